@@ -1,5 +1,5 @@
 from typing import Dict
-from .database import Database, MysqlDataBase
+from .database import Database, MysqlDataBase, SCHEMA_VERSION, md5_to_db
 
 DATABASE_CLASS: Dict[str, type] = {
     'mysql': MysqlDataBase
@@ -1,13 +1,29 @@
+import re
 import pymysql
 from pymysql.err import ProgrammingError
 from pymysql import Connection
+from pymysql.cursors import SSCursor
 from abc import ABCMeta, abstractmethod
-from typing import List, Tuple, Union, Dict
+from typing import List, Tuple, Union, Dict, Iterator
 
 from error import OperationError, CodingError
-from record import ManagementRecord, FileRecord, DirectoryRecord
+from record import ManagementRecord, FileRecord, DirectoryRecord, DirectoryStatsRecord
+
+# 当前数据库结构的版本号，旧版本的数据库需要使用migrate_db脚本升级
+SCHEMA_VERSION = 7
+# path表中根目录'/'的id，根目录的parent_id为0
+ROOT_PATH_ID = 1
+# content表中没有md5值的文件记录按大小归为一组，组的md5列为16个0字节
+UNHASHED_CONTENT_MD5 = bytes(16)
 
 ALL_TABLES = {
+    'schema_version': {
+        'mysql': """
+            CREATE TABLE schema_version (
+                version INT NOT NULL
+            );
+        """,
+    },
     'directory': {
         'mysql': """
             CREATE TABLE directory (
@@ -29,23 +45,95 @@ ALL_TABLES = {
             );
         """
     },
+    'path': {
+        'mysql': """
+            CREATE TABLE path (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                parent_id BIGINT NOT NULL,
+                name VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                UNIQUE path_parent_name_index(parent_id, `name`),
+                FULLTEXT path_name_fulltext(`name`) WITH PARSER ngram
+            );
+        """
+    },
     'file': {
         'mysql': """
             CREATE TABLE file (
                 id BIGINT AUTO_INCREMENT PRIMARY KEY, 
-                dir_path VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                path_id BIGINT NOT NULL,
                 name VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
                 suffix VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
-                md5 CHAR(32) DEFAULT NULL,
+                md5 BINARY(16) DEFAULT NULL,
                 size BIGINT NOT NULL,
                 dir_id INT NOT NULL,
                 modified_timestamp BIGINT NOT NULL,
-                UNIQUE file_path_index(dir_id, dir_path, `name`, suffix), 
+                change_seq BIGINT NOT NULL DEFAULT 0,
+                UNIQUE file_path_index(dir_id, path_id, `name`, suffix), 
                 INDEX file_size_index(`size`),
                 INDEX file_md5_index(md5),
                 INDEX file_same_index(`size`, md5),
                 INDEX file_modified_timestamp_index(modified_timestamp),
-                CONSTRAINT file_fk FOREIGN KEY (dir_id) REFERENCES directory(id)
+                INDEX file_change_seq_index(change_seq),
+                FULLTEXT file_name_fulltext(`name`) WITH PARSER ngram,
+                FULLTEXT file_suffix_fulltext(suffix) WITH PARSER ngram,
+                CONSTRAINT file_fk FOREIGN KEY (dir_id) REFERENCES directory(id),
+                CONSTRAINT file_path_fk FOREIGN KEY (path_id) REFERENCES path(id)
+            );
+        """
+    },
+    'directory_stats': {
+        'mysql': """
+            CREATE TABLE directory_stats (
+                dir_id INT PRIMARY KEY,
+                file_count BIGINT NOT NULL DEFAULT 0,
+                total_size BIGINT NOT NULL DEFAULT 0,
+                hashed_count BIGINT NOT NULL DEFAULT 0,
+                hashed_size BIGINT NOT NULL DEFAULT 0,
+                duplicate_count BIGINT NOT NULL DEFAULT 0,
+                duplicate_size BIGINT NOT NULL DEFAULT 0,
+                CONSTRAINT directory_stats_fk FOREIGN KEY (dir_id) REFERENCES directory(id) ON DELETE CASCADE
+            );
+        """
+    },
+    'content': {
+        'mysql': """
+            CREATE TABLE content (
+                `size` BIGINT NOT NULL,
+                md5 BINARY(16) NOT NULL,
+                refcount BIGINT NOT NULL,
+                duplicated TINYINT AS (refcount > 1) STORED NOT NULL,
+                PRIMARY KEY (`size`, md5),
+                INDEX content_duplicated_index(duplicated, `size`, md5)
+            );
+        """
+    },
+    'change_sequence': {
+        'mysql': """
+            CREATE TABLE change_sequence (
+                id TINYINT PRIMARY KEY,
+                seq BIGINT NOT NULL
+            );
+        """
+    },
+    'file_tombstone': {
+        'mysql': """
+            CREATE TABLE file_tombstone (
+                file_id BIGINT PRIMARY KEY,
+                change_seq BIGINT NOT NULL,
+                INDEX file_tombstone_change_seq_index(change_seq)
+            );
+        """
+    },
+    'file_move': {
+        'mysql': """
+            CREATE TABLE file_move (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                dir_id INT NOT NULL,
+                file_id BIGINT NOT NULL,
+                old_path TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                new_path TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                INDEX file_move_dir_id_index(dir_id),
+                CONSTRAINT file_move_fk FOREIGN KEY (dir_id) REFERENCES directory(id) ON DELETE CASCADE
             );
         """
     }
@@ -55,6 +143,47 @@ ALL_TABLES = {
 ALL_TABLE_NAMES = list(ALL_TABLES.keys())
 
 
+def escape_like(keyword: str) -> str:
+    """
+    转义LIKE语句中的通配符
+    :param keyword: 关键字
+    :return: 可以直接放入LIKE模式中的字符串
+    """
+    return keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def md5_to_db(md5: Union[str, None]) -> Union[bytes, None]:
+    """
+    将文件记录中的md5十六进制字符串转换为数据库中存储的16字节二进制值
+    :param md5: md5十六进制字符串，为空或者为FileRecord.EMPTY_MD5表示未计算
+    :return: 16字节的md5值，None表示未计算
+    """
+    if not md5 or md5 == FileRecord.EMPTY_MD5:
+        return None
+    return bytes.fromhex(md5)
+
+
+def content_md5_from_db(md5: bytes) -> str:
+    """
+    将content表中的md5值转换为文件记录中的十六进制字符串
+    :param md5: content表中的md5值
+    :return: md5十六进制字符串，没有md5值的内容为FileRecord.EMPTY_MD5
+    """
+    md5 = bytes(md5)
+    return FileRecord.EMPTY_MD5 if md5 == UNHASHED_CONTENT_MD5 else md5.hex()
+
+
+def md5_from_db(md5: Union[bytes, None]) -> str:
+    """
+    将数据库中存储的16字节二进制md5值转换为文件记录中的十六进制字符串
+    :param md5: 数据库中的md5值，None表示未计算
+    :return: md5十六进制字符串，未计算时为FileRecord.EMPTY_MD5
+    """
+    if md5 is None:
+        return FileRecord.EMPTY_MD5
+    return bytes(md5).hex()
+
+
 class Transaction(metaclass=ABCMeta):
     @abstractmethod
     def commit(self):
@@ -85,6 +214,19 @@ class Database(metaclass=ABCMeta):
         :return: 数据集是否已经初始化
         """
 
+    @abstractmethod
+    def schema_version(self) -> Union[int, None]:
+        """
+        :return: 数据库结构的版本号，None表示数据库未初始化
+        """
+
+    @abstractmethod
+    def migrate(self) -> int:
+        """
+        将数据库结构就地升级到当前版本SCHEMA_VERSION
+        :return: 升级前的版本号
+        """
+
     @abstractmethod
     def close(self):
         """
@@ -204,6 +346,22 @@ class Database(metaclass=ABCMeta):
         :return: 插入的记录数
         """
 
+    @abstractmethod
+    def move_file_records(self, moves: List[Tuple[FileRecord, str]]) -> int:
+        """
+        就地修改文件记录的路径，并记录这些移动以便在其他管理记录的物理位置重放
+        :param moves: (数据库中的文件记录, 新的相对路径)列表
+        :return: 修改的数量
+        """
+
+    @abstractmethod
+    def file_moves(self, dir_id: int) -> List[Tuple[int, str, str]]:
+        """
+        按发生的顺序查询目录中记录的文件记录移动
+        :param dir_id: 目录id
+        :return: (文件id, 移动前的相对路径, 移动后的相对路径)列表
+        """
+
     @abstractmethod
     def update_file_records(self, file_records: List[FileRecord]) -> int:
         """
@@ -213,10 +371,11 @@ class Database(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def file_records(self, dir_id: int) -> List[FileRecord]:
+    def file_records(self, dir_id: int, dir_path: str = '/') -> List[FileRecord]:
         """
         读取指定目录下的文件记录
         :param dir_id: 文件id
+        :param dir_path: 只读取该目录路径（以/开头和结尾）下的文件记录，默认为整个目录
         :return: 数据库中的文件记录列表
         """
 
@@ -228,6 +387,25 @@ class Database(metaclass=ABCMeta):
         :return: 删除的数量
         """
 
+    @abstractmethod
+    def hashed_file_records_after(self, dir_id: int, after: Union[str, None], limit: int) -> List[FileRecord]:
+        """
+        按完整路径的顺序分页读取有md5值的文件记录
+        :param dir_id: 目录id
+        :param after: 只读取路径大于该路径的文件记录，None表示从头开始
+        :param limit: 最多读取多少条
+        :return: 按路径排序的文件记录列表
+        """
+
+    @abstractmethod
+    def delete_file_records_under(self, dir_id: int, dir_path: str) -> int:
+        """
+        删除指定目录下某个目录路径中的所有文件记录（包括子目录中的）
+        :param dir_id: 目录id
+        :param dir_path: 目录路径，以/开头和结尾
+        :return: 删除的数量
+        """
+
     @abstractmethod
     def all_files(self) -> List[FileRecord]:
         """
@@ -235,6 +413,108 @@ class Database(metaclass=ABCMeta):
         :return: 数据库中的文件记录列表
         """
 
+    @abstractmethod
+    def iterate_file_rows(self, resolve_dir_path: bool = True, since: int = None) -> Iterator[tuple]:
+        """
+        按id顺序流式读取所有文件记录的原始数据，不构造FileRecord对象，读取完毕前不能执行其他数据库操作
+        :param resolve_dir_path: 是否将目录节点id还原为目录路径
+        :param since: 只读取修改序号大于该值的文件记录，None表示读取所有文件记录
+        :return: 生成器，每次生成(id, dir_path, name, suffix, md5, size, dir_id, modified_timestamp)，
+            resolve_dir_path为False时dir_path为目录节点id，md5为数据库中的16字节值或者None
+        """
+
+    @abstractmethod
+    def all_dir_paths(self) -> Dict[int, str]:
+        """
+        获取所有的目录节点
+        :return: [目录节点id] -> 目录路径
+        """
+
+    @abstractmethod
+    def intern_dir_paths(self, dir_paths: List[str]) -> Dict[str, int]:
+        """
+        获取目录路径对应的目录节点id，不存在的节点会被创建
+        :param dir_paths: 目录路径，以/开头和结尾
+        :return: [目录路径] -> 目录节点id
+        """
+
+    @abstractmethod
+    def create_file_rows_with_id(self, rows: List[tuple], replace: bool = False) -> int:
+        """
+        以原始数据创建指定id的文件记录，用于快速的初始化，同create_files_with_id不会维护统计信息
+        :param rows: (id, 目录节点id, name, suffix, md5, size, dir_id, modified_timestamp)列表，md5为16字节值或者None
+        :param replace: 是否覆盖已存在的同id文件记录
+        :return: 创建记录的个数
+        """
+
+    @abstractmethod
+    def prepare_bulk_load(self):
+        """
+        大量导入文件记录前删除file表的二级索引和外键，可以重复调用
+        :return: None
+        """
+
+    @abstractmethod
+    def finish_bulk_load(self):
+        """
+        大量导入文件记录后重新创建prepare_bulk_load删除的索引和外键，可以重复调用
+        :return: None
+        """
+
+    @abstractmethod
+    def defer_constraint_checks(self):
+        """
+        在本连接中关闭外键和唯一性检查，用于大量导入文件记录的连接
+        :return: None
+        """
+
+    @abstractmethod
+    def file_count_in_id_range(self, first_id: int, last_id: int) -> int:
+        """
+        :return: id在[first_id, last_id]之间的文件记录数
+        """
+
+    @abstractmethod
+    def purge_file_records(self, file_ids: List[int]) -> int:
+        """
+        删除指定id的文件记录，不维护统计信息也不留下删除标记，用于重放增量导出的数据
+        :param file_ids: 文件id
+        :return: 删除的数量
+        """
+
+    @abstractmethod
+    def change_seq(self) -> int:
+        """
+        :return: 最近一次修改文件记录的修改序号，导出数据时作为快照的序号
+        """
+
+    @abstractmethod
+    def set_change_seq(self, seq: int):
+        """
+        设置当前的修改序号，用于重放增量导出的数据后与导出时的数据库保持一致
+        :param seq: 修改序号
+        :return: None
+        """
+
+    @abstractmethod
+    def deleted_file_ids(self, since: int) -> List[int]:
+        """
+        查询修改序号大于since之后被删除的文件记录id
+        :param since: 修改序号
+        :return: 文件id列表
+        """
+
+    @abstractmethod
+    def replace_directories_and_managements(
+            self, directories: List[DirectoryRecord], managements: List[ManagementRecord]
+    ):
+        """
+        将目录记录和管理记录替换为指定的记录，用于重放增量导出的数据，不在列表中的目录记录需要已经没有文件记录
+        :param directories: 目录记录
+        :param managements: 管理记录
+        :return: None
+        """
+
     @abstractmethod
     def all_managements(self) -> List[ManagementRecord]:
         """
@@ -243,17 +523,60 @@ class Database(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def query_common_size_wo_md5_files(self) -> Dict[int, List[int]]:
+    def duplicate_content_count(self, hashed: bool) -> int:
         """
-        查询所有拥有相同大小的缺失md5的文件记录id
-        :return: [size] -> [file_ids]
+        查询被多个文件记录引用的内容的数量
+        :param hashed: True表示大小和md5值都相同的内容，False表示没有md5值且大小相同的内容
+        :return: 内容的数量
+        """
+
+    @abstractmethod
+    def duplicate_contents(
+            self, hashed: bool, limit: int, after: Tuple[int, str] = None
+    ) -> List[Tuple[int, str, int]]:
+        """
+        按大小从大到小分页查询被多个文件记录引用的内容
+        :param hashed: True表示大小和md5值都相同的内容，False表示没有md5值且大小相同的内容
+        :param limit: 最多返回多少条
+        :param after: 上一页最后一条内容的(size, md5)，None表示从第一页开始
+        :return: (size, md5, 引用数)列表，没有md5值的内容的md5为FileRecord.EMPTY_MD5
+        """
+
+    @abstractmethod
+    def query_file_ids_by_contents(self, contents: List[Tuple[int, str]]) -> Dict[Tuple[int, str], List[int]]:
+        """
+        批量查询引用指定内容的文件记录id
+        :param contents: (size, md5)列表，md5为FileRecord.EMPTY_MD5时查询没有md5值且大小相同的文件记录
+        :return: [(size, md5)] -> [file_ids]
+        """
+
+    @abstractmethod
+    def file_records_by_contents(
+            self, contents: List[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], List[FileRecord]]:
+        """
+        批量查询所有目录中内容为指定(大小, md5值)的文件记录，用于寻找文件的其他副本
+        :param contents: (size, md5)列表，md5值不能为FileRecord.EMPTY_MD5
+        :return: [(size, md5)] -> 文件记录列表
+        """
+
+    @abstractmethod
+    def iterate_file_records_by_path(self, dir_id: int) -> Iterator[FileRecord]:
+        """
+        按路径（UTF-8编码的字节序，与Python字符串的比较顺序一致）流式读取目录中的所有文件记录，由数据库排序，
+        读取完毕前不能执行其他数据库操作
+        :param dir_id: 目录id
+        :return: 文件记录的生成器
         """
 
     @abstractmethod
-    def query_common_md5_files(self) -> Dict[int, Dict[str, List[int]]]:
+    def unhashed_file_records(self, dir_id: int, limit: int, after: int = 0) -> List[FileRecord]:
         """
-        查询所有拥有相同大小和md5的文件记录id
-        :return: [size][md5] -> [file_ids]
+        按id顺序分页查询目录中没有md5值的文件记录
+        :param dir_id: 目录id
+        :param limit: 最多返回多少条
+        :param after: 上一页最后一条文件记录的id，0表示从第一页开始
+        :return: 文件记录列表
         """
 
     @abstractmethod
@@ -273,13 +596,29 @@ class Database(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def create_files_with_id(self, records: List[FileRecord]) -> int:
+    def create_files_with_id(self, records: List[FileRecord], replace: bool = False) -> int:
         """
-        创建指定id管理记录，用于初始化
+        创建指定id管理记录，用于初始化，不维护统计信息，导入完成后需要调用rebuild_statistics
         :param records: 记录列表
+        :param replace: 是否覆盖已存在的同id文件记录
         :return: 创建记录的个数
         """
 
+    @abstractmethod
+    def rebuild_statistics(self):
+        """
+        根据文件记录重建所有的统计信息
+        :return: None
+        """
+
+    @abstractmethod
+    def directory_statistics(self, dir_ids: List[int] = None) -> Dict[int, DirectoryStatsRecord]:
+        """
+        查询目录的统计信息
+        :param dir_ids: 需要查询的目录id，None表示所有目录
+        :return: [dir_id] -> DirectoryStatsRecord，没有文件记录的目录统计信息全部为0
+        """
+
     @abstractmethod
     def query_file_by_id(self, file_ids: List[int]) -> Dict[int, FileRecord]:
         """
@@ -297,21 +636,33 @@ class Database(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def query_director_size(self, dir_id: int) -> int:
+    def query_director_size(self, dir_id: int, dir_path: str = '/') -> int:
         """
         查询目录的大小
         :param dir_id: 目录id
+        :param dir_path: 只统计该目录路径（以/开头和结尾）下的文件记录，默认为整个目录
         :return: 大小（字节）
         """
 
-    @abstractmethod
     def find_in_file_path(self, column: str, keyword: str) -> List[FileRecord]:
         """
         在文件记录的指定字段中寻找指定关键字
-        :param column: 字段
+        :param column: 字段，只能是dir_path、name或suffix
         :param keyword: 关键字
         :return: 查询到的文件记录
         """
+        assert column in ('dir_path', 'name', 'suffix'), CodingError(f'不支持在字段{column}中查找')
+        return self.find_files(**{column: keyword})
+
+    @abstractmethod
+    def find_files(self, name: str = None, suffix: str = None, dir_path: str = None) -> List[FileRecord]:
+        """
+        查找文件名、后缀和目录路径分别包含指定关键字的文件记录，多个关键字之间是"且"的关系
+        :param name: 文件名关键字，None表示不限制
+        :param suffix: 后缀关键字，None表示不限制
+        :param dir_path: 目录路径关键字，None表示不限制
+        :return: 查询到的文件记录
+        """
 
     @abstractmethod
     def query_file_ids_by_size_and_md5(self, size: int, md5: str) -> List[int]:
@@ -339,8 +690,61 @@ class MysqlDataBase(Database):
     __DROP_CONSTRAINT_SQL = [
         'ALTER TABLE management DROP FOREIGN KEY management_fk',
         'ALTER TABLE file DROP FOREIGN KEY file_fk',
+        'ALTER TABLE file DROP FOREIGN KEY file_path_fk',
+        'ALTER TABLE directory_stats DROP FOREIGN KEY directory_stats_fk',
+        'ALTER TABLE file_move DROP FOREIGN KEY file_move_fk',
     ]
     __WHERE_IN_BATCH = 1000  # 使用where in查询时最多一次execute多少个
+    # 构造文件记录时查询的字段，由_fetch_file_records读取
+    __FILE_COLUMNS = 'file.path_id, file.`name`, file.suffix, file.md5, file.`size`, ' \
+                     'file.modified_timestamp, file.id, file.dir_id'
+    # 以导入的数据覆盖已存在的同id文件记录
+    __FILE_UPSERT = """
+        ON DUPLICATE KEY UPDATE path_id = VALUES(path_id), `name` = VALUES(`name`), suffix = VALUES(suffix), 
+        md5 = VALUES(md5), `size` = VALUES(`size`), dir_id = VALUES(dir_id), 
+        modified_timestamp = VALUES(modified_timestamp)
+    """
+    # 大量导入文件记录时延后创建的file表二级索引：[索引名] -> 定义
+    __FILE_DEFERRED_INDEXES = {
+        'file_path_index': 'UNIQUE file_path_index(dir_id, path_id, `name`, suffix)',
+        'file_size_index': 'INDEX file_size_index(`size`)',
+        'file_md5_index': 'INDEX file_md5_index(md5)',
+        'file_same_index': 'INDEX file_same_index(`size`, md5)',
+        'file_modified_timestamp_index': 'INDEX file_modified_timestamp_index(modified_timestamp)',
+        'file_change_seq_index': 'INDEX file_change_seq_index(change_seq)',
+        'file_name_fulltext': 'FULLTEXT file_name_fulltext(`name`) WITH PARSER ngram',
+        'file_suffix_fulltext': 'FULLTEXT file_suffix_fulltext(suffix) WITH PARSER ngram',
+    }
+    # 大量导入文件记录时延后创建的file表外键：[外键名] -> 定义
+    __FILE_DEFERRED_FOREIGN_KEYS = {
+        'file_fk': 'CONSTRAINT file_fk FOREIGN KEY (dir_id) REFERENCES directory(id)',
+        'file_path_fk': 'CONSTRAINT file_path_fk FOREIGN KEY (path_id) REFERENCES path(id)',
+    }
+    # 流式读取时每次从服务端读取的行数
+    __STREAM_BATCH = 10000
+    # 按路径流式读取时服务端等待客户端读取的超时秒数
+    __STREAM_WRITE_TIMEOUT = 3600
+    # 按完整路径排序时比较的最大字节数，默认的1024字节会截断较深的路径（例如每个字符3字节的中文路径），使排序出错，
+    # 这里取MySQL允许的最大值
+    __MAX_SORT_LENGTH = 8388608
+    # 以参数指定的节点为根的所有子孙节点（包括其自身），通过path表的(parent_id, name)索引逐层查找
+    __SUBTREE_CTE = """
+        WITH RECURSIVE subtree (id) AS (
+            SELECT CAST(%s AS SIGNED)
+            UNION ALL
+            SELECT path.id FROM path JOIN subtree ON path.parent_id = subtree.id
+        )
+    """
+    # 在数据库中拼接从指定节点开始的每个目录节点的完整路径，参数为起始节点id，其路径为/。
+    # 递归CTE中路径列的类型由初始行决定，CHAR(65535)使其成为TEXT类型，目录路径不会因为长度被截断
+    __FULL_PATH_CTE = """
+        WITH RECURSIVE full_path (id, dir_path) AS (
+            SELECT CAST(%s AS SIGNED), CAST('/' AS CHAR(65535) CHARACTER SET utf8mb4)
+            UNION ALL
+            SELECT path.id, CONCAT(full_path.dir_path, path.`name`, '/')
+            FROM path JOIN full_path ON path.parent_id = full_path.id
+        )
+    """
 
     def __init__(
             self,
@@ -361,6 +765,7 @@ class MysqlDataBase(Database):
             db='lyl232fm',
             charset='utf8mb4'
         )
+        self._ngram_token_size = None
 
     def begin_transaction(self) -> MysqlTransaction:
         return MysqlTransaction(self.connection)
@@ -380,11 +785,252 @@ class MysqlDataBase(Database):
         """
         :return: 数据库是否已经初始化好了
         """
+        return self.schema_version() is not None
+
+    def schema_version(self) -> Union[int, None]:
         with self.connection.cursor() as cursor:
-            for table_name in ALL_TABLE_NAMES:
-                if cursor.execute(f"SHOW TABLES LIKE '{table_name}';") == 0:
-                    return False
-        return True
+            if cursor.execute("SHOW TABLES LIKE 'schema_version';") == 0:
+                # 版本0的数据库没有schema_version表
+                return 0 if cursor.execute("SHOW TABLES LIKE 'directory';") > 0 else None
+            cursor.execute('SELECT version FROM schema_version;')
+            res = cursor.fetchone()
+            return 0 if res is None else int(res[0])
+
+    def migrate(self) -> int:
+        """
+        就地升级数据库结构，注意：MySQL的DDL语句会隐式提交事务，所以每一步升级完成后都会立即记录版本号，
+        每一步中的DDL语句执行前都会检查其效果是否已经存在，中途失败后可以重新执行
+        :return: 升级前的版本号
+        """
+        version = self.schema_version()
+        assert version is not None, OperationError('数据库尚未初始化，无需升级')
+        assert version <= SCHEMA_VERSION, OperationError(
+            f'数据库结构版本{version}比程序支持的版本{SCHEMA_VERSION}更新，请升级程序')
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            print(f'正在将数据库结构从版本{target - 1}升级到版本{target}')
+            with self.connection.cursor() as cursor:
+                getattr(self, f'_migrate_to_v{target}')(cursor)
+                cursor.execute('DELETE FROM schema_version;')
+                cursor.execute('INSERT INTO schema_version (version) VALUES (%s);', (target,))
+            self.connection.commit()
+        return version
+
+    @staticmethod
+    def _table_exists(cursor, table: str) -> bool:
+        cursor.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s;
+            """,
+            (table,)
+        )
+        return int(cursor.fetchone()[0]) > 0
+
+    @staticmethod
+    def _column_type(cursor, table: str, column: str) -> Union[str, None]:
+        """
+        :return: 字段的数据类型（例如char、binary），字段不存在时为None
+        """
+        cursor.execute(
+            """
+            SELECT DATA_TYPE FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s;
+            """,
+            (table, column)
+        )
+        res = cursor.fetchone()
+        return None if res is None else res[0].lower()
+
+    @staticmethod
+    def _index_exists(cursor, table: str, index: str) -> bool:
+        cursor.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s;
+            """,
+            (table, index)
+        )
+        return int(cursor.fetchone()[0]) > 0
+
+    def _migrate_to_v1(self, cursor):
+        """
+        版本1：md5由CHAR(32)的十六进制字符串改为BINARY(16)，未计算的md5由32个星号改为NULL
+        """
+        if not self._table_exists(cursor, 'schema_version'):
+            cursor.execute(ALL_TABLES['schema_version']['mysql'])
+        if self._column_type(cursor, 'file', 'md5') == 'binary':
+            # 最后一条ALTER已经执行完毕
+            return
+        if self._column_type(cursor, 'file', 'md5_bin') is None:
+            cursor.execute('ALTER TABLE file ADD COLUMN md5_bin BINARY(16) DEFAULT NULL AFTER md5;')
+        cursor.execute(
+            """
+            UPDATE file SET md5_bin = UNHEX(md5) WHERE md5 IS NOT NULL AND md5 != %s;
+            """,
+            (FileRecord.EMPTY_MD5,)
+        )
+        cursor.execute(
+            """
+            ALTER TABLE file
+            DROP INDEX file_md5_index,
+            DROP INDEX file_same_index,
+            DROP COLUMN md5,
+            RENAME COLUMN md5_bin TO md5,
+            ADD INDEX file_md5_index(md5),
+            ADD INDEX file_same_index(`size`, md5);
+            """
+        )
+
+    def _migrate_to_v2(self, cursor):
+        """
+        版本2：文件记录的dir_path改为引用path表中的目录节点
+        """
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS path (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                parent_id BIGINT NOT NULL,
+                name VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                UNIQUE path_parent_name_index(parent_id, `name`)
+            );
+            """
+        )
+        cursor.execute('INSERT IGNORE INTO path (id, parent_id, `name`) VALUES (%s, 0, %s);', (ROOT_PATH_ID, ''))
+        if self._column_type(cursor, 'file', 'dir_path') is None:
+            # 最后一条ALTER已经执行完毕
+            return
+        cursor.execute('SELECT DISTINCT dir_path FROM file;')
+        path_ids = self._intern_dir_paths(cursor, [each[0] for each in cursor.fetchall()])
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE path_map (
+                dir_path VARCHAR (255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin PRIMARY KEY,
+                path_id BIGINT NOT NULL
+            );
+            """
+        )
+        cursor.executemany(
+            'INSERT INTO path_map (dir_path, path_id) VALUES (%s, %s);',
+            list(path_ids.items())
+        )
+        if self._column_type(cursor, 'file', 'path_id') is None:
+            cursor.execute('ALTER TABLE file ADD COLUMN path_id BIGINT DEFAULT NULL AFTER id;')
+        cursor.execute(
+            """
+            UPDATE file JOIN path_map ON file.dir_path = path_map.dir_path SET file.path_id = path_map.path_id;
+            """
+        )
+        cursor.execute('DROP TEMPORARY TABLE path_map;')
+        cursor.execute(
+            """
+            ALTER TABLE file
+            DROP INDEX file_path_index,
+            DROP COLUMN dir_path,
+            MODIFY path_id BIGINT NOT NULL,
+            ADD UNIQUE file_path_index(dir_id, path_id, `name`, suffix),
+            ADD CONSTRAINT file_path_fk FOREIGN KEY (path_id) REFERENCES path(id);
+            """
+        )
+
+    def _migrate_to_v3(self, cursor):
+        """
+        版本3：文件名、后缀和目录节点名使用ngram全文索引进行子串查找
+        """
+        cursor.execute('SET SESSION innodb_ft_enable_stopword = OFF;')
+        # InnoDB一次只能添加一个全文索引
+        for table, index, column in (
+                ('file', 'file_name_fulltext', '`name`'),
+                ('file', 'file_suffix_fulltext', 'suffix'),
+                ('path', 'path_name_fulltext', '`name`'),
+        ):
+            if not self._index_exists(cursor, table, index):
+                cursor.execute(f'ALTER TABLE {table} ADD FULLTEXT {index}({column}) WITH PARSER ngram;')
+
+    def _migrate_to_v4(self, cursor):
+        """
+        版本4：增加随文件记录增量维护的目录统计信息表
+        """
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS directory_stats (
+                dir_id INT PRIMARY KEY,
+                file_count BIGINT NOT NULL DEFAULT 0,
+                total_size BIGINT NOT NULL DEFAULT 0,
+                hashed_count BIGINT NOT NULL DEFAULT 0,
+                hashed_size BIGINT NOT NULL DEFAULT 0,
+                duplicate_count BIGINT NOT NULL DEFAULT 0,
+                duplicate_size BIGINT NOT NULL DEFAULT 0,
+                CONSTRAINT directory_stats_fk FOREIGN KEY (dir_id) REFERENCES directory(id) ON DELETE CASCADE
+            );
+            """
+        )
+        self._rebuild_directory_stats(cursor)
+
+    def _migrate_to_v5(self, cursor):
+        """
+        版本5：增加随文件记录增量维护的内容引用计数表
+        """
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS content (
+                `size` BIGINT NOT NULL,
+                md5 BINARY(16) NOT NULL,
+                refcount BIGINT NOT NULL,
+                duplicated TINYINT AS (refcount > 1) STORED NOT NULL,
+                PRIMARY KEY (`size`, md5),
+                INDEX content_duplicated_index(duplicated, `size`, md5)
+            );
+            """
+        )
+        self._rebuild_content(cursor)
+
+    def _migrate_to_v6(self, cursor):
+        """
+        版本6：文件记录增加修改序号，删除的文件记录留下删除标记，用于增量导出
+        """
+        if self._column_type(cursor, 'file', 'change_seq') is None:
+            cursor.execute(
+                """
+                ALTER TABLE file ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0, 
+                ADD INDEX file_change_seq_index(change_seq);
+                """
+            )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS change_sequence (
+                id TINYINT PRIMARY KEY,
+                seq BIGINT NOT NULL
+            );
+            """
+        )
+        cursor.execute('INSERT IGNORE INTO change_sequence (id, seq) VALUES (1, 0);')
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_tombstone (
+                file_id BIGINT PRIMARY KEY,
+                change_seq BIGINT NOT NULL,
+                INDEX file_tombstone_change_seq_index(change_seq)
+            );
+            """
+        )
+
+    @staticmethod
+    def _migrate_to_v7(cursor):
+        """
+        版本7：记录文件记录的移动，用于在其他管理记录的物理位置重放移动
+        """
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_move (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                dir_id INT NOT NULL,
+                file_id BIGINT NOT NULL,
+                old_path TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                new_path TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_bin NOT NULL,
+                INDEX file_move_dir_id_index(dir_id),
+                CONSTRAINT file_move_fk FOREIGN KEY (dir_id) REFERENCES directory(id) ON DELETE CASCADE
+            );
+            """
+        )
 
     def clear(self):
         """
@@ -411,8 +1057,14 @@ class MysqlDataBase(Database):
         :return:
         """
         with self.connection.cursor() as cursor:
+            # ngram分词会丢弃所有包含停用词的词元，例如包含"a"的所有二元组，所以全文索引不使用停用词
+            cursor.execute('SET SESSION innodb_ft_enable_stopword = OFF;')
             for table, build_statement in ALL_TABLES.items():
                 cursor.execute(build_statement['mysql'])
+            cursor.execute('INSERT INTO schema_version (version) VALUES (%s);', (SCHEMA_VERSION,))
+            cursor.execute('INSERT INTO path (id, parent_id, `name`) VALUES (%s, 0, %s);', (ROOT_PATH_ID, ''))
+            cursor.execute('INSERT INTO change_sequence (id, seq) VALUES (1, 0);')
+        self.connection.commit()
 
     def directory_id(self, name: str) -> int:
         with self.connection.cursor() as cursor:
@@ -543,62 +1195,567 @@ class MysqlDataBase(Database):
                 return None
             return res[0]
 
-    def new_file_records(self, dir_id: int, file_records: List[FileRecord]) -> int:
-        with self.connection.cursor() as cursor:
-            return cursor.executemany(
+    def _intern_dir_paths(self, cursor, dir_paths) -> Dict[str, int]:
+        """
+        获取目录路径在path表中对应的节点id，不存在的节点会被创建，按目录深度逐层批量查询和插入
+        :param cursor: 数据库游标
+        :param dir_paths: 目录路径，以/开头和结尾
+        :return: [目录路径] -> 节点id
+        """
+        path_ids = {'/': ROOT_PATH_ID}
+        levels: Dict[int, set] = {}
+        for dir_path in set(dir_paths):
+            parts = dir_path.split('/')[1:-1]
+            for depth in range(1, len(parts) + 1):
+                levels.setdefault(depth, set()).add('/' + '/'.join(parts[:depth]) + '/')
+        for depth in sorted(levels.keys()):
+            key2path = {}
+            for dir_path in levels[depth]:
+                parent_path, name = dir_path[:-1].rsplit('/', 1)
+                key2path[(path_ids[parent_path + '/'], name)] = dir_path
+            keys = list(key2path.keys())
+            found = self._query_path_node_ids(cursor, keys)
+            missing = [each for each in keys if each not in found]
+            if len(missing) > 0:
+                # 使用IGNORE防止并发插入相同的节点时出错
+                cursor.executemany('INSERT IGNORE INTO path (parent_id, `name`) VALUES (%s, %s);', missing)
+                found.update(self._query_path_node_ids(cursor, missing))
+            for key, dir_path in key2path.items():
+                path_ids[dir_path] = found[key]
+        return path_ids
+
+    def _query_path_node_ids(self, cursor, keys: List[Tuple[int, str]]) -> Dict[Tuple[int, str], int]:
+        """
+        :param cursor: 数据库游标
+        :param keys: (父节点id，目录名)列表
+        :return: [(父节点id，目录名)] -> 节点id，不存在的节点不会出现在结果中
+        """
+        res = {}
+        for begin in range(0, len(keys), self.__WHERE_IN_BATCH):
+            batch = keys[begin: begin + self.__WHERE_IN_BATCH]
+            cursor.execute(
+                """
+                SELECT parent_id, `name`, id FROM path WHERE (parent_id, `name`) IN (%s);
+                """ % ','.join(['(%s, %s)'] * len(batch)),
+                [item for each in batch for item in each]
+            )
+            for parent_id, name, path_id in cursor.fetchall():
+                res[(int(parent_id), name)] = int(path_id)
+        return res
+
+    def _resolve_path_ids(self, cursor, path_ids) -> Dict[int, str]:
+        """
+        将path表中的节点id还原为目录路径，按目录深度逐层批量向上查询父节点
+        :param cursor: 数据库游标
+        :param path_ids: 节点id
+        :return: [节点id] -> 目录路径，以/开头和结尾
+        """
+        nodes = {}
+        pending = {int(each) for each in path_ids} - {ROOT_PATH_ID}
+        while len(pending) > 0:
+            pending = list(pending)
+            for begin in range(0, len(pending), self.__WHERE_IN_BATCH):
+                batch = pending[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    SELECT id, parent_id, `name` FROM path WHERE id IN (%s);
+                    """ % ','.join(['%s'] * len(batch)),
+                    batch
+                )
+                for path_id, parent_id, name in cursor.fetchall():
+                    nodes[int(path_id)] = (int(parent_id), name)
+            pending = {
+                nodes[each][0] for each in pending
+                if nodes[each][0] != ROOT_PATH_ID and nodes[each][0] not in nodes
+            }
+        return self._build_dir_paths(nodes, path_ids)
+
+    @staticmethod
+    def _build_dir_paths(nodes: Dict[int, Tuple[int, str]], path_ids) -> Dict[int, str]:
+        """
+        根据节点信息拼接目录路径
+        :param nodes: [节点id] -> (父节点id，目录名)，需要包含path_ids的所有祖先节点
+        :param path_ids: 需要拼接的节点id
+        :return: [节点id] -> 目录路径
+        """
+        dir_paths = {ROOT_PATH_ID: '/'}
+        for path_id in path_ids:
+            chain = []
+            current = int(path_id)
+            while current not in dir_paths:
+                chain.append(current)
+                current = nodes[current][0]
+            for each in reversed(chain):
+                dir_paths[each] = f'{dir_paths[nodes[each][0]]}{nodes[each][1]}/'
+        return dir_paths
+
+    def _find_path_id(self, cursor, dir_path: str) -> Union[int, None]:
+        """
+        查询目录路径对应的节点id，不会创建节点
+        :param cursor: 数据库游标
+        :param dir_path: 目录路径，以/开头和结尾
+        :return: 节点id，None表示不存在
+        """
+        path_id = ROOT_PATH_ID
+        for name in dir_path.split('/')[1:-1]:
+            cursor.execute('SELECT id FROM path WHERE parent_id = %s AND `name` = %s;', (path_id, name))
+            res = cursor.fetchone()
+            if res is None:
+                return None
+            path_id = int(res[0])
+        return path_id
+
+    def _fetch_file_records(self, cursor) -> List[FileRecord]:
+        """
+        读取以__FILE_COLUMNS为字段的查询结果，并批量将path_id还原为目录路径
+        :param cursor: 执行过查询的数据库游标
+        :return: 文件记录列表
+        """
+        rows = cursor.fetchall()
+        dir_paths = self._resolve_path_ids(cursor, {int(each[0]) for each in rows})
+        return FileRecord.from_db_rows(rows, dir_paths)
+
+    def _query_stats_rows(self, cursor, file_ids: List[int]) -> List[Tuple[int, int, Union[bytes, None]]]:
+        """
+        查询文件记录中与统计信息相关的字段
+        :param cursor: 数据库游标
+        :param file_ids: 文件id
+        :return: (dir_id, size, md5)列表
+        """
+        rows = []
+        for begin in range(0, len(file_ids), self.__WHERE_IN_BATCH):
+            batch = file_ids[begin: begin + self.__WHERE_IN_BATCH]
+            cursor.execute(
                 """
-                INSERT INTO file 
-                (dir_path, `name`, suffix, md5, `size`, dir_id, modified_timestamp) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
+                SELECT dir_id, `size`, md5 FROM file WHERE id IN (%s);
+                """ % ','.join(['%s'] * len(batch)),
+                batch
+            )
+            rows.extend((int(dir_id), int(size), md5) for dir_id, size, md5 in cursor.fetchall())
+        return rows
+
+    def _query_duplicate_distribution(self, cursor, keys: List[Tuple[int, bytes]]) -> Dict[tuple, Dict[int, int]]:
+        """
+        查询拥有指定大小和md5值的文件记录在各个目录中的数量
+        :param cursor: 数据库游标
+        :param keys: (size, md5)列表
+        :return: [(size, md5)] -> [dir_id] -> 文件记录数
+        """
+        res = {}
+        for begin in range(0, len(keys), self.__WHERE_IN_BATCH):
+            batch = keys[begin: begin + self.__WHERE_IN_BATCH]
+            cursor.execute(
+                """
+                SELECT `size`, md5, dir_id, COUNT(*) FROM file
+                WHERE (`size`, md5) IN (%s)
+                GROUP BY `size`, md5, dir_id;
+                """ % ','.join(['(%s, %s)'] * len(batch)),
+                [item for each in batch for item in each]
+            )
+            for size, md5, dir_id, count in cursor.fetchall():
+                res.setdefault((int(size), bytes(md5)), {})[int(dir_id)] = int(count)
+        return res
+
+    def _maintain_statistics(self, cursor, old_rows: list, new_rows: list, write: callable):
+        """
+        执行对文件表的写操作，并在同一事务中增量维护统计信息
+        :param cursor: 数据库游标
+        :param old_rows: 写操作会删除或者修改的文件记录的(dir_id, size, md5)列表
+        :param new_rows: 写操作会插入或者修改后的文件记录的(dir_id, size, md5)列表
+        :param write: 对文件表的写操作，不接收参数
+        :return: 写操作的返回值
+        """
+        keys = list({(size, bytes(md5)) for _, size, md5 in old_rows + new_rows if md5 is not None})
+        before = self._query_duplicate_distribution(cursor, keys)
+        res = write()
+        after = self._query_duplicate_distribution(cursor, keys)
+
+        # [dir_id] -> [file_count, total_size, hashed_count, hashed_size, duplicate_count, duplicate_size]
+        deltas = {}
+        for rows, sign in ((old_rows, -1), (new_rows, 1)):
+            for dir_id, size, md5 in rows:
+                delta = deltas.setdefault(dir_id, [0] * 6)
+                delta[0] += sign
+                delta[1] += sign * size
+                if md5 is not None:
+                    delta[2] += sign
+                    delta[3] += sign * size
+        for distribution, sign in ((before, -1), (after, 1)):
+            for (size, _), dir_counts in distribution.items():
+                if sum(dir_counts.values()) < 2:
+                    continue
+                for dir_id, count in dir_counts.items():
+                    delta = deltas.setdefault(dir_id, [0] * 6)
+                    delta[4] += sign * count
+                    delta[5] += sign * count * size
+        self._maintain_content(cursor, old_rows, new_rows)
+        deltas = [(dir_id, *delta) for dir_id, delta in deltas.items() if any(each != 0 for each in delta)]
+        if len(deltas) > 0:
+            cursor.executemany(
+                """
+                INSERT INTO directory_stats
+                (dir_id, file_count, total_size, hashed_count, hashed_size, duplicate_count, duplicate_size)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                file_count = file_count + VALUES(file_count),
+                total_size = total_size + VALUES(total_size),
+                hashed_count = hashed_count + VALUES(hashed_count),
+                hashed_size = hashed_size + VALUES(hashed_size),
+                duplicate_count = duplicate_count + VALUES(duplicate_count),
+                duplicate_size = duplicate_size + VALUES(duplicate_size);
                 """,
-                [
-                    (each.dir_path, each.name, each.suffix, each.md5, each.size, dir_id, each.modified_time)
-                    for each in file_records
-                ]
+                deltas
+            )
+        return res
+
+    def _maintain_content(self, cursor, old_rows: list, new_rows: list):
+        """
+        根据写操作前后的文件记录增量维护内容的引用计数
+        :param cursor: 数据库游标
+        :param old_rows: 被删除或者修改的文件记录的(dir_id, size, md5)列表
+        :param new_rows: 插入或者修改后的文件记录的(dir_id, size, md5)列表
+        :return: None
+        """
+        refcount_deltas = {}
+        for rows, sign in ((old_rows, -1), (new_rows, 1)):
+            for _, size, md5 in rows:
+                key = (size, UNHASHED_CONTENT_MD5 if md5 is None else bytes(md5))
+                refcount_deltas[key] = refcount_deltas.get(key, 0) + sign
+        increased = [(size, md5, delta) for (size, md5), delta in refcount_deltas.items() if delta > 0]
+        decreased = [(delta, size, md5) for (size, md5), delta in refcount_deltas.items() if delta < 0]
+        if len(increased) > 0:
+            cursor.executemany(
+                """
+                INSERT INTO content (`size`, md5, refcount) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount);
+                """,
+                increased
+            )
+        if len(decreased) > 0:
+            cursor.executemany(
+                """
+                UPDATE content SET refcount = refcount + %s WHERE `size` = %s AND md5 = %s;
+                """,
+                decreased
+            )
+            removed = [(size, md5) for _, size, md5 in decreased]
+            for begin in range(0, len(removed), self.__WHERE_IN_BATCH):
+                batch = removed[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    DELETE FROM content WHERE refcount <= 0 AND (`size`, md5) IN (%s);
+                    """ % ','.join(['(%s, %s)'] * len(batch)),
+                    [item for each in batch for item in each]
+                )
+
+    @staticmethod
+    def _rebuild_content(cursor):
+        """
+        根据文件记录重建内容引用计数表
+        :param cursor: 数据库游标
+        :return: None
+        """
+        cursor.execute('DELETE FROM content;')
+        cursor.execute(
+            """
+            INSERT INTO content (`size`, md5, refcount)
+            SELECT `size`, COALESCE(md5, %s), COUNT(*) FROM file GROUP BY `size`, COALESCE(md5, %s);
+            """,
+            (UNHASHED_CONTENT_MD5, UNHASHED_CONTENT_MD5)
+        )
+
+    @staticmethod
+    def _rebuild_directory_stats(cursor):
+        """
+        根据文件记录重建目录统计信息表
+        :param cursor: 数据库游标
+        :return: None
+        """
+        cursor.execute('DELETE FROM directory_stats;')
+        cursor.execute(
+            """
+            INSERT INTO directory_stats
+            (dir_id, file_count, total_size, hashed_count, hashed_size, duplicate_count, duplicate_size)
+            SELECT
+            file.dir_id, COUNT(*), SUM(file.`size`),
+            COUNT(file.md5), COALESCE(SUM(IF(file.md5 IS NULL, 0, file.`size`)), 0),
+            COUNT(dup.`size`), COALESCE(SUM(IF(dup.`size` IS NULL, 0, file.`size`)), 0)
+            FROM file LEFT JOIN (
+                SELECT `size`, md5 FROM file WHERE md5 IS NOT NULL GROUP BY `size`, md5 HAVING COUNT(*) > 1
+            ) dup ON file.`size` = dup.`size` AND file.md5 = dup.md5
+            GROUP BY file.dir_id;
+            """
+        )
+
+    def rebuild_statistics(self):
+        with self.connection.cursor() as cursor:
+            self._rebuild_directory_stats(cursor)
+            self._rebuild_content(cursor)
+
+    def directory_statistics(self, dir_ids: List[int] = None) -> Dict[int, DirectoryStatsRecord]:
+        with self.connection.cursor() as cursor:
+            if dir_ids is None:
+                cursor.execute('SELECT id FROM directory;')
+                dir_ids = [int(each[0]) for each in cursor.fetchall()]
+            records = {dir_id: DirectoryStatsRecord(dir_id=dir_id) for dir_id in dir_ids}
+            for begin in range(0, len(dir_ids), self.__WHERE_IN_BATCH):
+                batch = dir_ids[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    SELECT dir_id, file_count, total_size, hashed_count, hashed_size, duplicate_count, duplicate_size
+                    FROM directory_stats WHERE dir_id IN (%s);
+                    """ % ','.join(['%s'] * len(batch)),
+                    batch
+                )
+                for res in cursor.fetchall():
+                    records[int(res[0])] = DirectoryStatsRecord(*(int(each) for each in res))
+            return records
+
+    def new_file_records(self, dir_id: int, file_records: List[FileRecord]) -> int:
+        with self.connection.cursor() as cursor:
+            path_ids = self._intern_dir_paths(cursor, [each.dir_path for each in file_records])
+            change_seq = self._next_change_seq(cursor)
+            rows = [
+                (
+                    path_ids[each.dir_path], each.name, each.suffix, md5_to_db(each.md5),
+                    each.size, dir_id, each.modified_time, change_seq
+                )
+                for each in file_records
+            ]
+            return self._maintain_statistics(
+                cursor, [], [(dir_id, size, md5) for _, _, _, md5, size, _, _, _ in rows],
+                lambda: cursor.executemany(
+                    """
+                    INSERT INTO file 
+                    (path_id, `name`, suffix, md5, `size`, dir_id, modified_timestamp, change_seq) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                    """,
+                    rows
+                )
             )
 
     def update_file_records(self, file_records: List[FileRecord]) -> int:
         with self.connection.cursor() as cursor:
             assert all(each.file_id is not None for each in file_records), \
                 CodingError('更新数据库文件记录时文件id不能为None')
-            return cursor.executemany(
+            # 更新前后的统计字段需要按id对应
+            id2new = {each.file_id: (each.size, md5_to_db(each.md5)) for each in file_records}
+            file_ids = list(id2new.keys())
+            old_rows, new_rows = [], []
+            for begin in range(0, len(file_ids), self.__WHERE_IN_BATCH):
+                batch = file_ids[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    SELECT id, dir_id, `size`, md5 FROM file WHERE id IN (%s);
+                    """ % ','.join(['%s'] * len(batch)),
+                    batch
+                )
+                for file_id, dir_id, size, md5 in cursor.fetchall():
+                    old_rows.append((int(dir_id), int(size), md5))
+                    new_rows.append((int(dir_id), *id2new[int(file_id)]))
+            change_seq = self._next_change_seq(cursor)
+            return self._maintain_statistics(
+                cursor, old_rows, new_rows,
+                lambda: cursor.executemany(
+                    """
+                    UPDATE `file` SET md5 = %s, `size` = %s, modified_timestamp = %s, change_seq = %s WHERE id = %s;
+                    """,
+                    [
+                        (md5_to_db(each.md5), each.size, each.modified_time, change_seq, each.file_id)
+                        for each in file_records
+                    ]
+                )
+            )
+
+    def move_file_records(self, moves: List[Tuple[FileRecord, str]]) -> int:
+        with self.connection.cursor() as cursor:
+            assert all(record.file_id is not None for record, _ in moves), \
+                CodingError('移动数据库文件记录时文件id不能为None')
+            new_paths = [FileRecord.format_path(path) for _, path in moves]
+            path_ids = self._intern_dir_paths(cursor, [dir_path for dir_path, _, _ in new_paths])
+            change_seq = self._next_change_seq(cursor)
+            # 大小和md5值都没有改变，不影响统计信息
+            moved = cursor.executemany(
                 """
-                UPDATE `file` SET md5 = %s, `size` = %s, modified_timestamp = %s WHERE id = %s;
+                UPDATE `file` SET path_id = %s, `name` = %s, suffix = %s, change_seq = %s WHERE id = %s;
                 """,
                 [
-                    (each.md5, each.size, each.modified_time, each.file_id)
-                    for each in file_records
+                    (path_ids[dir_path], name, suffix, change_seq, record.file_id)
+                    for (record, _), (dir_path, name, suffix) in zip(moves, new_paths)
                 ]
             )
+            cursor.executemany(
+                """
+                INSERT INTO file_move (dir_id, file_id, old_path, new_path) VALUES (%s, %s, %s, %s);
+                """,
+                [
+                    (record.directory_id, record.file_id, record.path, f'{dir_path}{name}{suffix}')
+                    for (record, _), (dir_path, name, suffix) in zip(moves, new_paths)
+                ]
+            )
+            return moved
 
-    def file_records(self, dir_id: int) -> List[FileRecord]:
+    def file_moves(self, dir_id: int) -> List[Tuple[int, str, str]]:
         with self.connection.cursor() as cursor:
             cursor.execute(
                 """
-                SELECT 
-                dir_path, `name`, suffix, md5, `size`, modified_timestamp, id 
-                FROM file WHERE dir_id = %s;
+                SELECT file_id, old_path, new_path FROM file_move WHERE dir_id = %s ORDER BY id;
                 """,
                 (dir_id,)
             )
-            file_records = []
-            while True:
-                res = cursor.fetchone()
-                if res is None:
-                    break
-                file_records.append(FileRecord(
-                    dir_path=res[0],
-                    name=res[1],
-                    suffix=res[2],
-                    md5=res[3],
-                    size=int(res[4]),
-                    modified_time=int(res[5]),
-                    file_id=int(res[6]),
-                    directory_id=dir_id
-                ))
-            return file_records
+            return [(int(file_id), old_path, new_path) for file_id, old_path, new_path in cursor.fetchall()]
+
+    def file_records(self, dir_id: int, dir_path: str = '/') -> List[FileRecord]:
+        with self.connection.cursor() as cursor:
+            if dir_path == '/':
+                cursor.execute(
+                    f"""
+                    SELECT {self.__FILE_COLUMNS} FROM file WHERE dir_id = %s;
+                    """,
+                    (dir_id,)
+                )
+                return self._fetch_file_records(cursor)
+            path_id = self._find_path_id(cursor, dir_path)
+            if path_id is None:
+                return []
+            cursor.execute(
+                f"""
+                {self.__SUBTREE_CTE}
+                SELECT {self.__FILE_COLUMNS} FROM file
+                JOIN subtree ON file.path_id = subtree.id
+                WHERE file.dir_id = %s;
+                """,
+                (path_id, dir_id)
+            )
+            return self._fetch_file_records(cursor)
 
     def delete_file_record_by_ids(self, file_ids: List[int]) -> int:
+        with self.connection.cursor() as cursor:
+            change_seq = self._next_change_seq(cursor)
+
+            def write():
+                deleted = cursor.executemany(
+                    """
+                    DELETE FROM file WHERE id = %s;
+                    """,
+                    [(each,) for each in file_ids]
+                )
+                cursor.executemany(
+                    """
+                    INSERT INTO file_tombstone (file_id, change_seq) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE change_seq = VALUES(change_seq);
+                    """,
+                    [(each, change_seq) for each in file_ids]
+                )
+                return deleted
+
+            return self._maintain_statistics(cursor, self._query_stats_rows(cursor, list(file_ids)), [], write)
+
+    def delete_file_records_under(self, dir_id: int, dir_path: str) -> int:
+        with self.connection.cursor() as cursor:
+            path_id = self._find_path_id(cursor, dir_path)
+            if path_id is None:
+                return 0
+            # 子树中的文件记录由目录节点的递归查询和file_path_index确定，不需要先读出文件id
+            cursor.execute(
+                f"""
+                {self.__SUBTREE_CTE}
+                SELECT file.dir_id, file.`size`, file.md5 FROM file
+                JOIN subtree ON file.path_id = subtree.id
+                WHERE file.dir_id = %s;
+                """,
+                (path_id, dir_id)
+            )
+            old_rows = [(int(each_dir_id), int(size), md5) for each_dir_id, size, md5 in cursor.fetchall()]
+            if len(old_rows) == 0:
+                return 0
+            change_seq = self._next_change_seq(cursor)
+
+            def write():
+                cursor.execute(
+                    f"""
+                    INSERT INTO file_tombstone (file_id, change_seq)
+                    {self.__SUBTREE_CTE}
+                    SELECT file.id, %s FROM file
+                    JOIN subtree ON file.path_id = subtree.id
+                    WHERE file.dir_id = %s
+                    ON DUPLICATE KEY UPDATE change_seq = %s;
+                    """,
+                    (path_id, change_seq, dir_id, change_seq)
+                )
+                return cursor.execute(
+                    f"""
+                    {self.__SUBTREE_CTE}
+                    DELETE file FROM file
+                    JOIN subtree ON file.path_id = subtree.id
+                    WHERE file.dir_id = %s;
+                    """,
+                    (path_id, dir_id)
+                )
+
+            return self._maintain_statistics(cursor, old_rows, [], write)
+
+    @staticmethod
+    def _file_indexes_and_foreign_keys(cursor) -> Tuple[set, set]:
+        """
+        :return: file表现有的索引名和外键名
+        """
+        cursor.execute(
+            """
+            SELECT DISTINCT index_name FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = 'file';
+            """
+        )
+        indexes = {each[0] for each in cursor.fetchall()}
+        cursor.execute(
+            """
+            SELECT constraint_name FROM information_schema.table_constraints
+            WHERE table_schema = DATABASE() AND table_name = 'file' AND constraint_type = 'FOREIGN KEY';
+            """
+        )
+        return indexes, {each[0] for each in cursor.fetchall()}
+
+    def prepare_bulk_load(self):
+        with self.connection.cursor() as cursor:
+            indexes, foreign_keys = self._file_indexes_and_foreign_keys(cursor)
+            # 外键依赖的索引不能先于外键删除
+            drops = [f'DROP FOREIGN KEY {each}' for each in self.__FILE_DEFERRED_FOREIGN_KEYS if each in foreign_keys]
+            if len(drops) > 0:
+                cursor.execute(f'ALTER TABLE file {", ".join(drops)};')
+            drops = [f'DROP INDEX {each}' for each in self.__FILE_DEFERRED_INDEXES if each in indexes]
+            if len(drops) > 0:
+                cursor.execute(f'ALTER TABLE file {", ".join(drops)};')
+
+    def finish_bulk_load(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SET SESSION innodb_ft_enable_stopword = OFF;')
+            indexes, foreign_keys = self._file_indexes_and_foreign_keys(cursor)
+            adds, fulltext_adds = [], []
+            for name, definition in self.__FILE_DEFERRED_INDEXES.items():
+                if name not in indexes:
+                    (fulltext_adds if definition.startswith('FULLTEXT') else adds).append(f'ADD {definition}')
+            if len(adds) > 0:
+                cursor.execute(f'ALTER TABLE file {", ".join(adds)};')
+            # InnoDB一次只能添加一个全文索引
+            for each in fulltext_adds:
+                cursor.execute(f'ALTER TABLE file {each};')
+            adds = [
+                f'ADD {definition}' for name, definition in self.__FILE_DEFERRED_FOREIGN_KEYS.items()
+                if name not in foreign_keys
+            ]
+            if len(adds) > 0:
+                cursor.execute(f'ALTER TABLE file {", ".join(adds)};')
+
+    def defer_constraint_checks(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SET SESSION foreign_key_checks = 0, unique_checks = 0;')
+
+    def file_count_in_id_range(self, first_id: int, last_id: int) -> int:
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM file WHERE id BETWEEN %s AND %s;', (first_id, last_id))
+            return int(cursor.fetchone()[0])
+
+    def purge_file_records(self, file_ids: List[int]) -> int:
         with self.connection.cursor() as cursor:
             return cursor.executemany(
                 """
@@ -607,31 +1764,98 @@ class MysqlDataBase(Database):
                 [(each,) for each in file_ids]
             )
 
+    @staticmethod
+    def _next_change_seq(cursor) -> int:
+        """
+        获取下一个修改序号，序号所在的行会被锁定到事务结束，所以修改序号的顺序与事务提交的顺序一致
+        :param cursor: 数据库游标
+        :return: 修改序号
+        """
+        cursor.execute('UPDATE change_sequence SET seq = LAST_INSERT_ID(seq + 1) WHERE id = 1;')
+        cursor.execute('SELECT LAST_INSERT_ID();')
+        return int(cursor.fetchone()[0])
+
+    def change_seq(self) -> int:
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT seq FROM change_sequence WHERE id = 1;')
+            return int(cursor.fetchone()[0])
+
+    def set_change_seq(self, seq: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('UPDATE change_sequence SET seq = %s WHERE id = 1;', (seq,))
+
+    def deleted_file_ids(self, since: int) -> List[int]:
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT file_id FROM file_tombstone WHERE change_seq > %s ORDER BY file_id;', (since,))
+            return [int(each[0]) for each in cursor.fetchall()]
+
+    def replace_directories_and_managements(
+            self, directories: List[DirectoryRecord], managements: List[ManagementRecord]
+    ):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO directory (id, `name`, des) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `name` = VALUES(`name`), des = VALUES(des);
+                """,
+                [(each.dir_id, each.name, each.desc) for each in directories]
+            )
+            cursor.execute('DELETE FROM management;')
+            cursor.executemany(
+                """
+                INSERT INTO management (tag, `path`, dir_id) VALUES (%s, %s, %s);
+                """,
+                [(each.tag, each.path, each.dir_id) for each in managements]
+            )
+            dir_ids = [each.dir_id for each in directories]
+            cursor.execute(
+                'DELETE FROM directory WHERE id NOT IN (%s);' % ','.join(['%s'] * len(dir_ids))
+                if len(dir_ids) > 0 else 'DELETE FROM directory;',
+                dir_ids
+            )
+
     def all_files(self) -> List[FileRecord]:
         with self.connection.cursor() as cursor:
             cursor.execute(
-                """
-                SELECT 
-                dir_path, `name`, suffix, md5, `size`, modified_timestamp, id, dir_id
-                FROM file;
+                f"""
+                SELECT {self.__FILE_COLUMNS} FROM file;
+                """,
+            )
+            return self._fetch_file_records(cursor)
+
+    def all_dir_paths(self) -> Dict[int, str]:
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT id, parent_id, `name` FROM path;')
+            nodes = {int(path_id): (int(parent_id), name) for path_id, parent_id, name in cursor.fetchall()}
+        return self._build_dir_paths(nodes, nodes.keys())
+
+    def intern_dir_paths(self, dir_paths: List[str]) -> Dict[str, int]:
+        with self.connection.cursor() as cursor:
+            return self._intern_dir_paths(cursor, dir_paths)
+
+    def iterate_file_rows(self, resolve_dir_path: bool = True, since: int = None) -> Iterator[tuple]:
+        # 目录节点的数量远小于文件记录，一次性读入后在内存中拼接目录路径
+        dir_paths = self.all_dir_paths() if resolve_dir_path else None
+        with self.connection.cursor(SSCursor) as cursor:
+            cursor.execute(
+                f"""
+                SELECT id, path_id, `name`, suffix, md5, `size`, dir_id, modified_timestamp FROM file
+                {'' if since is None else 'WHERE change_seq > %s'} ORDER BY id;
                 """,
+                None if since is None else (since,)
             )
-            file_records = []
             while True:
-                res = cursor.fetchone()
-                if res is None:
+                rows = cursor.fetchmany(self.__STREAM_BATCH)
+                if len(rows) == 0:
                     break
-                file_records.append(FileRecord(
-                    dir_path=res[0],
-                    name=res[1],
-                    suffix=res[2],
-                    md5=res[3],
-                    size=int(res[4]),
-                    modified_time=int(res[5]),
-                    file_id=int(res[6]),
-                    directory_id=int(res[7])
-                ))
-            return file_records
+                if not resolve_dir_path:
+                    yield from rows
+                    continue
+                for file_id, path_id, name, suffix, md5, size, dir_id, modified_timestamp in rows:
+                    yield (
+                        int(file_id), dir_paths[int(path_id)], name, suffix, md5_from_db(md5),
+                        int(size), int(dir_id), int(modified_timestamp)
+                    )
 
     def all_managements(self) -> List[ManagementRecord]:
         with self.connection.cursor() as cursor:
@@ -652,71 +1876,140 @@ class MysqlDataBase(Database):
                 ))
             return records
 
-    def query_common_size_wo_md5_files(self) -> Dict[int, List[int]]:
+    def duplicate_content_count(self, hashed: bool) -> int:
         with self.connection.cursor() as cursor:
             cursor.execute(
-                """
-                WITH t AS (
-                    SELECT id, `size` FROM file WHERE md5='********************************'
+                f"""
+                SELECT COUNT(*) FROM content WHERE duplicated = 1 AND md5 {'!=' if hashed else '='} %s;
+                """,
+                (UNHASHED_CONTENT_MD5,)
+            )
+            return int(cursor.fetchone()[0])
+
+    def duplicate_contents(
+            self, hashed: bool, limit: int, after: Tuple[int, str] = None
+    ) -> List[Tuple[int, str, int]]:
+        with self.connection.cursor() as cursor:
+            conditions = ['duplicated = 1', f'md5 {"!=" if hashed else "="} %s']
+            params = [UNHASHED_CONTENT_MD5]
+            if after is not None:
+                size, md5 = after
+                md5 = md5_to_db(md5) or UNHASHED_CONTENT_MD5
+                conditions.append('(`size` < %s OR (`size` = %s AND md5 < %s))')
+                params.extend([size, size, md5])
+            cursor.execute(
+                f"""
+                SELECT `size`, md5, refcount FROM content
+                WHERE {' AND '.join(conditions)}
+                ORDER BY duplicated DESC, `size` DESC, md5 DESC LIMIT %s;
+                """,
+                params + [limit]
+            )
+            return [
+                (int(size), content_md5_from_db(md5), int(refcount))
+                for size, md5, refcount in cursor.fetchall()
+            ]
+
+    def query_file_ids_by_contents(self, contents: List[Tuple[int, str]]) -> Dict[Tuple[int, str], List[int]]:
+        with self.connection.cursor() as cursor:
+            res = {}
+            hashed = [(size, md5_to_db(md5)) for size, md5 in contents if md5 != FileRecord.EMPTY_MD5]
+            unhashed = [size for size, md5 in contents if md5 == FileRecord.EMPTY_MD5]
+            for begin in range(0, len(hashed), self.__WHERE_IN_BATCH):
+                batch = hashed[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    SELECT `size`, md5, id FROM file WHERE (`size`, md5) IN (%s);
+                    """ % ','.join(['(%s, %s)'] * len(batch)),
+                    [item for each in batch for item in each]
+                )
+                for size, md5, file_id in cursor.fetchall():
+                    res.setdefault((int(size), md5_from_db(md5)), []).append(int(file_id))
+            for begin in range(0, len(unhashed), self.__WHERE_IN_BATCH):
+                batch = unhashed[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    """
+                    SELECT `size`, id FROM file WHERE md5 IS NULL AND `size` IN (%s);
+                    """ % ','.join(['%s'] * len(batch)),
+                    batch
+                )
+                for size, file_id in cursor.fetchall():
+                    res.setdefault((int(size), FileRecord.EMPTY_MD5), []).append(int(file_id))
+            return res
+
+    def file_records_by_contents(
+            self, contents: List[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], List[FileRecord]]:
+        assert all(md5 != FileRecord.EMPTY_MD5 for _, md5 in contents), \
+            CodingError('按内容查询文件记录时md5值不能为空')
+        with self.connection.cursor() as cursor:
+            res = {}
+            contents = list({(size, md5_to_db(md5)) for size, md5 in contents})
+            for begin in range(0, len(contents), self.__WHERE_IN_BATCH):
+                batch = contents[begin: begin + self.__WHERE_IN_BATCH]
+                cursor.execute(
+                    f"""
+                    SELECT {self.__FILE_COLUMNS} FROM file WHERE (`size`, md5) IN (%s);
+                    """ % ','.join(['(%s, %s)'] * len(batch)),
+                    [item for each in batch for item in each]
                 )
-                SELECT id, `size` FROM t  WHERE `size` IN (
-                    SELECT `size` FROM t GROUP BY `size` HAVING COUNT(*) > 1
-                ) ORDER BY `size`;
+                for record in self._fetch_file_records(cursor):
+                    res.setdefault((record.size, record.md5), []).append(record)
+            return res
+
+    def iterate_file_records_by_path(self, dir_id: int) -> Iterator[FileRecord]:
+        with self.connection.cursor(SSCursor) as cursor:
+            # 调用方在两次读取之间会扫描本地文件，防止服务端在等待客户端读取时超时断开
+            cursor.execute('SET SESSION net_write_timeout = %s;', (self.__STREAM_WRITE_TIMEOUT,))
+            cursor.execute('SET SESSION max_sort_length = %s;', (self.__MAX_SORT_LENGTH,))
+            # 在数据库中拼接目录节点的完整路径，按完整的文件路径排序，排序的数据过多时由数据库写入磁盘
+            cursor.execute(
+                f"""
+                {self.__FULL_PATH_CTE}
+                SELECT full_path.dir_path, file.`name`, file.suffix, file.md5, file.`size`,
+                file.modified_timestamp, file.id, file.dir_id FROM file
+                JOIN full_path ON file.path_id = full_path.id
+                WHERE file.dir_id = %s
+                ORDER BY CAST(CONCAT(full_path.dir_path, file.`name`, file.suffix) AS BINARY);
                 """,
+                (ROOT_PATH_ID, dir_id)
             )
-            size2records = {}
-            current_size = None
-            current_ids = []
             while True:
-                res = cursor.fetchone()
-                if res is None:
+                rows = cursor.fetchmany(self.__STREAM_BATCH)
+                if len(rows) == 0:
                     break
-                if current_size != int(res[1]):
-                    if len(current_ids) > 0:
-                        size2records[current_size] = current_ids
-                        current_ids = []
-                current_size = int(res[1])
-                current_ids.append(int(res[0]))
+                yield from FileRecord.from_db_rows(rows)
 
-            if len(current_ids) > 0:
-                size2records[current_size] = current_ids
-            return size2records
+    def hashed_file_records_after(self, dir_id: int, after: Union[str, None], limit: int) -> List[FileRecord]:
+        with self.connection.cursor() as cursor:
+            cursor.execute('SET SESSION max_sort_length = %s;', (self.__MAX_SORT_LENGTH,))
+            # 只需要排序后的前limit条，数据库不需要保存整个排序结果
+            cursor.execute(
+                f"""
+                {self.__FULL_PATH_CTE}
+                SELECT full_path.dir_path, file.`name`, file.suffix, file.md5, file.`size`,
+                file.modified_timestamp, file.id, file.dir_id FROM file
+                JOIN full_path ON file.path_id = full_path.id
+                WHERE file.dir_id = %s AND file.md5 IS NOT NULL
+                AND CAST(CONCAT(full_path.dir_path, file.`name`, file.suffix) AS BINARY) > CAST(%s AS BINARY)
+                ORDER BY CAST(CONCAT(full_path.dir_path, file.`name`, file.suffix) AS BINARY)
+                LIMIT %s;
+                """,
+                (ROOT_PATH_ID, dir_id, after or '', limit)
+            )
+            return FileRecord.from_db_rows(cursor.fetchall())
 
-    def query_common_md5_files(self) -> Dict[int, Dict[str, List[int]]]:
+    def unhashed_file_records(self, dir_id: int, limit: int, after: int = 0) -> List[FileRecord]:
         with self.connection.cursor() as cursor:
+            # file_md5_index中md5为NULL的部分按id有序
             cursor.execute(
-                """
-                WITH t AS (
-                    SELECT id, `size`, md5 FROM file WHERE md5!='********************************'
-                )
-                SELECT id, `size`, md5 FROM t WHERE (`size`, md5) IN (
-                    SELECT `size`, md5 FROM t GROUP BY `size`, md5 HAVING COUNT(*) > 1
-                ) ORDER BY `size`, md5;
+                f"""
+                SELECT {self.__FILE_COLUMNS} FROM file
+                WHERE md5 IS NULL AND dir_id = %s AND id > %s ORDER BY id LIMIT %s;
                 """,
+                (dir_id, after, limit)
             )
-            size_md5_to_records = {}
-            current_size_md5 = (None, None)
-            current_ids = []
-            while True:
-                res = cursor.fetchone()
-                if res is None:
-                    break
-                size, md5 = current_size_md5
-                if size != int(res[1]) or md5 != res[2]:
-                    if len(current_ids) > 0:
-                        if size not in size_md5_to_records.keys():
-                            size_md5_to_records[size] = {}
-                        size_md5_to_records[size][md5] = current_ids
-                        current_ids = []
-                current_size_md5 = (int(res[1]), res[2])
-                current_ids.append(int(res[0]))
-
-            if len(current_ids) > 0:
-                size, md5 = current_size_md5
-                if size not in size_md5_to_records.keys():
-                    size_md5_to_records[size] = {}
-                size_md5_to_records[size][md5] = current_ids
-            return size_md5_to_records
+            return self._fetch_file_records(cursor)
 
     def create_directories_with_id(self, records: List[DirectoryRecord]) -> int:
         with self.connection.cursor() as cursor:
@@ -744,18 +2037,29 @@ class MysqlDataBase(Database):
                 ]
             )
 
-    def create_files_with_id(self, records: List[FileRecord]) -> int:
+    def create_files_with_id(self, records: List[FileRecord], replace: bool = False) -> int:
+        path_ids = self.intern_dir_paths([each.dir_path for each in records])
+        return self.create_file_rows_with_id(
+            [
+                (
+                    each.file_id, path_ids[each.dir_path], each.name, each.suffix, md5_to_db(each.md5),
+                    each.size, each.directory_id, each.modified_time
+                )
+                for each in records
+            ],
+            replace
+        )
+
+    def create_file_rows_with_id(self, rows: List[tuple], replace: bool = False) -> int:
         with self.connection.cursor() as cursor:
             return cursor.executemany(
-                """
+                f"""
                 INSERT INTO `file` 
-                (dir_path, `name`, suffix, md5, `size`, dir_id, modified_timestamp) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
+                (id, path_id, `name`, suffix, md5, `size`, dir_id, modified_timestamp) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                {self.__FILE_UPSERT if replace else ''};
                 """,
-                [
-                    (each.dir_path, each.name, each.suffix, each.md5, each.size, each.directory_id, each.modified_time)
-                    for each in records
-                ]
+                rows
             )
 
     def query_file_by_id(self, file_ids: List[int]) -> Dict[int, FileRecord]:
@@ -766,28 +2070,13 @@ class MysqlDataBase(Database):
                 end = min(len(file_ids), begin + self.__WHERE_IN_BATCH)
                 batch = file_ids[begin: end]
                 cursor.execute(
-                    """
-                    SELECT 
-                    dir_path, `name`, suffix, md5, `size`, modified_timestamp, id, dir_id
-                    FROM file
+                    f"""
+                    SELECT {self.__FILE_COLUMNS} FROM file
                     WHERE id IN (%s);
                     """ % ','.join(['%s'] * len(batch)),
                     batch
                 )
-                while True:
-                    res = cursor.fetchone()
-                    if res is None:
-                        break
-                    record = FileRecord(
-                        dir_path=res[0],
-                        name=res[1],
-                        suffix=res[2],
-                        md5=res[3],
-                        size=int(res[4]),
-                        modified_time=int(res[5]),
-                        file_id=int(res[6]),
-                        directory_id=int(res[7])
-                    )
+                for record in self._fetch_file_records(cursor):
                     file_records[record.file_id] = record
                 begin = end
             return file_records
@@ -820,47 +2109,132 @@ class MysqlDataBase(Database):
                 begin = end
             return records
 
-    def query_director_size(self, dir_id: int) -> int:
+    def query_director_size(self, dir_id: int, dir_path: str = '/') -> int:
         """
         查询目录的大小
         :param dir_id: 目录id
+        :param dir_path: 只统计该目录路径下的文件记录
         :return: 大小（字节）
         """
+        if dir_path == '/':
+            return self.directory_statistics([dir_id])[dir_id].total_size
         with self.connection.cursor() as cursor:
+            path_id = self._find_path_id(cursor, dir_path)
+            if path_id is None:
+                return 0
             cursor.execute(
-                """
-                SELECT SUM(`size`) FROM file WHERE dir_id = %s;
+                f"""
+                {self.__SUBTREE_CTE}
+                SELECT COALESCE(SUM(file.`size`), 0) FROM file
+                JOIN subtree ON file.path_id = subtree.id
+                WHERE file.dir_id = %s;
                 """,
-                (dir_id,)
+                (path_id, dir_id)
             )
             return int(cursor.fetchone()[0])
 
-    def find_in_file_path(self, column: str, keyword: str) -> List[FileRecord]:
-        with self.connection.cursor() as cursor:
+    def _fulltext_term(self, cursor, keyword: str) -> Union[str, None]:
+        """
+        从关键字中选出用于全文索引查找的词：关键字中最长的连续单词字符串，全文索引只用于缩小候选范围，
+        结果仍需要用LIKE精确过滤
+        :param cursor: 数据库游标
+        :param keyword: 关键字
+        :return: 全文索引查找的词，None表示关键字太短，无法使用全文索引
+        """
+        if self._ngram_token_size is None:
+            cursor.execute('SELECT @@ngram_token_size;')
+            self._ngram_token_size = int(cursor.fetchone()[0])
+        words = re.findall(r'\w+', keyword)
+        if len(words) == 0:
+            return None
+        term = max(words, key=len)
+        return term if len(term) >= self._ngram_token_size else None
+
+    def _substring_condition(self, cursor, column: str, keyword: str, params: list) -> str:
+        """
+        生成字段包含关键字的查询条件，能使用全文索引时先用全文索引查找候选记录
+        :param cursor: 数据库游标
+        :param column: 字段名，需要有ngram全文索引
+        :param keyword: 关键字
+        :param params: 查询参数列表，本函数会向其中添加条件所需的参数
+        :return: 查询条件
+        """
+        term = self._fulltext_term(cursor, keyword)
+        if term is not None:
+            params.extend([f'"{term}"', f'%{escape_like(keyword)}%'])
+            return f'MATCH({column}) AGAINST(%s IN BOOLEAN MODE) AND {column} LIKE %s'
+        params.append(f'%{escape_like(keyword)}%')
+        return f'{column} LIKE %s'
+
+    def _find_dir_path_ids(self, cursor, keyword: str) -> List[int]:
+        """
+        查找目录路径包含关键字的所有目录节点
+        :param cursor: 数据库游标
+        :param keyword: 关键字，可以包含/
+        :return: 节点id列表
+        """
+        # 关键字被/分割后的每一段都必定包含于同一个目录名中，选出最长的一段用于查找目录节点，
+        # 包含该段的目录节点的所有子孙节点就是候选节点
+        piece = max(keyword.split('/'), key=len)
+        if self._fulltext_term(cursor, piece) is None:
+            # 关键字太短无法使用全文索引，只能在数据库中拼接出所有的目录路径再查找，只有匹配的节点id被返回，
+            # 按二进制比较，与目录名的区分大小写的排序规则一致
             cursor.execute(
-                """
-                SELECT 
-                dir_path, `name`, suffix, md5, `size`, modified_timestamp, id, dir_id
-                FROM file WHERE %s LIKE %s;
-                """ % (column, '%s'),
-                (f'%{keyword}%',)
+                f"""
+                {self.__FULL_PATH_CTE}
+                SELECT id FROM full_path
+                WHERE INSTR(CAST(dir_path AS BINARY), CAST(%s AS BINARY)) > 0;
+                """,
+                (ROOT_PATH_ID, keyword)
             )
-            file_records = []
-            while True:
-                res = cursor.fetchone()
-                if res is None:
-                    break
-                file_records.append(FileRecord(
-                    dir_path=res[0],
-                    name=res[1],
-                    suffix=res[2],
-                    md5=res[3],
-                    size=int(res[4]),
-                    modified_time=int(res[5]),
-                    file_id=int(res[6]),
-                    directory_id=int(res[7])
-                ))
-            return file_records
+            return [int(each[0]) for each in cursor.fetchall()]
+        else:
+            params = []
+            condition = self._substring_condition(cursor, 'path.`name`', piece, params)
+            cursor.execute(
+                f"""
+                WITH RECURSIVE subtree (id) AS (
+                    SELECT path.id FROM path WHERE {condition}
+                    UNION
+                    SELECT path.id FROM path JOIN subtree ON path.parent_id = subtree.id
+                )
+                SELECT id FROM subtree;
+                """,
+                params
+            )
+            dir_paths = self._resolve_path_ids(cursor, [int(each[0]) for each in cursor.fetchall()])
+        return [path_id for path_id, dir_path in dir_paths.items() if keyword in dir_path]
+
+    def find_files(self, name: str = None, suffix: str = None, dir_path: str = None) -> List[FileRecord]:
+        with self.connection.cursor() as cursor:
+            conditions, params = [], []
+            for column, keyword in (('file.`name`', name), ('file.suffix', suffix)):
+                if keyword is not None and len(keyword) > 0:
+                    conditions.append(self._substring_condition(cursor, column, keyword, params))
+            if dir_path is None or len(dir_path) == 0:
+                cursor.execute(
+                    f"""
+                    SELECT {self.__FILE_COLUMNS} FROM file
+                    WHERE {" AND ".join(conditions) or "TRUE"};
+                    """,
+                    params
+                )
+                return self._fetch_file_records(cursor)
+            # 匹配的目录节点可能非常多（例如关键字为/），分批查询
+            path_ids = self._find_dir_path_ids(cursor, dir_path)
+            res = []
+            for begin in range(0, len(path_ids), self.__WHERE_IN_BATCH):
+                batch = path_ids[begin: begin + self.__WHERE_IN_BATCH]
+                path_condition = f'file.path_id IN ({",".join(["%s"] * len(batch))})'
+                cursor.execute(
+                    f"""
+                    SELECT {self.__FILE_COLUMNS} FROM file
+                    WHERE {" AND ".join(conditions + [path_condition])};
+                    """,
+                    params + batch
+                )
+                res.extend(self._fetch_file_records(cursor))
+            return res
 
     def query_file_ids_by_size_and_md5(self, size: int, md5: str) -> List[int]:
         with self.connection.cursor() as cursor:
@@ -868,7 +2242,7 @@ class MysqlDataBase(Database):
                 """
                 SELECT id FROM file WHERE `size` = %s and md5 = %s;
                 """,
-                (size, md5,)
+                (size, md5_to_db(md5),)
             )
             file_ids = []
             while True:
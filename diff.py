@@ -0,0 +1,173 @@
+"""
+本地文件与数据库文件记录的流式比较：两边都按路径排序后归并，内存占用与文件数量无关。
+本地扫描逐个目录地排序，单个目录中的文件过多时分段排序后写入临时文件，再归并读出（外部排序）
+"""
+import os
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+from typing import Iterator, Iterable, Tuple, Callable, Union
+
+from error import RunTimeError
+from record import FileRecord
+
+# 外部排序时每段在内存中排序的最大条目数，不超过时不会写入临时文件
+SORT_CHUNK = 200000
+
+
+def external_sort(items: Iterable, key: Callable = None, chunk_size: int = SORT_CHUNK) -> Iterator:
+    """
+    对条目排序，条目数不超过chunk_size时直接在内存中排序，否则每chunk_size个排序后序列化到临时文件，再多路归并
+    :param items: 需要排序的条目，需要可以被pickle序列化
+    :param key: 排序的键函数
+    :param chunk_size: 每段的最大条目数
+    :return: 排好序的条目的迭代器
+    """
+    items = iter(items)
+    chunk = list(islice(items, chunk_size))
+    chunk.sort(key=key)
+    if len(chunk) < chunk_size:
+        yield from chunk
+        return
+    runs = []
+    try:
+        while len(chunk) > 0:
+            run = tempfile.TemporaryFile()
+            for item in chunk:
+                pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+            run.seek(0)
+            runs.append(run)
+            chunk = list(islice(items, chunk_size))
+            chunk.sort(key=key)
+        yield from heapq.merge(*(_read_run(run) for run in runs), key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _read_run(run) -> Iterator:
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+class SpillList:
+    """
+    只能追加的序列，条目序列化后写入临时文件而不是保存在内存中，可以按追加的顺序多次遍历
+    """
+
+    def __init__(self):
+        self._file = None
+        self._count = 0
+
+    def append(self, item):
+        """
+        :param item: 条目，需要可以被pickle序列化
+        :return: None
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        pickle.dump(item, self._file, pickle.HIGHEST_PROTOCOL)
+        self._count += 1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator:
+        if self._file is None:
+            return
+        self._file.seek(0)
+        try:
+            for _ in range(self._count):
+                yield pickle.load(self._file)
+        finally:
+            # 遍历后（包括中途停止时）可以继续追加
+            self._file.seek(0, os.SEEK_END)
+
+    def batches(self, size: int) -> Iterator[list]:
+        """
+        :param size: 每批的最大条目数
+        :return: 按追加的顺序分批生成条目列表
+        """
+        it = iter(self)
+        while True:
+            batch = list(islice(it, size))
+            if len(batch) == 0:
+                return
+            yield batch
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._count = 0
+
+
+def scan_sorted(dir_path: str, chunk_size: int = SORT_CHUNK) -> Iterator[Tuple[str, int, int, int]]:
+    """
+    按相对路径的顺序扫描目录下的所有文件，与FileRecord.get_dir_file_records一样跳过根目录下的.lyl232fm和复制的临时文件。
+    每个目录中的条目按名字排序，子目录以名字加/排序，这样生成的相对路径整体有序，同时只需要保存正在扫描的各级目录的条目
+    :param dir_path: 目录的物理路径
+    :param chunk_size: 单个目录中的条目超过该数量时使用外部排序
+    :return: 生成器，每次生成(相对路径, 大小, 修改时间, inode)
+    """
+    dir_path = os.path.abspath(dir_path)
+
+    def walk(abs_path: str, rel_path: str) -> Iterator[Tuple[str, int, int, int]]:
+        entries = []
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if rel_path == '/' and entry.name == '.lyl232fm':
+                        continue
+                    entries.append((f'{entry.name}/', True))
+                elif not entry.name.endswith(FileRecord.TEMP_SUFFIX):
+                    entries.append((entry.name, False))
+        for name, is_dir in external_sort(entries, chunk_size=chunk_size):
+            if is_dir:
+                yield from walk(os.path.join(abs_path, name[:-1]), f'{rel_path}{name}')
+                continue
+            stat = os.stat(os.path.join(abs_path, name))
+            yield f'{rel_path}{name}', stat.st_size, FileRecord.modified_timestamp(stat.st_mtime), stat.st_ino
+
+    if os.path.isdir(dir_path):
+        yield from walk(dir_path, '/')
+
+
+def merge_diff(
+        local: Iterator[Tuple[str, int, int, int]], db: Iterator[FileRecord]
+) -> Iterator[Tuple[Union[Tuple[str, int, int, int], None], Union[FileRecord, None]]]:
+    """
+    归并两个按路径排序的序列
+    :param local: scan_sorted的结果
+    :param db: 按路径排序的数据库文件记录
+    :return: 生成器，每次生成(本地条目, 数据库文件记录)，路径相同时两者都不为None，只存在于一边时另一边为None
+    """
+    local, db = _strictly_increasing(local, lambda item: item[0], '本地扫描'), \
+        _strictly_increasing(db, lambda record: record.path, '数据库文件记录')
+    local_item, db_item = next(local, None), next(db, None)
+    while local_item is not None or db_item is not None:
+        if db_item is None or (local_item is not None and local_item[0] < db_item.path):
+            yield local_item, None
+            local_item = next(local, None)
+        elif local_item is None or db_item.path < local_item[0]:
+            yield None, db_item
+            db_item = next(db, None)
+        else:
+            yield local_item, db_item
+            local_item, db_item = next(local, None), next(db, None)
+
+
+def _strictly_increasing(items: Iterator, key: Callable, name: str) -> Iterator:
+    """
+    检查序列按路径严格递增，顺序错误的序列会使归并得到错误的结果（例如把相同的文件当作两边各自独有的文件）
+    """
+    last = None
+    for item in items:
+        path = key(item)
+        assert last is None or last < path, RunTimeError(f'{name}没有按路径排序：{last}之后是{path}')
+        last = path
+        yield item
@@ -0,0 +1,399 @@
+"""
+数据库导出数据的读写：每张表导出为一个（可选压缩的）文件，导出目录下的header.json记录了导出时的数据库结构版本、
+压缩方式以及每张表的行数和校验和，恢复时据此检查导出的数据是否完整
+"""
+import io
+import os
+import csv
+import json
+import gzip
+import lzma
+import sys
+import struct
+import hashlib
+from array import array
+from os.path import join, exists
+from typing import Iterator, List, Dict, Union, Tuple
+
+from error import OperationError, RunTimeError, CodingError
+
+HEADER_FILE = 'header.json'
+# 压缩方式 -> 文件后缀
+COMPRESSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'lzma': '.xz',
+    'zstd': '.zst',
+}
+DEFAULT_COMPRESSION = 'gzip'
+# 1MB的写入缓存
+WRITE_BUFFER = 1024 * 1024
+# 二进制列式导出文件的开头
+BINARY_MAGIC = b'LFMCOL1\n'
+# 二进制列式导出文件中块的头部：块类型，行数，块的字节数
+BLOCK_HEADER = struct.Struct('<4sIQ')
+
+
+def open_compressed(path: str, mode: str, compression: str):
+    """
+    以二进制模式打开一个（可能）被压缩的文件
+    :param path: 文件路径
+    :param mode: 'rb'或者'wb'
+    :param compression: 压缩方式，COMPRESSIONS中的键
+    :return: 文件对象
+    """
+    assert compression in COMPRESSIONS, OperationError(
+        f'不支持的压缩方式：{compression}，可选的压缩方式有：{list(COMPRESSIONS.keys())}')
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == 'lzma':
+        return lzma.open(path, mode)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise OperationError('使用zstd压缩需要安装zstandard：pip install zstandard')
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def load_header(dump_dir: str) -> Union[dict, None]:
+    """
+    读取导出目录的header.json
+    :param dump_dir: 导出目录
+    :return: header的内容，None表示该目录是没有header的旧版导出数据
+    """
+    header_path = join(dump_dir, HEADER_FILE)
+    if not exists(header_path):
+        return None
+    with open(header_path, 'r', encoding='utf8') as file:
+        return json.load(file)
+
+
+class _ChecksumWriter:
+    """
+    写入一张表的导出文件，同时统计行数和未压缩数据的sha256校验和
+    """
+    FORMAT = None
+
+    def __init__(self, dump_dir: str, table: str, filename: str, compression: str):
+        self.table = table
+        self.compression = compression
+        self.filename = filename
+        self.rows = 0
+        self._file = open_compressed(join(dump_dir, self.filename), 'wb', compression)
+        self._sha256 = hashlib.sha256()
+        self._buffer, self._buffered = [], 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self, data: bytes):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BUFFER:
+            self._flush()
+
+    def _flush(self):
+        data = b''.join(self._buffer)
+        self._sha256.update(data)
+        self._file.write(data)
+        self._buffer, self._buffered = [], 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self._flush()
+        self._file.close()
+        self._file = None
+
+    def header(self) -> dict:
+        """
+        :return: 该表在header.json中的描述
+        """
+        return {
+            'file': self.filename,
+            'format': self.FORMAT,
+            'rows': self.rows,
+            'sha256': self._sha256.hexdigest(),
+        }
+
+
+class TableWriter(_ChecksumWriter):
+    """
+    逐行写入一张表的文本导出文件，每行的列以反斜杠分隔。包含反斜杠、双引号或者换行符的列以双引号包围，
+    其中的双引号写为两个双引号（csv模块的规则），所以文件名、目录路径和描述中可以出现任意字符
+    """
+    FORMAT = 'csv'
+    # 旧版的导出数据没有引号规则，列中的反斜杠和换行符会破坏行的结构
+    QUOTING = 'csv_minimal'
+
+    def __init__(self, dump_dir: str, table: str, columns: List[str], compression: str = DEFAULT_COMPRESSION):
+        """
+        :param dump_dir: 导出目录
+        :param table: 表名
+        :param columns: 列名
+        :param compression: 压缩方式
+        """
+        super().__init__(dump_dir, table, f'{table}.csv{COMPRESSIONS[compression]}', compression)
+        self.columns = columns
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line, **_CSV_DIALECT)
+        self._write_line(columns)
+
+    def _write_line(self, items):
+        self._csv.writerow([str(item) for item in items])
+        self._write(self._line.getvalue().encode('utf8'))
+        self._line.seek(0)
+        self._line.truncate()
+
+    def write_row(self, row: tuple):
+        assert len(row) == len(self.columns)
+        self._write_line(row)
+        self.rows += 1
+
+    def header(self) -> dict:
+        return {**super().header(), 'columns': self.columns, 'quoting': self.QUOTING}
+
+
+# 文本导出文件的格式：以反斜杠分隔（逗号常常出现在文件名中），必要时以双引号包围
+_CSV_DIALECT = {
+    'delimiter': '\\', 'quotechar': '"', 'doublequote': True, 'quoting': csv.QUOTE_MINIMAL, 'lineterminator': '\n'
+}
+
+
+def _pack_array(typecode: str, values) -> bytes:
+    """
+    :return: 以小端序打包的数组
+    """
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack_array(typecode: str, view: memoryview, offset: int, n: int) -> Tuple[array, int]:
+    """
+    :return: 从小端序数据中解出的数组，解出后的偏移量
+    """
+    values = array(typecode)
+    end = offset + n * values.itemsize
+    values.frombytes(view[offset: end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+def _pack_strings(strings: List[str]) -> List[bytes]:
+    """
+    :return: 字符串的长度数组和拼接后的utf8字节
+    """
+    encoded = [each.encode('utf8') for each in strings]
+    return [_pack_array('I', [len(each) for each in encoded]), b''.join(encoded)]
+
+
+def _unpack_strings(view: memoryview, offset: int, n: int) -> Tuple[List[str], int]:
+    """
+    :return: 解出的字符串列表，解出后的偏移量
+    """
+    lengths, offset = _unpack_array('I', view, offset, n)
+    blob = bytes(view[offset: offset + sum(lengths)])
+    strings, begin = [], 0
+    for length in lengths:
+        strings.append(str(blob[begin: begin + length], 'utf8'))
+        begin += length
+    return strings, offset + begin
+
+
+class FileColumnWriter(_ChecksumWriter):
+    """
+    以二进制列式格式写入文件记录：文件开头是目录字典块，之后每CHUNK_ROWS行为一个行块，
+    行块中每一列连续存放，整数列为小端序的定长数组，字符串列为长度数组加拼接的utf8字节，目录列为目录字典中的id
+    """
+    FORMAT = 'binary'
+    CHUNK_ROWS = 65536
+
+    def __init__(self, dump_dir: str, dir_paths: Dict[int, str], compression: str = DEFAULT_COMPRESSION):
+        """
+        :param dump_dir: 导出目录
+        :param dir_paths: 目录字典，[目录节点id] -> 目录路径
+        :param compression: 压缩方式
+        """
+        super().__init__(dump_dir, 'file', f'file.bin{COMPRESSIONS[compression]}', compression)
+        self._write(BINARY_MAGIC)
+        ids = list(dir_paths.keys())
+        self._write_block(b'DICT', len(ids), [_pack_array('q', ids), *_pack_strings([dir_paths[i] for i in ids])])
+        self._chunk = []
+
+    def _write_block(self, kind: bytes, n: int, parts: List[bytes]):
+        self._write(BLOCK_HEADER.pack(kind, n, sum(len(each) for each in parts)))
+        for each in parts:
+            self._write(each)
+
+    def write_row(self, row: tuple):
+        """
+        :param row: (id, 目录节点id, name, suffix, md5, size, dir_id, modified_timestamp)，md5为16字节值或者None
+        """
+        self._chunk.append(row)
+        self.rows += 1
+        if len(self._chunk) >= self.CHUNK_ROWS:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if len(self._chunk) == 0:
+            return
+        file_ids, path_ids, names, suffixes, md5s, sizes, dir_ids, timestamps = zip(*self._chunk)
+        self._write_block(b'ROWS', len(self._chunk), [
+            _pack_array('q', file_ids),
+            _pack_array('q', path_ids),
+            *_pack_strings(names),
+            *_pack_strings(suffixes),
+            bytes(0 if each is None else 1 for each in md5s),
+            b''.join(bytes(each) for each in md5s if each is not None),
+            _pack_array('q', sizes),
+            _pack_array('q', dir_ids),
+            _pack_array('q', timestamps),
+        ])
+        self._chunk = []
+
+    def close(self):
+        if self._file is not None:
+            self._write_chunk()
+        super().close()
+
+
+def write_header(dump_dir: str, schema_version: int, compression: str, tables: Dict[str, dict], **extra):
+    """
+    写入导出目录的header.json，应该在所有表都写入完毕后调用
+    :param dump_dir: 导出目录
+    :param schema_version: 导出时数据库结构的版本
+    :param compression: 压缩方式
+    :param tables: [表名] -> TableWriter.header()
+    :param extra: 其他需要记录的信息
+    :return: None
+    """
+    with open(join(dump_dir, HEADER_FILE), 'w', encoding='utf8') as file:
+        json.dump({
+            'schema_version': schema_version,
+            'compression': compression,
+            'tables': tables,
+            **extra
+        }, file, ensure_ascii=False, indent=2)
+
+
+def read_table(dump_dir: str, table: str) -> Iterator[List[str]]:
+    """
+    逐行读取一张表的导出数据（不包括表头），读取完毕后检查行数和校验和，不一致时抛出异常
+    :param dump_dir: 导出目录
+    :param table: 表名
+    :return: 生成器，每次生成一行的字符串列表
+    """
+    header = load_header(dump_dir)
+    if header is None:
+        # 没有header的旧版导出数据：未压缩，无法校验
+        path, compression, expected = join(dump_dir, f'{table}.csv'), 'none', None
+    else:
+        expected = header['tables'][table]
+        path, compression = join(dump_dir, expected['file']), header['compression']
+    sha256 = hashlib.sha256()
+    rows, ignore_header = 0, True
+
+    def lines(file) -> Iterator[str]:
+        for line in file:
+            sha256.update(line)
+            yield line.decode('utf8')
+
+    with open_compressed(path, 'rb', compression) as file:
+        if expected is not None and expected.get('quoting') == TableWriter.QUOTING:
+            # 被引号包围的列中可能有换行符，一行数据可以跨越多个物理行
+            records = csv.reader(lines(file), **_CSV_DIALECT)
+        else:
+            records = (line.rstrip('\r\n').split('\\') for line in lines(file))
+        for record in records:
+            if ignore_header:
+                ignore_header = False
+                continue
+            if len(record) == 0 or record == ['']:
+                continue
+            rows += 1
+            yield record
+    if expected is not None:
+        assert rows == expected['rows'], RunTimeError(
+            f'导出数据{path}不完整：header中记录了{expected["rows"]}行，但是只读取到{rows}行')
+        assert sha256.hexdigest() == expected['sha256'], RunTimeError(f'导出数据{path}的校验和与header中的记录不一致')
+
+
+def _read_exactly(file, size: int, path: str) -> bytes:
+    data = file.read(size)
+    assert len(data) == size, RunTimeError(f'导出数据{path}不完整：文件提前结束')
+    return data
+
+
+def read_file_blocks(dump_dir: str) -> Iterator[Tuple[str, Union[Dict[int, str], List[tuple]]]]:
+    """
+    逐块读取二进制列式格式的文件记录，读取完毕后检查行数和校验和，不一致时抛出异常
+    :param dump_dir: 导出目录
+    :return: 生成器，每次生成('dict', [目录节点id] -> 目录路径)或者
+        ('rows', (id, 目录节点id, name, suffix, md5, size, dir_id, modified_timestamp)列表)，md5为16字节值或者None
+    """
+    header = load_header(dump_dir)
+    expected = header['tables']['file']
+    assert expected.get('format') == FileColumnWriter.FORMAT, CodingError('文件记录不是二进制列式格式')
+    path = join(dump_dir, expected['file'])
+    sha256 = hashlib.sha256()
+    rows = 0
+    with open_compressed(path, 'rb', header['compression']) as file:
+        magic = _read_exactly(file, len(BINARY_MAGIC), path)
+        assert magic == BINARY_MAGIC, RunTimeError(f'{path}不是二进制列式格式的导出数据')
+        sha256.update(magic)
+        while True:
+            block_header = file.read(BLOCK_HEADER.size)
+            if len(block_header) == 0:
+                break
+            assert len(block_header) == BLOCK_HEADER.size, RunTimeError(f'导出数据{path}不完整：文件提前结束')
+            kind, n, size = BLOCK_HEADER.unpack(block_header)
+            payload = _read_exactly(file, size, path)
+            sha256.update(block_header)
+            sha256.update(payload)
+            view = memoryview(payload)
+            if kind == b'DICT':
+                ids, offset = _unpack_array('q', view, 0, n)
+                dir_paths, _ = _unpack_strings(view, offset, n)
+                yield 'dict', dict(zip(ids, dir_paths))
+                continue
+            assert kind == b'ROWS', RunTimeError(f'导出数据{path}中存在无法识别的块：{kind}')
+            file_ids, offset = _unpack_array('q', view, 0, n)
+            path_ids, offset = _unpack_array('q', view, offset, n)
+            names, offset = _unpack_strings(view, offset, n)
+            suffixes, offset = _unpack_strings(view, offset, n)
+            hashed = view[offset: offset + n]
+            offset += n
+            md5s = []
+            for flag in hashed:
+                if flag:
+                    md5s.append(bytes(view[offset: offset + 16]))
+                    offset += 16
+                else:
+                    md5s.append(None)
+            sizes, offset = _unpack_array('q', view, offset, n)
+            dir_ids, offset = _unpack_array('q', view, offset, n)
+            timestamps, offset = _unpack_array('q', view, offset, n)
+            rows += n
+            yield 'rows', list(zip(file_ids, path_ids, names, suffixes, md5s, sizes, dir_ids, timestamps))
+    assert rows == expected['rows'], RunTimeError(
+        f'导出数据{path}不完整：header中记录了{expected["rows"]}行，但是只读取到{rows}行')
+    assert sha256.hexdigest() == expected['sha256'], RunTimeError(f'导出数据{path}的校验和与header中的记录不一致')
+
+
+def remove_dump(dump_dir: str):
+    """
+    删除写入失败的导出目录中的文件
+    :param dump_dir: 导出目录
+    :return: None
+    """
+    for each in os.listdir(dump_dir):
+        os.remove(join(dump_dir, each))
+    os.rmdir(dump_dir)
@@ -0,0 +1,116 @@
+"""
+按目录树自底向上计算每个子目录的摘要（Merkle树）：文件的摘要由文件名、大小和内容标识得出，
+目录的摘要由其中每个文件和子目录的名字及摘要得出，与目录本身的名字和位置无关，
+所以两个子目录的摘要相同即表示它们包含的相对路径和文件内容都相同
+"""
+import hashlib
+from typing import Dict, List, Tuple, Union
+
+# 子目录摘要的累加值按128位取模，使其与子项的顺序无关，不需要对子项排序
+_MASK = (1 << 128) - 1
+
+
+def parent_dir_path(dir_path: str) -> Tuple[str, str]:
+    """
+    :param dir_path: 以/开头和结尾的目录路径，不能是根目录
+    :return: (父目录路径, 目录名字)
+    """
+    parent, _, name = dir_path[:-1].rpartition('/')
+    return parent + '/', name
+
+
+def _entry_hash(kind: bytes, name: str, *fields) -> int:
+    h = hashlib.md5(kind)
+    h.update(name.encode('utf8'))
+    for field in fields:
+        h.update(b'\0')
+        h.update(field if isinstance(field, bytes) else str(field).encode('utf8'))
+    return int.from_bytes(h.digest(), 'big')
+
+
+class SubtreeNode:
+    __slots__ = ('acc', 'files', 'size', 'complete', 'digest', 'children', 'entries')
+
+    def __init__(self):
+        # 子项摘要的累加值
+        self.acc = 0
+        # 子树中的文件数量和总大小
+        self.files = 0
+        self.size = 0
+        # 子树中所有文件的内容标识是否都已知，否则没有摘要
+        self.complete = True
+        # 子树的摘要，compute之后才有值，不完整的子树为None
+        self.digest: Union[bytes, None] = None
+        # 直接子目录的名字
+        self.children: List[str] = []
+        # [文件名] -> (大小, 内容标识)，只有keep_entries时才记录
+        self.entries: Union[Dict[str, Tuple[int, object]], None] = None
+
+
+class SubtreeDigests:
+    def __init__(self, keep_entries: bool = False):
+        """
+        :param keep_entries: 是否在每个目录节点中保留其中的文件，用于逐层比较两棵目录树时找出不同的文件
+        """
+        self._keep_entries = keep_entries
+        # [目录路径] -> 目录节点
+        self.nodes: Dict[str, SubtreeNode] = {}
+        self._node('/')
+
+    def _node(self, dir_path: str) -> SubtreeNode:
+        node = self.nodes.get(dir_path)
+        if node is not None:
+            return node
+        node = self.nodes[dir_path] = SubtreeNode()
+        if self._keep_entries:
+            node.entries = {}
+        if dir_path != '/':
+            parent, name = parent_dir_path(dir_path)
+            self._node(parent).children.append(name)
+        return node
+
+    def add_file(self, dir_path: str, name: str, size: int, content=None):
+        """
+        加入一个文件
+        :param dir_path: 文件所在的目录路径，以/开头和结尾
+        :param name: 文件名
+        :param size: 文件大小
+        :param content: 文件内容的标识，例如md5值，None表示未知，其所在的所有子树都不会有摘要
+        :return: None
+        """
+        node = self._node(dir_path)
+        node.files += 1
+        node.size += size
+        if content is None:
+            node.complete = False
+        else:
+            node.acc = (node.acc + _entry_hash(b'f', name, size, content)) & _MASK
+        if node.entries is not None:
+            node.entries[name] = (size, content)
+
+    def compute(self):
+        """
+        自底向上计算所有目录节点的摘要，并将文件数量和大小累加到祖先节点上
+        :return: None
+        """
+        for dir_path in sorted(self.nodes.keys(), key=lambda p: p.count('/'), reverse=True):
+            node = self.nodes[dir_path]
+            node.digest = hashlib.md5(b'd' + node.acc.to_bytes(16, 'big')).digest() if node.complete else None
+            if dir_path == '/':
+                continue
+            parent_path, name = parent_dir_path(dir_path)
+            parent = self.nodes[parent_path]
+            parent.files += node.files
+            parent.size += node.size
+            if node.digest is None:
+                parent.complete = False
+            else:
+                parent.acc = (parent.acc + _entry_hash(b'd', name, node.digest)) & _MASK
+
+    def digest(self, dir_path: str = '/') -> Union[bytes, None]:
+        """
+        :param dir_path: 目录路径
+        :return: 该目录的摘要，目录不存在或者不完整时为None
+        """
+        node = self.nodes.get(dir_path)
+        return None if node is None else node.digest
@@ -1,12 +1,16 @@
 import os
+import sys
 import hashlib
 from os.path import join, isdir, abspath
 import platform
-from typing import List
-from datetime import datetime
+from typing import List, Iterable, Tuple, Dict
 import time
 
 from error import CodingError
+from throttle import THROTTLE
+
+# 只在导入时判断一次，不需要为每个文件调用platform.system()
+_WINDOWS = platform.system() == 'Windows'
 
 
 class DirectoryRecord:
@@ -36,11 +40,51 @@ class ManagementRecord:
         self.path = path
 
 
+class DirectoryStatsRecord:
+    """
+    描述一个目录的统计信息的类
+    """
+
+    def __init__(
+            self,
+            dir_id: int,
+            file_count: int = 0,
+            total_size: int = 0,
+            hashed_count: int = 0,
+            hashed_size: int = 0,
+            duplicate_count: int = 0,
+            duplicate_size: int = 0
+    ):
+        """
+        :param dir_id: 目录id
+        :param file_count: 文件记录数
+        :param total_size: 文件记录的大小之和
+        :param hashed_count: 已经计算md5值的文件记录数
+        :param hashed_size: 已经计算md5值的文件记录的大小之和
+        :param duplicate_count: 数据库中存在其他大小和md5值都相同的文件记录的文件记录数
+        :param duplicate_size: 上述重复文件记录的大小之和
+        """
+        self.dir_id = dir_id
+        self.file_count = file_count
+        self.total_size = total_size
+        self.hashed_count = hashed_count
+        self.hashed_size = hashed_size
+        self.duplicate_count = duplicate_count
+        self.duplicate_size = duplicate_size
+
+
 class FileRecord:
     """
-    描述一个文件的类
+    描述一个文件的类，目录很大时会同时存在上百万个实例，所以使用__slots__，同一目录的文件共享目录路径字符串，
+    path在访问时才拼接
     """
+    __slots__ = (
+        'dir_path', 'name', 'suffix', 'size', 'modified_time', 'directory_id', 'file_id', 'md5',
+        'dir_physical_path', 'inode'
+    )
     EMPTY_MD5 = '*' * 32
+    # 本程序正在写入的临时文件的后缀，写入完成后才被重命名为目标文件，扫描本地文件时忽略
+    TEMP_SUFFIX = '.lyl232fm-part'
     # 128MB的读取缓存
     READ_BUFFER = 128 * 1024 * 1024
 
@@ -55,7 +99,8 @@ class FileRecord:
             suffix: str = None,
             directory_id: int = None,
             file_id: int = None,
-            dir_physical_path: str = None
+            dir_physical_path: str = None,
+            inode: int = None
     ):
         """
         :param size: 该文件的大小，单位为字节
@@ -68,6 +113,7 @@ class FileRecord:
         :param directory_id: 所属的目录id，如果为None则表示不是从数据库读取出来的
         :param file_id: 文件记录的id，如果为None则表示不是从数据库读取出来的
         :param dir_physical_path: 文件所属目录的物理路径
+        :param inode: 本地文件的inode编号，如果为None则表示不是从本地扫描出来的
         """
         assert size >= 0, f'文件{path}的大小为{size}不能小于等于0'
         assert isinstance(modified_time, int)
@@ -75,14 +121,66 @@ class FileRecord:
             assert path is not None
             dir_path, name, suffix = self.format_path(path)
         self.dir_path, self.name, self.suffix = dir_path, name, suffix
-        self.path = f'{dir_path}{name}{suffix}'
         self.size = size
         self.modified_time = modified_time
         self.directory_id = directory_id
         self.file_id = file_id
         self.md5 = md5 or self.EMPTY_MD5
         self.dir_physical_path = dir_physical_path
-        self._modified_date = None
+        self.inode = inode
+
+    @classmethod
+    def from_scan_rows(
+            cls, dir_physical_path: str, rows: Iterable[Tuple[str, int, int, int]]
+    ) -> List['FileRecord']:
+        """
+        批量地从本地扫描的结果构造文件记录，不经过__init__的检查和format_path
+        :param dir_physical_path: 扫描的目录的物理路径
+        :param rows: (以/分隔并以/开头的相对路径, 大小, 修改时间, inode)
+        :return: 文件记录列表
+        """
+        res, new = [], cls.__new__
+        dir_paths: Dict[str, str] = {}
+        for path, size, modified_time, inode in rows:
+            dir_path, _, filename = path.rpartition('/')
+            dir_path = dir_paths.get(dir_path) or dir_paths.setdefault(dir_path, sys.intern(f'{dir_path}/'))
+            record = new(cls)
+            record.dir_path = dir_path
+            record.name, record.suffix = cls._split_suffix(filename)
+            record.size, record.modified_time, record.md5 = size, modified_time, cls.EMPTY_MD5
+            record.directory_id, record.file_id = None, None
+            record.dir_physical_path, record.inode = dir_physical_path, inode
+            res.append(record)
+        return res
+
+    @classmethod
+    def from_db_rows(cls, rows: Iterable[tuple], dir_paths: Dict[int, str] = None) -> List['FileRecord']:
+        """
+        批量地从数据库的查询结果构造文件记录，不经过__init__的检查
+        :param rows: (目录节点id, 文件名, 后缀, 数据库中的16字节md5值或者None, 大小, 修改时间, 文件id, 目录id)，
+            dir_paths为None时第一项为目录路径
+        :param dir_paths: [目录节点id] -> 目录路径
+        :return: 文件记录列表
+        """
+        res, new = [], cls.__new__
+        for path_id, name, suffix, md5, size, modified_time, file_id, dir_id in rows:
+            record = new(cls)
+            record.dir_path = sys.intern(path_id) if dir_paths is None else dir_paths[int(path_id)]
+            record.name, record.suffix = name, sys.intern(suffix)
+            record.md5 = cls.EMPTY_MD5 if md5 is None else bytes(md5).hex()
+            record.size, record.modified_time = int(size), int(modified_time)
+            record.file_id, record.directory_id = int(file_id), int(dir_id)
+            record.dir_physical_path, record.inode = None, None
+            res.append(record)
+        return res
+
+    @property
+    def path(self) -> str:
+        return f'{self.dir_path}{self.name}{self.suffix}'
+
+    @path.setter
+    def path(self, path: str):
+        self.dir_path, self.name, self.suffix = self.format_path(path)
 
     def __str__(self):
         return str({
@@ -97,9 +195,7 @@ class FileRecord:
 
     @property
     def modified_date(self) -> str:
-        if self._modified_date is None:
-            self._modified_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.modified_time))
-        return self._modified_date
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.modified_time))
 
     def __repr__(self):
         return str(self)
@@ -111,11 +207,13 @@ class FileRecord:
         """
         m = hashlib.md5()
         assert self.dir_physical_path is not None, CodingError('计算md5值前dir_physical_path不能为空')
+        THROTTLE.consume_files()
         with open(join(self.dir_physical_path, *(self.path.split('/')[1:])), 'rb') as file:
             while True:
-                data = file.read(self.READ_BUFFER)
+                data = file.read(THROTTLE.read_size(self.READ_BUFFER))
                 if not data:
                     break
+                THROTTLE.consume_bytes(len(data))
                 m.update(data)
         self.md5 = m.hexdigest()
         return self.md5
@@ -127,7 +225,7 @@ class FileRecord:
         :param path: 文件的路径
         :return: 文件所在目录路径，以/开头，文件名，文件后缀（如果有，则以.开头）
         """
-        if platform.system() == 'Windows':
+        if _WINDOWS:
             path = path.replace('\\\\', os.sep)  # 去除双反斜杠
         path = path.replace(os.sep, '/')
         # 检查所有路径中是否存在相对路径
@@ -136,12 +234,31 @@ class FileRecord:
             split_path.pop(0)
         assert all(each != '.' and each != '..' for each in split_path), f'路径中不允许存在相对路径：{path}'
         filename = split_path.pop(-1)
-        file_dir_path = '/' if len(split_path) == 0 else '/' + '/'.join(split_path) + '/'
-        filename_split = filename.split('.')
-        if len(filename_split) == 1:
-            return file_dir_path, filename, ''
-        suffix = '.' + filename_split.pop(-1)
-        return file_dir_path, '.'.join(filename_split), suffix
+        file_dir_path = sys.intern('/' if len(split_path) == 0 else '/' + '/'.join(split_path) + '/')
+        return (file_dir_path,) + FileRecord._split_suffix(filename)
+
+    @staticmethod
+    def _split_suffix(filename: str) -> Tuple[str, str]:
+        """
+        :param filename: 文件名
+        :return: 文件名，文件后缀（如果有，则以.开头）
+        """
+        name, dot, suffix = filename.rpartition('.')
+        if not dot:
+            return filename, ''
+        return name, sys.intern(f'.{suffix}')
+
+    @staticmethod
+    def format_dir_path(path: str) -> str:
+        """
+        格式化目录的路径
+        :param path: 目录相对于管理目录的根目录的路径
+        :return: 以/开头和结尾的目录路径
+        """
+        path = path.replace('\\', '/')
+        split_path = [each for each in path.split('/') if each != '']
+        assert all(each != '.' and each != '..' for each in split_path), f'路径中不允许存在相对路径：{path}'
+        return '/' if len(split_path) == 0 else '/' + '/'.join(split_path) + '/'
 
     @classmethod
     def get_file_paths_of_dir(cls, dir_abs_path: str) -> List[str]:
@@ -161,6 +278,16 @@ class FileRecord:
                 res.append(file)
         return res
 
+    @staticmethod
+    def modified_timestamp(st_mtime: float) -> int:
+        """
+        将文件系统的修改时间转换为文件记录中的整数时间戳（精确到秒）
+        :param st_mtime: os.stat得到的修改时间
+        :return: 整数时间戳
+        """
+        # 舍去秒以下的部分，并与按本地时间的字符串往返转换的结果一致（由mktime自行判断夏令时）
+        return int(time.mktime(time.localtime(st_mtime)[:8] + (-1,)))
+
     @classmethod
     def get_dir_file_records(cls, dir_path: str) -> List['FileRecord']:
         """
@@ -169,24 +296,20 @@ class FileRecord:
         :return: 该路径下的所有文件对应的File对象
         """
         dir_path = abspath(dir_path)
-        file_paths = cls.get_file_paths_of_dir(dir_path)
-        assert all(dir_path in each for each in file_paths)
-        res = []
-        for each in file_paths:
-            if dir_path.startswith(f'{dir_path}/.lyl232fm'):
-                continue
-            assert dir_path in each, f'文件路径：{each}中不包含指定物理根目录路径：{dir_path}'
-            date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(each)))
-            date_obj = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
-            timestamp = int(time.mktime(date_obj.timetuple()))
-            record = FileRecord(
-                path=each.replace(dir_path, ''),
-                size=os.path.getsize(each),
-                modified_time=timestamp,
-                md5='',
-                dir_physical_path=dir_path
-            )
-            if record.dir_path.startswith('/.lyl232fm/'):
-                continue
-            res.append(record)
-        return res
+
+        def scan(abs_path: str, rel_path: str):
+            if not isdir(abs_path):
+                return
+            with os.scandir(abs_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if rel_path == '/' and entry.name == '.lyl232fm':
+                            continue
+                        yield from scan(entry.path, f'{rel_path}{entry.name}/')
+                    elif not entry.name.endswith(cls.TEMP_SUFFIX):
+                        stat = os.stat(entry.path)
+                        yield (
+                            f'{rel_path}{entry.name}', stat.st_size, cls.modified_timestamp(stat.st_mtime), stat.st_ino
+                        )
+
+        return cls.from_scan_rows(dir_path, scan(dir_path, '/'))
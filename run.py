@@ -3,6 +3,7 @@ import sys
 import io
 from scripts import SCRIPTS
 from error import ArgumentError, OperationError
+from throttle import THROTTLE
 
 
 def get_args():
@@ -10,6 +11,10 @@ def get_args():
     parser.add_argument('script', type=str, choices=list(SCRIPTS.keys()), help='需要运行的脚本')
     parser.add_argument('script_args', type=str, nargs='*')
     parser.add_argument('--database_config', type=str, default='database_config.json', help='数据库配置')
+    parser.add_argument(
+        '--throttle_config', type=str, default='throttle.json',
+        help='读取限速的控制文件，运行中修改或者发送SIGHUP信号后生效'
+    )
     return parser.parse_args()
 
 
@@ -21,6 +26,7 @@ def main():
 
     try:
         database_config, script_args = args.database_config, args.script_args or []
+        THROTTLE.configure(args.throttle_config)
         with SCRIPTS[args.script](database_config=database_config) as script:
             return script(*script_args)
     except OperationError as e:
@@ -1,5 +1,5 @@
 from .base import BaseScript, DataBaseScript, SingleTransactionScript, FileMD5ComputingScript
-from .database import InitializeDataBaseScript, ClearDataBaseScript
+from .database import InitializeDataBaseScript, ClearDataBaseScript, MigrateDataBaseScript, RepairDataBaseScript
 from .common import (
     ManageDirectoryScript,
     CancelManagementScript,
@@ -9,14 +9,20 @@ from .common import (
     QueryFileRecordScript,
     DumpDatabaseScript,
     QueryRedundantFileScript,
+    QueryRedundantSubtreeScript,
+    VerifyReplicaScript,
+    ScrubScript,
+    HashDaemonScript,
     QuerySizeScript,
-    FindInFileDirectorPathScript, FindInNameScript, FindInSuffixScript,
+    FindInFileDirectorPathScript, FindInNameScript, FindInSuffixScript, FindFileScript,
     QueryDirectoryFileRecordsExistenceScript
 )
 
 SCRIPTS = {
     'init_db': InitializeDataBaseScript,
     'clear_db': ClearDataBaseScript,
+    'migrate_db': MigrateDataBaseScript,
+    'repair_db': RepairDataBaseScript,
     'manage': ManageDirectoryScript,
     'cm': CancelManagementScript,
     'mkdir': MakeDirectoryScript,
@@ -26,8 +32,13 @@ SCRIPTS = {
     'size': QuerySizeScript,
     'dump_db': DumpDatabaseScript,
     'qrf': QueryRedundantFileScript,
+    'qrd': QueryRedundantSubtreeScript,
+    'verify_replica': VerifyReplicaScript,
+    'scrub': ScrubScript,
+    'hashd': HashDaemonScript,
     'fid': FindInFileDirectorPathScript,
     'fin': FindInNameScript,
     'fis': FindInSuffixScript,
+    'find': FindFileScript,
     'qde': QueryDirectoryFileRecordsExistenceScript,
 }
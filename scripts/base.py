@@ -7,7 +7,7 @@ from os.path import join, dirname, exists, isdir, abspath, samefile
 import time
 from tqdm import tqdm
 
-from database import DATABASE_CLASS, Database
+from database import DATABASE_CLASS, Database, SCHEMA_VERSION
 from error import ArgumentError, CodingError, RunTimeError, OperationError
 from record import FileRecord
 
@@ -74,47 +74,6 @@ class BaseScript(metaclass=ABCMeta):
         byte_size /= 1024.0
         return '%.2fTB' % byte_size
 
-    @staticmethod
-    def read_csv(path: str, ignore_header: bool = False) -> List[tuple]:
-        """
-        :param path: 路径
-        :param ignore_header: 是否忽略表头
-        :return: 读取出的数据元组列表
-        """
-        with open(path, 'r', encoding='utf8') as file:
-            res = []
-            while True:
-                line = file.readline()
-                if len(line) == 0:
-                    break
-                if ignore_header:
-                    ignore_header = False
-                    continue
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                # 改用反斜杠，因为不会出现在数据库里而逗号会
-                res.append(line.split('\\'))
-        return res
-
-    @staticmethod
-    def write_csv(path: str, data: List[tuple], headers: List[str] = None) -> None:
-        """
-        :param path: 路径
-        :param data: 数据
-        :param headers: 表头
-        :return: None
-        """
-        headers = headers or []
-        with open(path, 'w', encoding='utf8') as file:
-            if len(headers) > 0:
-                # 使用反斜杠，因为不会出现在数据库里，而逗号会
-                file.write('\\'.join(headers) + '\n')
-            for each in data:
-                assert len(each) == len(headers)
-                # 使用反斜杠，因为不会出现在数据库里，而逗号会
-                file.write('\\'.join([str(item) for item in each]) + '\n')
-
     @staticmethod
     def _write_manage_info(dir_path, name: str, tag: str):
         """
@@ -296,16 +255,26 @@ class DataBaseScript(BaseScript, metaclass=ABCMeta):
         """
         if not self.db.is_initialized():
             self.db.initialize()
+        version = self.db.schema_version()
+        assert version == SCHEMA_VERSION, OperationError(
+            f'数据库结构的版本为{version}，而本程序需要的版本为{SCHEMA_VERSION}，请先执行lfm migrate_db升级数据库')
 
     @property
     def db(self) -> Database:
         assert self._db is not None or CodingError(f'请使用 with as 语法使用类{type(self)}或者在构造时传入Database对象')
         return self._db
 
-    def __enter__(self):
+    def connect_database(self) -> Database:
+        """
+        根据数据库配置建立一个新的数据库连接
+        :return: 数据库对象
+        """
         database_config = self.database_config.copy()
         database = database_config.pop('database')
-        self._db = DATABASE_CLASS[database](**database_config)
+        return DATABASE_CLASS[database](**database_config)
+
+    def __enter__(self):
+        self._db = self.connect_database()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
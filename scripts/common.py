@@ -2,16 +2,32 @@
 常规的脚本：经常使用的
 """
 import os
-from os.path import isdir, join, exists, abspath, samefile, dirname
+import json
+import time
+import hashlib
+import shutil
+import subprocess
+from os.path import isdir, join, exists, abspath, dirname
 from json.decoder import JSONDecodeError
-from typing import Set, Dict, Tuple, List
+from typing import Set, Dict, Tuple, List, Union
 from tqdm import tqdm
-import shutil
 from abc import abstractmethod, ABCMeta
 
 from scripts import DataBaseScript, SingleTransactionScript, FileMD5ComputingScript
-from error import OperationError, RunTimeError, CodingError
-from record import FileRecord
+from error import OperationError, RunTimeError, CodingError, ArgumentError, DataError
+from record import FileRecord, DirectoryStatsRecord
+from manifest import SubtreeDigests, parent_dir_path
+from throttle import THROTTLE, TokenBucket
+from diff import scan_sorted, merge_diff, external_sort, SpillList
+from snapshot import read_snapshot, load_snapshot, write_snapshot, merge_snapshots, SnapshotLookup
+from database import SCHEMA_VERSION
+from transfer import (
+    DeviceSpeed, CopyEngine, CopyJournal, device_of, copy_file, delta_copy, temp_path_of,
+    COPIED, REFLINKED, HARDLINKED, DELTA_COPY_SIZE
+)
+from dump import (
+    TableWriter, FileColumnWriter, write_header, load_header, remove_dump, COMPRESSIONS, DEFAULT_COMPRESSION
+)
 
 
 class MakeDirectoryScript(SingleTransactionScript):
@@ -57,10 +73,15 @@ class QueryDirectoryScript(DataBaseScript):
         self.check_empty_args(*args)
         self.init_db_if_needed()
         if name is None:
-            for directory in self.db.directories():
-                print(f'目录：{directory.name}，描述：{directory.desc}，id：{directory.dir_id}')
+            directories = self.db.directories()
+            statistics = self.db.directory_statistics([each.dir_id for each in directories])
+            for directory in directories:
+                print(f'目录：{directory.name}，描述：{directory.desc}，id：{directory.dir_id}，'
+                      f'{self.directory_statistics_hint(statistics[directory.dir_id])}')
         else:
-            assert self.db.directory_id(name) is not None, OperationError(f'目录名字：{name}不存在')
+            dir_id = self.db.directory_id(name)
+            assert dir_id is not None, OperationError(f'目录名字：{name}不存在')
+            print(self.directory_statistics_hint(self.db.directory_statistics([dir_id])[dir_id]))
             for tag, path in self.db.managements(name):
                 if exists(path):
                     print(f'标识：{tag}，路径：{path}')
@@ -68,16 +89,65 @@ class QueryDirectoryScript(DataBaseScript):
                     print(f'标识：{tag}，路径：{path}（不存在）')
         return 0
 
+    @classmethod
+    def directory_statistics_hint(cls, stats: DirectoryStatsRecord) -> str:
+        """
+        :param stats: 目录统计信息
+        :return: 目录统计信息的输出字符串
+        """
+        return (
+            f'文件数：{stats.file_count}，大小：{cls.human_readable_size(stats.total_size)}，'
+            f'已计算md5：{stats.hashed_count}，未计算md5：{stats.file_count - stats.hashed_count}，'
+            f'重复文件数：{stats.duplicate_count}，重复文件大小：{cls.human_readable_size(stats.duplicate_size)}'
+        )
+
 
 class ManageDirectoryScript(FileMD5ComputingScript):
+    # .lyl232fm下的本地扫描快照，格式见snapshot.py
+    SCAN_SNAPSHOT = 'scan_snapshot'
+    # .lyl232fm下隔离复制后校验失败的文件的目录
+    QUARANTINE_DIR = 'quarantine'
+    # .lyl232fm下的复制日志，用于继续上次中断的复制
+    COPY_JOURNAL = 'copy_journal'
+    # 动作计划的格式版本
+    PLAN_VERSION = 1
+    # 动作计划中每类条目可以选择的动作，第一个是生成计划时默认选择的动作
+    PLAN_CHOICES = {
+        # 在其他物理位置已经被移动的文件
+        'recorded_move': ('rename_local', 'skip'),
+        # 在本地被移动的文件
+        'moved': ('move_db', 'skip'),
+        # 本地独有的文件
+        'local_only': ('add', 'delete_local', 'skip'),
+        # 数据库独有的文件记录，没有找到来源时默认跳过
+        'db_only': ('copy', 'delete_db', 'skip'),
+        # 路径相同但大小或修改时间不同的文件
+        'conflict': ('update_db', 'restore', 'delete_local', 'skip'),
+        # 与数据库记录匹配但数据库中没有md5值的文件
+        'hash': ('update_md5', 'skip'),
+    }
+
     def __call__(self, dir_path: str = '.', name: str = None, tag: str = None, *args) -> int:
         """
         管理一个新的物理目录的脚本
         :param dir_path: 目录的路径
         :param name: 目录名字
         :param tag: 目录标识，不能与其他标识重复
+        :param args: 可选的plan:计划文件路径，无人值守地完成扫描、计算md5值和比较，将所有的动作写入计划文件后退出；
+            或者apply:计划文件路径，不经询问地批量执行计划文件中的动作。这两个参数可以出现在任意位置
         :return: 0表示正常
         """
+        options = {'plan': None, 'apply': None}
+        positional = []
+        for arg in (dir_path, name, tag) + args:
+            key, sep, value = (arg or '').partition(':')
+            if sep == ':' and key in options:
+                options[key] = value.strip()
+            elif arg is not None:
+                positional.append(arg)
+        assert options['plan'] is None or options['apply'] is None, ArgumentError('plan和apply不能同时指定')
+        dir_path, name, tag, *args = positional + [None] * (3 - min(len(positional), 3))
+        dir_path = dir_path or '.'
         self.check_empty_args(*args)
         self.init_db_if_needed()
         dir_path = abspath(dir_path)
@@ -85,11 +155,41 @@ class ManageDirectoryScript(FileMD5ComputingScript):
         assert isdir(dir_path), OperationError(f'{dir_path}不是一个目录')
 
         dir_id, dir_path = self.maintain_management(dir_path, name, tag)
+        # [相对路径] -> 上次的快照项，流式比较时只保存需要处理的文件的快照项
+        self._scan_snapshot: Dict[str, list] = {}
+        # [相对路径] -> 复制时校验过的文件的快照项
+        self._verified_snapshot: Dict[str, list] = {}
+        # 流式比较时没有构造文件记录的文件，见_stream_local_and_db_records，都保存在临时文件中：
+        # 按路径排序的(相对路径, 快照项)；需要校验md5值的文件；以及之后校验得到的快照项
+        self._unchanged_snapshot, self._snapshot_updates = SpillList(), SpillList()
+        self._streamed_uncached, self._streamed_uncached_size = SpillList(), 0
+        self._streamed_conflicts: Dict[str, Tuple[FileRecord, FileRecord]] = {}
+        try:
+            return self._manage(dir_path, dir_id, options)
+        finally:
+            for each in (self._unchanged_snapshot, self._snapshot_updates, self._streamed_uncached):
+                each.close()
+
+    def _manage(self, dir_path: str, dir_id: int, options: Dict[str, Union[str, None]]) -> int:
+        """
+        :param dir_path: 目录的物理路径
+        :param dir_id: 目录id
+        :param options: plan和apply参数
+        :return: 0表示正常
+        """
+        if options['plan'] is not None:
+            self._scan_snapshot = self._load_scan_snapshot(dir_path)
+            self._write_plan(dir_path, dir_id, options['plan'])
+            return 0
+        if options['apply'] is not None:
+            self._scan_snapshot = self._load_scan_snapshot(dir_path)
+            self._apply_plan(dir_path, dir_id, options['apply'])
+            return 0
+        self._resume_copy_journal(dir_path)
 
-        # 获取当前目录的所有文件信息记录
-        db_records = self.db.file_records(dir_id)
-        local_records = FileRecord.get_dir_file_records(dir_path)
-        if len(db_records) == 0:
+        # 按路径归并本地文件与数据库记录，只有需要处理的文件才构造文件记录
+        local_records, db_records, db_count = self._stream_local_and_db_records(dir_path, dir_id)
+        if db_count == 0:
             total_size = sum(each.size for each in local_records)
             if self.input_query(
                     f'有{len(local_records)}个文件共{self.human_readable_size(total_size)}，'
@@ -103,8 +203,10 @@ class ManageDirectoryScript(FileMD5ComputingScript):
             else:
                 created_rows = self.transaction(self.db.new_file_records, dir_id=dir_id, file_records=local_records)
             print(f'更新了{created_rows}条记录')
+            self._save_scan_snapshot(dir_path, local_records)
             return 0
         self._compare_local_records_to_db_records(dir_path, dir_id, local_records, db_records)
+        self._save_scan_snapshot(dir_path, local_records)
         if self.check_empty_dir(dir_path) and self.input_query('检测到存在空目录，是否删除它们？'):
             self.remove_empty_dir(dir_path)
         return 0
@@ -174,12 +276,542 @@ class ManageDirectoryScript(FileMD5ComputingScript):
         db_unique = db_file_path - current_paths
 
         deleted_records = self._common_path_records_action(dir_path, dir_id, common_path, local_records, db_records)
+        # 流式比较时没有构造的文件记录在校验md5值时才发现冲突，冲突中删除的本地文件需要在之后找到数据库记录
+        for path, (local_record, db_record) in self._streamed_conflicts.items():
+            local_records.setdefault(path, local_record)
+            db_records.setdefault(path, db_record)
         # 在上个动作中删除的本地文件记录添加到数据库缺失的文件中
         for each in deleted_records:
             db_unique.add(each.path)
+        # 先在本地重放其他物理位置已经记录的移动，再检测本地新发生的移动，匹配上的文件记录不再视为缺失
+        for local_path, db_path in self._replay_recorded_moves(
+                dir_path, dir_id, current_unique, db_unique, local_records, db_records
+        ):
+            current_unique.discard(local_path)
+            db_unique.discard(db_path)
+        for local_path, db_path in self._moved_records_action(self._detect_moved_records(
+                dir_path, current_unique, db_unique, local_records, db_records
+        )):
+            current_unique.discard(local_path)
+            db_unique.discard(db_path)
         self._unique_db_records_action(dir_path, dir_id, db_unique, db_records)
         self._unique_local_records_action(dir_path, dir_id, current_unique, local_records)
 
+    def _write_plan(self, dir_path: str, dir_id: int, plan_path: str):
+        """
+        无人值守地扫描本地文件、与数据库比较、计算需要的md5值并寻找复制的来源，将所有的动作写入计划文件，
+        计划文件可以在审阅和修改每个条目的action后以apply执行。为了不无人值守地读取大量数据，
+        与数据库记录匹配而且数据库中有md5值的文件不会被重新校验（扫描快照中已知md5值的除外）
+        :param dir_path: 正在操作的目录的物理路径
+        :param dir_id: 目录id
+        :param plan_path: 计划文件路径
+        :return: None
+        """
+        local_records = {each.path: each for each in FileRecord.get_dir_file_records(dir_path)}
+        db_records = {each.path: each for each in self.db.file_records(dir_id)}
+        current_paths, db_paths = set(local_records.keys()), set(db_records.keys())
+        common_paths = current_paths & db_paths
+        current_unique, db_unique = current_paths - db_paths, db_paths - current_paths
+        entries = []
+
+        def entry(entry_type: str, record: FileRecord, action: str = None, **kwargs) -> dict:
+            res = {
+                'type': entry_type, 'action': action or self.PLAN_CHOICES[entry_type][0], 'path': record.path,
+                'size': record.size, 'modified_time': record.modified_time,
+                'md5': None if record.md5 == FileRecord.EMPTY_MD5 else record.md5,
+            }
+            res.update(kwargs)
+            return res
+
+        for local_path, db_path in self._match_recorded_moves(
+                dir_id, current_unique, db_unique, local_records, db_records
+        ):
+            entries.append(entry('recorded_move', local_records[local_path], target=db_path))
+            current_unique.discard(local_path)
+            db_unique.discard(db_path)
+        for local_record, db_record in self._detect_moved_records(
+                dir_path, current_unique, db_unique, local_records, db_records, confirm_by_md5=True
+        ):
+            entries.append(entry('moved', local_record, db_path=db_record.path, file_id=db_record.file_id))
+            current_unique.discard(local_record.path)
+            db_unique.discard(db_record.path)
+
+        conflicts, hashes = [], []
+        for path in sorted(common_paths):
+            local_record, db_record = local_records[path], db_records[path]
+            local_record.file_id = db_record.file_id
+            local_record.md5 = self._snapshot_md5(local_record) or FileRecord.EMPTY_MD5
+            if local_record.size != db_record.size or local_record.modified_time != db_record.modified_time:
+                conflicts.append((local_record, db_record))
+            elif db_record.md5 == FileRecord.EMPTY_MD5:
+                hashes.append(local_record)
+            elif local_record.md5 != FileRecord.EMPTY_MD5 and local_record.md5 != db_record.md5:
+                conflicts.append((local_record, db_record))
+        local_only = [local_records[path] for path in sorted(current_unique)]
+        to_hash = [
+            each for each in local_only + hashes + [local for local, _ in conflicts]
+            if each.md5 == FileRecord.EMPTY_MD5
+        ]
+        for record in tqdm(to_hash, desc='计算本地文件md5值', disable=len(to_hash) < 5):
+            record.compute_md5()
+
+        db_only = [db_records[path] for path in sorted(db_unique)]
+        sources, _ = self._find_file_in_other_managements(
+            dir_path, dir_id, db_only + [db_record for _, db_record in conflicts]
+        )
+        for record in db_only:
+            source = sources.get(join(dir_path, *(record.path.split('/')[1:])))
+            entries.append(entry(
+                'db_only', record, action=None if source is not None else 'skip',
+                file_id=record.file_id, source=source
+            ))
+        for local_record, db_record in conflicts:
+            entries.append(entry(
+                'conflict', local_record, file_id=db_record.file_id, db_size=db_record.size,
+                db_modified_time=db_record.modified_time,
+                db_md5=None if db_record.md5 == FileRecord.EMPTY_MD5 else db_record.md5,
+                source=sources.get(join(dir_path, *(local_record.path.split('/')[1:])))
+            ))
+        entries.extend(entry('local_only', record) for record in local_only)
+        entries.extend(entry('hash', record, file_id=record.file_id) for record in hashes)
+
+        with open(plan_path, 'w', encoding='utf8') as file:
+            json.dump({
+                'version': self.PLAN_VERSION,
+                'dir_path': dir_path,
+                'dir_id': dir_id,
+                'choices': {key: list(value) for key, value in self.PLAN_CHOICES.items()},
+                'entries': entries,
+            }, file, ensure_ascii=False, indent=1)
+        counts = {}
+        for each in entries:
+            counts[(each['type'], each['action'])] = counts.get((each['type'], each['action']), 0) + 1
+        for (entry_type, action), count in sorted(counts.items()):
+            print(f'{entry_type}\t{action}\t{count}')
+        print(f'共{len(entries)}个动作已经写入计划文件：{plan_path}，审阅后可以使用apply:{plan_path}执行')
+
+    def _apply_plan(self, dir_path: str, dir_id: int, plan_path: str):
+        """
+        不经询问地执行计划文件中的动作：数据库的修改按动作类别各在一个事务中批量执行，复制使用并行的复制引擎。
+        本地文件在生成计划后被修改过（大小或修改时间不同）的条目会被跳过
+        :param dir_path: 正在操作的目录的物理路径
+        :param dir_id: 目录id
+        :param plan_path: 计划文件路径
+        :return: None
+        """
+        try:
+            with open(plan_path, 'r', encoding='utf8') as file:
+                plan = json.load(file)
+        except (JSONDecodeError, FileNotFoundError) as e:
+            raise OperationError(f'无法读取计划文件：{plan_path}，原因是：{e}')
+        assert plan.get('version') == self.PLAN_VERSION, OperationError(f'不支持的计划文件版本：{plan.get("version")}')
+        assert plan['dir_id'] == dir_id and abspath(plan['dir_path']) == dir_path, OperationError(
+            f'计划文件{plan_path}是为{plan["dir_path"]}生成的，而不是{dir_path}')
+
+        def real_path(path: str) -> str:
+            return join(dir_path, *(path.split('/')[1:]))
+
+        def unchanged(each: dict) -> bool:
+            try:
+                stat = os.stat(real_path(each['path']))
+            except OSError:
+                return False
+            return stat.st_size == each['size'] and \
+                FileRecord.modified_timestamp(stat.st_mtime) == each['modified_time']
+
+        actions: Dict[str, List[dict]] = {}
+        stale = []
+        for each in plan['entries']:
+            assert each['action'] in self.PLAN_CHOICES.get(each['type'], ()), OperationError(
+                f'条目{each["path"]}的类型{each["type"]}不支持动作{each["action"]}')
+            if each['action'] == 'skip':
+                continue
+            if each['type'] == 'db_only':
+                if exists(real_path(each['path'])):
+                    stale.append(each)
+                    continue
+            elif not unchanged(each):
+                stale.append(each)
+                continue
+            actions.setdefault(each['action'], []).append(each)
+        for each in stale:
+            print(each['path'])
+        if len(stale) > 0:
+            print(f'上述{len(stale)}个文件在生成计划后发生了变化，将被跳过')
+
+        def local_record(each: dict, file_id: int = None) -> FileRecord:
+            return FileRecord(
+                path=each['path'], size=each['size'], modified_time=each['modified_time'], md5=each['md5'],
+                file_id=file_id, directory_id=dir_id, dir_physical_path=dir_path
+            )
+
+        renamed = sum(
+            self._rename_local_file(dir_path, each['path'], each['target'])
+            for each in actions.get('rename_local', [])
+        )
+        if renamed > 0:
+            print(f'移动了{renamed}个本地文件')
+        if len(actions.get('move_db', [])) > 0:
+            moved = self.transaction(self.db.move_file_records, moves=[
+                (FileRecord(
+                    path=each['db_path'], size=each['size'], modified_time=each['modified_time'],
+                    file_id=each['file_id'], directory_id=dir_id
+                ), each['path'])
+                for each in actions['move_db']
+            ])
+            print(f'修改了{moved}条文件记录的路径')
+        if len(actions.get('add', [])) > 0:
+            created = self.transaction(
+                self.db.new_file_records, dir_id=dir_id, file_records=[local_record(each) for each in actions['add']]
+            )
+            print(f'插入了{created}条文件记录')
+        updating = actions.get('update_db', []) + actions.get('update_md5', [])
+        if len(updating) > 0:
+            updated = self.transaction(
+                self.db.update_file_records, file_records=[local_record(each, each['file_id']) for each in updating]
+            )
+            print(f'更新了{updated}条文件记录')
+        if len(actions.get('delete_db', [])) > 0:
+            deleted = self.transaction(
+                self.db.delete_file_record_by_ids, file_ids=[each['file_id'] for each in actions['delete_db']]
+            )
+            print(f'删除了{deleted}条文件记录')
+
+        # 需要恢复的本地文件不在这里删除，由复制成功后原子地替换，来源不可用或者复制失败时本地文件仍然保留
+        removing = actions.get('delete_local', [])
+        for each in removing:
+            os.remove(real_path(each['path']))
+        if len(removing) > 0:
+            print(f'删除了{len(removing)}个本地文件')
+        copying, no_source = [], []
+        for each in actions.get('copy', []) + actions.get('restore', []):
+            (copying if each.get('source') is not None else no_source).append(each)
+        for each in no_source:
+            print(each['path'])
+        if len(no_source) > 0:
+            print(f'上述{len(no_source)}个文件在生成计划时没有找到可以复制的来源，将被跳过')
+        if len(copying) > 0:
+            self._copy_files(
+                dir_path,
+                [(each['source'], real_path(each['path'])) for each in copying],
+                {
+                    real_path(each['path']): each.get('db_md5', each['md5']) for each in copying
+                    if each.get('db_md5', each['md5']) is not None
+                },
+                hardlink=False,
+                overwrite={
+                    real_path(each['path']) for each in actions.get('restore', []) if each.get('source') is not None
+                }
+            )
+        self._save_scan_snapshot(dir_path, FileRecord.get_dir_file_records(dir_path))
+
+    def _replay_recorded_moves(
+            self,
+            dir_path: str,
+            dir_id: int,
+            current_unique: Set[str],
+            db_unique: Set[str],
+            local_records: Dict[str, FileRecord],
+            db_records: Dict[str, FileRecord]
+    ) -> List[Tuple[str, str]]:
+        """
+        在本地重放数据库中记录的文件移动：本地独有的文件如果位于某条文件记录曾经的路径上，而且大小和修改时间与该文件记录一致，
+        则将其重命名到该文件记录现在的路径，而不是删除后再从其他物理位置复制
+        :param dir_path: 正在操作的目录的物理路径
+        :param dir_id: 目录id
+        :param current_unique: 本地独有的路径集合
+        :param db_unique: 数据库独有的路径集合
+        :param local_records: 本地文件记录
+        :param db_records: 数据库文件记录
+        :return: 已经重放的(本地原路径, 数据库路径)列表
+        """
+        moves = self._match_recorded_moves(dir_id, current_unique, db_unique, local_records, db_records)
+        if len(moves) == 0:
+            return []
+        for local_path, db_path in moves:
+            print(f'{local_path} -> {db_path}')
+        if not self.input_query(f'上述{len(moves)}个文件已经在其他物理位置被移动，是否在本地执行相同的移动？'):
+            return []
+        replayed = []
+        for local_path, db_path in moves:
+            if not self._rename_local_file(dir_path, local_path, db_path):
+                continue
+            record = local_records.pop(local_path)
+            record.path = db_path
+            record.file_id = db_records[db_path].file_id
+            local_records[db_path] = record
+            replayed.append((local_path, db_path))
+        print(f'移动了{len(replayed)}个本地文件')
+        return replayed
+
+    def _match_recorded_moves(
+            self,
+            dir_id: int,
+            current_unique: Set[str],
+            db_unique: Set[str],
+            local_records: Dict[str, FileRecord],
+            db_records: Dict[str, FileRecord]
+    ) -> List[Tuple[str, str]]:
+        """
+        找出位于某条文件记录曾经的路径上，而且大小和修改时间与该文件记录一致的本地独有的文件
+        :param dir_id: 目录id
+        :param current_unique: 本地独有的路径集合
+        :param db_unique: 数据库独有的路径集合
+        :param local_records: 本地文件记录
+        :param db_records: 数据库文件记录
+        :return: (本地路径, 数据库路径)列表
+        """
+        if len(current_unique) == 0 or len(db_unique) == 0:
+            return []
+        id2db_path = {db_records[path].file_id: path for path in db_unique}
+        # 每个曾经的路径只取最后一次移出该路径的文件记录
+        old_path2file_id = {}
+        for file_id, old_path, _ in self.db.file_moves(dir_id):
+            old_path2file_id[old_path] = file_id
+        moves, taken = [], set()
+        for local_path in sorted(current_unique):
+            db_path = id2db_path.get(old_path2file_id.get(local_path))
+            if db_path is None or db_path in taken:
+                continue
+            local_record, db_record = local_records[local_path], db_records[db_path]
+            if local_record.size != db_record.size or local_record.modified_time != db_record.modified_time:
+                continue
+            taken.add(db_path)
+            moves.append((local_path, db_path))
+        return moves
+
+    @staticmethod
+    def _rename_local_file(dir_path: str, path: str, new_path: str) -> bool:
+        """
+        在本地目录中移动一个文件
+        :param dir_path: 正在操作的目录的物理路径
+        :param path: 文件的相对路径
+        :param new_path: 移动后的相对路径
+        :return: 是否移动成功，目标路径已经存在文件时不移动
+        """
+        src = join(dir_path, *(path.split('/')[1:]))
+        dst = join(dir_path, *(new_path.split('/')[1:]))
+        if exists(dst):
+            print(f'无法移动：{src}，目标路径{dst}已经存在文件')
+            return False
+        os.makedirs(dirname(dst), exist_ok=True)
+        os.rename(src, dst)
+        return True
+
+    def _detect_moved_records(
+            self,
+            dir_path: str,
+            current_unique: Set[str],
+            db_unique: Set[str],
+            local_records: Dict[str, FileRecord],
+            db_records: Dict[str, FileRecord],
+            confirm_by_md5: bool = None
+    ) -> List[Tuple[FileRecord, FileRecord]]:
+        """
+        检测本地发生的文件移动：按(大小, 修改时间)匹配本地独有与数据库独有的文件记录，
+        再以上次扫描快照中的inode或者md5值确认，每条数据库文件记录最多匹配一个本地文件
+        :param dir_path: 正在操作的目录的物理路径
+        :param current_unique: 本地独有的路径集合
+        :param db_unique: 数据库独有的路径集合
+        :param local_records: 本地文件记录
+        :param db_records: 数据库文件记录
+        :param confirm_by_md5: 是否计算md5值确认无法通过inode确认的文件，为None时询问
+        :return: 确认移动的(本地文件记录, 数据库文件记录)列表
+        """
+        if len(current_unique) == 0 or len(db_unique) == 0:
+            return []
+        candidates: Dict[Tuple[int, int], List[FileRecord]] = {}
+        for path in sorted(db_unique):
+            record = db_records[path]
+            # 空文件的内容都相同，没有必要匹配
+            if record.size > 0:
+                candidates.setdefault((record.size, record.modified_time), []).append(record)
+        if len(candidates) == 0:
+            return []
+        moves, taken, unconfirmed = [], set(), []
+        for path in sorted(current_unique):
+            local_record = local_records[path]
+            db_candidates = candidates.get((local_record.size, local_record.modified_time))
+            if db_candidates is None:
+                continue
+            for db_record in db_candidates:
+                if self._scan_snapshot.get(db_record.path, [])[:3] == [
+                    local_record.inode, local_record.size, local_record.modified_time
+                ] and db_record.path not in taken:
+                    taken.add(db_record.path)
+                    moves.append((local_record, db_record))
+                    break
+            else:
+                unconfirmed.append((local_record, db_candidates))
+        unconfirmed = [
+            (local_record, [each for each in db_candidates if each.md5 != FileRecord.EMPTY_MD5])
+            for local_record, db_candidates in unconfirmed
+        ]
+        unconfirmed = [each for each in unconfirmed if len(each[1]) > 0]
+        if len(unconfirmed) > 0 and confirm_by_md5 is not False and (confirm_by_md5 or self.input_query(
+                f'有{len(unconfirmed)}个本地独有的文件'
+                f'共{self.human_readable_size(sum(each.size for each, _ in unconfirmed))}'
+                f'与数据库中缺失的文件记录大小和修改时间相同，可能是被移动的文件，是否计算它们的md5值以确认？'
+        )):
+            for local_record, db_candidates in tqdm(unconfirmed, desc='计算本地文件md5值'):
+                md5 = local_record.compute_md5()
+                for db_record in db_candidates:
+                    if db_record.md5 == md5 and db_record.path not in taken:
+                        taken.add(db_record.path)
+                        moves.append((local_record, db_record))
+                        break
+        return moves
+
+    def _moved_records_action(self, moves: List[Tuple[FileRecord, FileRecord]]) -> List[Tuple[str, str]]:
+        """
+        确认被移动的文件记录的动作，在一个事务中批量修改数据库中这些文件记录的路径
+        :param moves: (本地文件记录, 数据库文件记录)列表
+        :return: 已经修改的(本地路径, 数据库原路径)列表
+        """
+        if len(moves) == 0:
+            return []
+        moves = sorted(moves, key=lambda x: x[0].path)
+        moved = []
+
+        def action_a():
+            updated = self.transaction(
+                self.db.move_file_records, moves=[(db_record, local_record.path) for local_record, db_record in moves]
+            )
+            for local_record, db_record in moves:
+                local_record.file_id = db_record.file_id
+                moved.append((local_record.path, db_record.path))
+            print(f'更新了{updated}条数据库记录')
+            return True
+
+        def action_ls(inputs):
+            self.cmd_ls(inputs, [f'{db_record.path} -> {local_record.path}' for local_record, db_record in moves])
+            return False
+
+        self.query_actions(
+            f'有{len(moves)}个文件被确认在本地移动了位置，请问需要作何处理？',
+            {
+                'a': ('将数据库中这些文件记录的路径修改为本地的路径，其他物理位置之后可以重放这些移动', action_a),
+            },
+            {
+                'ls': ('[写入文件路径（可选）]', '列出这些文件移动前后的路径 [写入指定的文件中]', action_ls)
+            }
+        )
+        return moved
+
+    @classmethod
+    def _snapshot_path(cls, dir_path: str) -> str:
+        return join(dir_path, '.lyl232fm', cls.SCAN_SNAPSHOT)
+
+    @classmethod
+    def _load_scan_snapshot(cls, dir_path: str) -> Dict[str, list]:
+        """
+        将上次管理时保存的本地扫描快照整个读入内存
+        :param dir_path: 正在操作的目录的物理路径
+        :return: [相对路径] -> [inode, 大小, 修改时间, md5值或者None]，快照不存在或者无法读取时为空
+        """
+        return load_snapshot(cls._snapshot_path(dir_path))
+
+    def _save_scan_snapshot(self, dir_path: str, local_records: List[FileRecord]):
+        """
+        保存本地扫描快照：流式比较时没有构造文件记录的文件的快照项，与本地文件记录、之后校验过的文件的快照项按路径归并后写入，
+        先写入临时文件再替换，中断时不会留下不完整的快照
+        :param dir_path: 正在操作的目录的物理路径
+        :param local_records: 本地文件记录
+        :return: None
+        """
+        updates = self._snapshot_updates
+        for record in local_records:
+            if record.inode is not None:
+                # 没有在本次计算md5值的文件沿用快照中已知的md5值
+                updates.append((record.path, [
+                    record.inode, record.size, record.modified_time,
+                    self._snapshot_md5(record) if record.md5 == FileRecord.EMPTY_MD5 else record.md5
+                ]))
+        for path, entry in self._verified_snapshot.items():
+            updates.append((path, entry))
+        write_snapshot(self._snapshot_path(dir_path), merge_snapshots(
+            self._unchanged_snapshot, external_sort(updates, key=lambda item: item[0])
+        ))
+
+    def _snapshot_md5(self, record: FileRecord) -> Union[str, None]:
+        """
+        从扫描快照中读取本地文件已知的md5值，只有inode、大小和修改时间都没有改变时才有效
+        :param record: 本地文件记录
+        :return: md5值，未知时为None
+        """
+        entry = self._scan_snapshot.get(record.path)
+        if entry is None or len(entry) < 4 or entry[:3] != [record.inode, record.size, record.modified_time]:
+            return None
+        return entry[3]
+
+    def _stream_local_and_db_records(self, dir_path: str, dir_id: int) -> Tuple[List[FileRecord], List[FileRecord], int]:
+        """
+        将按路径排序的本地扫描、上次的扫描快照与按路径排序的数据库记录归并，大小和修改时间都与数据库记录相同、
+        而且数据库中有md5值的文件（通常是绝大多数）不构造文件记录，它们的快照项按顺序写入临时文件，
+        扫描快照中没有md5值的这类文件也写入临时文件，在询问是否校验md5值时再读出；
+        其他的文件记录交给_compare_local_records_to_db_records处理，内存占用只与这些文件的数量有关
+        :param dir_path: 正在操作的目录的物理路径
+        :param dir_id: 目录id
+        :return: (需要处理的本地文件记录, 需要处理的数据库文件记录, 数据库中的文件记录数)
+        """
+        local_rows, db_records, db_count = [], [], 0
+        snapshot = SnapshotLookup(read_snapshot(self._snapshot_path(dir_path)))
+        for local, db_record in tqdm(
+                merge_diff(scan_sorted(dir_path), self.db.iterate_file_records_by_path(dir_id)), desc='比较本地文件'
+        ):
+            path = local[0] if local is not None else db_record.path
+            entry = snapshot.get(path)
+            if db_record is not None:
+                db_count += 1
+            if local is not None and db_record is not None and db_record.md5 != FileRecord.EMPTY_MD5 and \
+                    (local[1], local[2]) == (db_record.size, db_record.modified_time):
+                _, size, modified_time, inode = local
+                md5 = entry[3] if entry is not None and len(entry) >= 4 and \
+                    entry[:3] == [inode, size, modified_time] else None
+                if md5 is None or md5 == db_record.md5:
+                    self._unchanged_snapshot.append((path, [inode, size, modified_time, md5]))
+                    if md5 is None:
+                        self._streamed_uncached.append(
+                            (db_record.file_id, path, inode, size, modified_time, db_record.md5)
+                        )
+                        self._streamed_uncached_size += size
+                    continue
+            if entry is not None:
+                self._scan_snapshot[path] = entry
+            if local is not None:
+                local_rows.append(local)
+            if db_record is not None:
+                db_records.append(db_record)
+        return FileRecord.from_scan_rows(dir_path, local_rows), db_records, db_count
+
+    def _verify_streamed_matches(self, dir_path: str) -> Dict[str, Tuple[FileRecord, FileRecord]]:
+        """
+        按路径顺序计算流式比较时没有构造文件记录的本地文件的md5值，写入扫描快照，只为md5值不同的文件读取数据库记录
+        :param dir_path: 正在操作的目录的物理路径
+        :return: 与数据库中的md5值不同的(本地文件记录, 数据库文件记录)
+        """
+        # [文件id] -> md5值不同的本地文件记录
+        conflicts: Dict[int, FileRecord] = {}
+        with tqdm(total=self._streamed_uncached_size, unit='B', unit_scale=True, desc='计算本地文件md5值') as bar:
+            for file_id, path, inode, size, modified_time, db_md5 in self._streamed_uncached:
+                local_record = FileRecord(
+                    path=path, size=size, modified_time=modified_time, md5='', dir_physical_path=dir_path, inode=inode
+                )
+                md5 = local_record.compute_md5()
+                bar.update(size)
+                self._snapshot_updates.append((path, [inode, size, modified_time, md5]))
+                if md5 != db_md5:
+                    local_record.file_id = file_id
+                    conflicts[file_id] = local_record
+        res = {}
+        for file_id, db_record in self.db.query_file_by_id(list(conflicts.keys())).items():
+            db_record.dir_physical_path = dir_path
+            res[db_record.path] = (conflicts[file_id], db_record)
+        self._streamed_conflicts.update(res)
+        self._streamed_uncached.close()
+        self._streamed_uncached_size = 0
+        return res
+
     def _unique_local_records_action(
             self,
             dir_path: str,
@@ -430,24 +1062,69 @@ class ManageDirectoryScript(FileMD5ComputingScript):
             self, dir_path: str, dir_id: int, records: List[FileRecord]
     ) -> Tuple[Dict[str, str], Set[str]]:
         """
-        在其他的管理记录中找到有效的指定文件记录的备份
+        在本机所有受管理的物理位置中找到指定文件记录的有效备份：同目录其他物理位置下相同路径的文件，
+        以及数据库中任意目录下大小和md5值都相同的文件记录对应的文件。候选的备份一次性从数据库中批量查出，
+        优先选择读取较快而且与正在操作的目录不在同一设备上的备份。候选按其物理位置所在设备的优先级排序，
+        找到第一个存在的就停止，相同内容的候选只查找一次
         :param dir_path: 正在操作的目录路径
         :param dir_id: 目录id
         :param records: 需要操作的文件记录列表
         :return: ([本地路径->其他有效备份的路径], {找不到的路径})
         """
-        other_dir_paths = self._get_valid_management_paths(dir_id, except_path=dir_path)
+        # [目录id] -> 本机上存在的物理路径
+        mounted_paths = {dir_id: self._get_valid_management_paths(dir_id, except_path=dir_path)}
+        for management in self.db.all_managements():
+            if management.dir_id == dir_id or not management.path or not exists(management.path):
+                continue
+            mounted_paths.setdefault(management.dir_id, []).append(management.path)
+        contents = [(each.size, each.md5) for each in records if each.md5 != FileRecord.EMPTY_MD5]
+        same_content_records = self.db.file_records_by_contents(contents) if len(contents) > 0 else {}
+
+        speed, target_device = DeviceSpeed(), device_of(dir_path)
+        # [物理位置] -> (设备的速度等级, 是否与正在操作的目录在同一设备上)，越小越优先
+        root_keys = {
+            root: (speed.rank(device_of(root)), device_of(root) == target_device)
+            for roots in mounted_paths.values() for root in roots
+        }
+
+        def first_existing(candidates: List[Tuple[int, str]], size: int) -> Tuple[Union[str, None], tuple]:
+            """
+            :param candidates: (目录id, 文件路径)列表，优先级相同时靠前的优先
+            :param size: 文件大小
+            :return: (优先级最高的存在的备份的路径, 其优先级)，都不存在时为(None, None)
+            """
+            options = sorted(
+                (root_keys[root], order, root, path)
+                for order, (candidate_dir_id, path) in enumerate(candidates)
+                for root in mounted_paths.get(candidate_dir_id, [])
+            )
+            for key, _, root, path in options:
+                real_path = join(root, *(path.split('/')[1:]))
+                try:
+                    if os.stat(real_path).st_size == size:
+                        return real_path, key
+                except OSError:
+                    continue
+            return None, None
 
+        # [(size, md5)] -> 相同内容的候选中找到的备份
+        content_found: Dict[Tuple[int, str], Tuple[Union[str, None], tuple]] = {}
         found_file_paths, not_found_paths = {}, set()
-        # 尝试寻找所有的文件路径
         for record in records:
-            path = record.path
-            found = self._find_single_file_in_managements(record, other_dir_paths)
-            local_real_path = join(dir_path, *(path.split('/')[1:]))
+            content = (record.size, record.md5)
+            if content not in content_found:
+                content_found[content] = first_existing(list(dict.fromkeys(
+                    (each.directory_id, each.path) for each in same_content_records.get(content, [])
+                )), record.size)
+            found, found_key = content_found[content]
+            # 同目录相同路径的备份在优先级不低于相同内容的备份时优先使用
+            same_path, same_path_key = first_existing([(dir_id, record.path)], record.size)
+            if same_path is not None and (found_key is None or same_path_key <= found_key):
+                found = same_path
             if found is None:
-                not_found_paths.add(path)
+                not_found_paths.add(record.path)
             else:
-                found_file_paths[local_real_path] = found
+                found_file_paths[join(dir_path, *(record.path.split('/')[1:]))] = found
         return found_file_paths, not_found_paths
 
     def _unique_db_records_copy_from_others(
@@ -460,22 +1137,10 @@ class ManageDirectoryScript(FileMD5ComputingScript):
         :param records: 需要处理的文件记录
         :return: 没法找到物理位置的文件记录
         """
-        other_dir_paths = []
-        not_exist_path_tags = []
-        # 这里假设其他物理位置下的路径的文件都是与数据库一致的
-        for tag, path in self.db.managements(dir_id):
-            if not exists(path):
-                not_exist_path_tags.append(tag)
-                continue
-            if samefile(path, dir_path):
-                continue
-            other_dir_paths.append(path)
-        if len(not_exist_path_tags):
-            self.transaction(self.db.reset_management_path, tags=not_exist_path_tags)
-
         found_file_paths, not_found_paths = self._find_file_in_other_managements(
             dir_path, dir_id, records
         )
+        local_path2record = {join(dir_path, *(each.path.split('/')[1:])): each for each in records}
 
         if len(found_file_paths) > 0:
             local_paths = sorted(list(found_file_paths.keys()))
@@ -483,15 +1148,26 @@ class ManageDirectoryScript(FileMD5ComputingScript):
                 real_path = found_file_paths[local_real_path]
                 print(f'{real_path} -> {local_real_path}')
             if self.input_query('将执行上述文件的复制，是否继续？'):
-                total = len(found_file_paths)
-                for local_real_path, real_path in tqdm(
-                        found_file_paths.items(), total=total, desc='复制文件', disable=total < 3
-                ):
+                for local_real_path in local_paths:
                     assert not exists(local_real_path), \
                         CodingError(f'复制文件的目标路径不应该存在文件：{local_real_path}，'
                                     f'请检查是否是由于Windows默认路径不区分大小写造成的')
-                    os.makedirs(os.path.dirname(local_real_path), exist_ok=True)
-                    shutil.copy2(real_path, local_real_path)
+                target_device = device_of(dir_path)
+                same_device = sum(device_of(each) == target_device for each in found_file_paths.values())
+                hardlink = same_device > 0 and self.input_query(
+                    f'有{same_device}个文件的来源与本地目录在同一设备上，是否使用硬链接代替复制？'
+                    f'（硬链接的文件与来源是同一个文件，修改其中一个另一个也会改变）'
+                )
+                # 有md5记录的文件在复制的同时校验
+                self._copy_files(
+                    dir_path,
+                    [(found_file_paths[local_real_path], local_real_path) for local_real_path in local_paths],
+                    {
+                        local_real_path: local_path2record[local_real_path].md5 for local_real_path in local_paths
+                        if local_path2record[local_real_path].md5 != FileRecord.EMPTY_MD5
+                    },
+                    hardlink
+                )
         if len(not_found_paths) > 0:
             for each in not_found_paths:
                 print(each)
@@ -501,6 +1177,81 @@ class ManageDirectoryScript(FileMD5ComputingScript):
                 '或者接入有相关文件记录的设备并重新使用本程序管理'
             )
 
+    def _copy_files(
+            self, dir_path: str, pairs: List[Tuple[str, str]], md5s: Dict[str, str], hardlink: bool,
+            overwrite: Set[str] = None
+    ):
+        """
+        将文件复制到本地目录下，复制前先在复制日志中记录计划，全部完成后才删除日志，中断后可以继续
+        :param dir_path: 正在操作的目录的物理路径
+        :param pairs: (源文件路径, 本地目标文件路径)列表
+        :param md5s: [本地目标文件路径] -> 期望的md5值，这些文件在复制的同时校验
+        :param hardlink: 是否优先使用硬链接
+        :param overwrite: 复制成功后替换已有本地文件的目标文件路径
+        :return: None
+        """
+        journal = CopyJournal(join(dir_path, '.lyl232fm', self.COPY_JOURNAL))
+        journal.plan(pairs, md5s, overwrite)
+        engine = CopyEngine(
+            hardlink=hardlink,
+            quarantine=lambda path: join(dir_path, '.lyl232fm', self.QUARANTINE_DIR, os.path.relpath(path, dir_path)),
+            journal=journal
+        )
+        try:
+            failed = engine.copy(pairs, md5s=md5s, overwrite=overwrite)
+        finally:
+            journal.close()
+        sources = dict((dst, src) for src, dst in pairs)
+        for local_real_path, e in failed.items():
+            print(f'无法复制：{sources[local_real_path]} -> {local_real_path}，原因是：{e}')
+        for local_real_path, md5 in engine.verified.items():
+            stat = os.stat(local_real_path)
+            path = '/' + os.path.relpath(local_real_path, dir_path).replace(os.sep, '/')
+            self._verified_snapshot[path] = [
+                stat.st_ino, stat.st_size, FileRecord.modified_timestamp(stat.st_mtime), md5
+            ]
+        if len(engine.quarantined) > 0:
+            for local_real_path, quarantine_path in engine.quarantined.items():
+                print(f'{sources[local_real_path]} -> {quarantine_path}')
+            print(
+                f'【注意！】：上述{len(engine.quarantined)}个文件复制后的md5值与数据库中的记录不一致，'
+                f'来源的文件可能已经损坏，复制的结果已被隔离到上述路径'
+            )
+        if engine.methods.get(REFLINKED, 0) + engine.methods.get(HARDLINKED, 0) > 0:
+            print(
+                f'复制了{engine.methods.get(COPIED, 0)}个文件，'
+                f'reflink了{engine.methods.get(REFLINKED, 0)}个文件，'
+                f'硬链接了{engine.methods.get(HARDLINKED, 0)}个文件'
+            )
+        if len(failed) == len(engine.quarantined):
+            # 除了被隔离的文件都已经复制完成，隔离的文件重试也无法通过校验
+            journal.remove()
+        else:
+            print(f'复制日志保存在{journal.path}，下次管理该目录时可以重试失败的复制')
+
+    def _resume_copy_journal(self, dir_path: str):
+        """
+        继续上次中断的复制，直接使用复制日志中记录的来源，不需要重新比较
+        :param dir_path: 正在操作的目录的物理路径
+        :return: None
+        """
+        journal = CopyJournal(join(dir_path, '.lyl232fm', self.COPY_JOURNAL))
+        pairs, md5s, errors, overwrite = journal.pending()
+        if not exists(journal.path):
+            return
+        if len(pairs) == 0:
+            journal.remove()
+            return
+        for src, dst in pairs:
+            print(f'{src} -> {dst}' + (f'\t上次失败的原因：{errors[dst]}' if dst in errors else ''))
+        if not self.input_query(f'上次的复制中断了，还有上述{len(pairs)}个文件没有完成复制，是否继续？'):
+            if self.input_query('是否放弃这些复制（删除复制日志）？'):
+                journal.remove()
+            return
+        # 以剩余的复制重新开始一份日志
+        journal.remove()
+        self._copy_files(dir_path, pairs, md5s, hardlink=False, overwrite=overwrite)
+
     def _common_path_records_action(
             self,
             dir_path: str,
@@ -518,7 +1269,7 @@ class ManageDirectoryScript(FileMD5ComputingScript):
         :param db_records: 数据库中的文件记录
         :return: 如果删除了本地文件，则返回这些被删除的文件记录
         """
-        if len(common_path) == 0:
+        if len(common_path) == 0 and len(self._streamed_uncached) == 0:
             return []
 
         conflict, match_with_md5, match_wo_md5 = {}, {}, {}
@@ -537,7 +1288,7 @@ class ManageDirectoryScript(FileMD5ComputingScript):
                 conflict[path] = record_pair
 
         self._common_path_match_without_db_md5_action(match_wo_md5)
-        conflict.update(self._common_path_match_with_db_md5_action(match_with_md5))
+        conflict.update(self._common_path_match_with_db_md5_action(match_with_md5, dir_path))
 
         return self._common_path_conflict_action(dir_path, dir_id, conflict)
 
@@ -672,8 +1423,11 @@ class ManageDirectoryScript(FileMD5ComputingScript):
                         f'将删除：{file_real_path}，并复制{file_other_real_path}到被删除文件的位置，是否继续？'
                 ):
                     return False
-                os.remove(file_real_path)
-                shutil.copy2(file_other_real_path, file_real_path)
+                if os.path.getsize(file_other_real_path) >= DELTA_COPY_SIZE:
+                    self._delta_copy_conflict(file_other_real_path, file_real_path, db_record)
+                else:
+                    # 复制完成后才原子地替换本地文件，复制中断时本地文件保持不变
+                    copy_file(file_other_real_path, file_real_path, overwrite=True)
             else:
                 self.remove_single_file(file_real_path)
             return True
@@ -695,6 +1449,43 @@ class ManageDirectoryScript(FileMD5ComputingScript):
 
         return abort, deleted_local_record
 
+    def _delta_copy_conflict(self, src: str, local_path: str, db_record: FileRecord):
+        """
+        以增量复制的方式用其他物理位置的文件替换本地的冲突文件：本地文件中相同的块直接复用，只写入不同的部分，
+        重建的文件先写入临时文件，与数据库的md5值一致（如果有）后才替换本地文件。
+        两个文件差别太大时增量复制会很慢，此时改为直接复制
+        :param src: 其他物理位置的文件路径
+        :param local_path: 本地冲突文件的路径
+        :param db_record: 数据库中的文件记录
+        :return: None
+        """
+        tmp_path = temp_path_of(local_path)
+        if exists(tmp_path):
+            os.remove(tmp_path)
+        size = os.path.getsize(src)
+        with tqdm(total=size, desc='增量复制', unit='B', unit_scale=True, unit_divisor=1024) as bar:
+            res = delta_copy(src, local_path, tmp_path, bar.update)
+        if res is None:
+            print('本地文件与来源的差别太大，改为直接复制')
+            md5 = None if db_record.md5 == FileRecord.EMPTY_MD5 else db_record.md5
+            try:
+                with tqdm(total=size, desc='复制文件', unit='B', unit_scale=True, unit_divisor=1024) as bar:
+                    copy_file(src, local_path, bar.update, md5=md5, overwrite=True)
+            except DataError:
+                os.remove(tmp_path)
+                print(f'【注意！】：{src}的md5值与数据库中的记录{db_record.md5}不一致，没有替换本地文件')
+            return
+        literal_size, md5 = res
+        if db_record.md5 != FileRecord.EMPTY_MD5 and md5 != db_record.md5:
+            os.remove(tmp_path)
+            print(f'【注意！】：{src}的md5值为{md5}，与数据库中的记录{db_record.md5}不一致，没有替换本地文件')
+            return
+        os.replace(tmp_path, local_path)
+        print(
+            f'增量复制完成，共{self.human_readable_size(size)}，'
+            f'其中{self.human_readable_size(literal_size)}与本地文件不同'
+        )
+
     def _common_path_match_without_db_md5_action(
             self,
             path2records: Dict[str, Tuple[FileRecord, FileRecord]]
@@ -721,27 +1512,43 @@ class ManageDirectoryScript(FileMD5ComputingScript):
 
     def _common_path_match_with_db_md5_action(
             self,
-            path2records: Dict[str, Tuple[FileRecord, FileRecord]]
+            path2records: Dict[str, Tuple[FileRecord, FileRecord]],
+            dir_path: str = None
     ) -> Dict[str, Tuple[FileRecord, FileRecord]]:
         """
         对于当前文件与数据库文件中大小，修改日期都匹配的文件记录且数据库对应记录有md5记录的动作
         :param path2records: 路径到文件记录的映射
+        :param dir_path: 当前操作的目录路径，用于校验流式比较时没有构造文件记录的文件
         :return: 通过计算md5确认与数据库中的不同的文件记录
         """
-        if len(path2records) == 0:
-            return {}
-        total_size = sum(each[0].size for each in path2records.values())
-        if not self.input_query(
-                f'有{len(path2records)}个文件共{self.human_readable_size(total_size)}与数据库中记录相匹配，'
-                f'且数据库中有md5记录，是否计算本地文件的md5以确认是否相同？'
-        ):
+        streamed = len(self._streamed_uncached) if dir_path is not None else 0
+        if len(path2records) == 0 and streamed == 0:
             return {}
         res = {}
-        # 计算本地文件的md5值并比较
-        for path, (local_record, db_record) in tqdm(path2records.items(), desc='计算本地文件md5值'):
-            md5 = local_record.compute_md5()
+        # 扫描快照中已知md5值（例如复制时校验过）的文件不需要重新读取
+        uncached = {}
+        for path, (local_record, db_record) in path2records.items():
+            md5 = self._snapshot_md5(local_record)
+            if md5 is None:
+                uncached[path] = (local_record, db_record)
+                continue
+            local_record.md5 = md5
             if md5 != db_record.md5:
                 res[path] = (local_record, db_record)
+        total_size = sum(each[0].size for each in uncached.values())
+        if streamed > 0:
+            total_size += self._streamed_uncached_size
+        if len(uncached) + streamed > 0 and self.input_query(
+                f'有{len(uncached) + streamed}个文件共{self.human_readable_size(total_size)}与数据库中记录相匹配，'
+                f'且数据库中有md5记录，是否计算本地文件的md5以确认是否相同？'
+        ):
+            # 计算本地文件的md5值并比较
+            for path, (local_record, db_record) in tqdm(uncached.items(), desc='计算本地文件md5值'):
+                md5 = local_record.compute_md5()
+                if md5 != db_record.md5:
+                    res[path] = (local_record, db_record)
+            if streamed > 0:
+                res.update(self._verify_streamed_matches(dir_path))
         print(f'通过比较md5值，共发现{len(res)}个文件的md5值与数据库中的相应记录不同')
         return res
 
@@ -780,113 +1587,311 @@ class CancelManagementScript(SingleTransactionScript):
 
 
 class QueryFileRecordScript(DataBaseScript):
-    def __call__(self, name: str = None, write_path: str = None, *args) -> int:
+    def __call__(self, name: str = None, write_path: str = None, sub_path: str = '/', *args) -> int:
         """
         查询所有被管理的目录的脚本
         :param name: 目录名字，如果为空，则从当前目录下的.lyl232fm的信息获取
+        :param write_path: 输出文件路径
+        :param sub_path: 只查询该子目录下的文件记录
         :param args: 其他参数，应为空
         :return: 0表示执行正常
         """
         self.check_empty_args(*args)
         self.init_db_if_needed()
         dir_id = self.get_directory_id_by_name_or_local(name)
-        outputs = self.file_record_output_lines(self.db.file_records(dir_id))
+        outputs = self.file_record_output_lines(self.db.file_records(dir_id, FileRecord.format_dir_path(sub_path)))
         self.write_or_output_lines_to_file(outputs, write_path)
         return 0
 
 
 class DumpDatabaseScript(DataBaseScript):
+    FILE_COLUMNS = ['id', 'dir_path', 'name', 'suffix', 'md5', 'size', 'dir_id', 'modified_timestamp']
+    FILE_FORMATS = ('csv', 'binary')
+
     def __call__(self, out_dir: str, *args):
-        self.check_empty_args(*args)
+        """
+        流式地将数据库中的记录导出到指定目录
+        :param out_dir: 输出目录，必须不存在
+        :param args: 可选的compress:压缩方式，压缩方式为gzip（默认）、lzma、zstd或none；
+            可选的format:文件记录的导出格式，格式为csv（默认）或binary；
+            可选的since:之前导出的目录，只导出该次导出之后修改和删除的文件记录
+        :return: None
+        """
+        options = {'compress': DEFAULT_COMPRESSION, 'format': 'csv', 'since': None}
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            assert sep == ':' and key in options, ArgumentError(f'无法识别的参数：{arg}')
+            options[key] = value.strip()
+        compression, file_format = options['compress'], options['format']
+        assert compression in COMPRESSIONS, ArgumentError(
+            f'不支持的压缩方式：{compression}，可选的压缩方式有：{list(COMPRESSIONS.keys())}')
+        assert file_format in self.FILE_FORMATS, ArgumentError(
+            f'不支持的导出格式：{file_format}，可选的导出格式有：{list(self.FILE_FORMATS)}')
+        since = None
+        if options['since'] is not None:
+            snapshot = load_header(options['since'])
+            assert snapshot is not None and 'change_seq' in snapshot, OperationError(
+                f'{options["since"]}不是可以作为增量导出起点的导出数据')
+            since = snapshot['change_seq']
+        self.init_db_if_needed()
         assert not exists(out_dir), OperationError(f'输出目录{out_dir}必须为空。')
         os.makedirs(out_dir)
-        self.write_csv(
-            join(out_dir, 'directory.csv'),
-            [(record.dir_id, record.name, record.desc) for record in self.db.directories()],
-            headers=['id', 'name', 'des']
-        )
-        self.write_csv(
-            join(out_dir, 'management.csv'),
-            [
-                (
-                    record.tag,
-                    record.path.replace('\\', '/'),  # 将反斜杠换成正斜杠
-                    record.dir_id
+        try:
+            # 之后的读取都在同一个事务的一致性快照中进行，快照包含且仅包含修改序号不大于change_seq的修改
+            change_seq = self.db.change_seq()
+            tables = {
+                'directory': self._dump_table(
+                    out_dir, 'directory', ['id', 'name', 'des'], compression,
+                    ((record.dir_id, record.name, record.desc) for record in self.db.directories())
+                ),
+                'management': self._dump_table(
+                    out_dir, 'management', ['tag', 'path', 'dir_id'], compression,
+                    (
+                        # 将反斜杠换成正斜杠
+                        (record.tag, record.path.replace('\\', '/'), record.dir_id)
+                        for record in self.db.all_managements()
+                    )
+                ),
+            }
+            if since is not None:
+                tables['file_tombstone'] = self._dump_table(
+                    out_dir, 'file_tombstone', ['file_id'], compression,
+                    ((file_id,) for file_id in self.db.deleted_file_ids(since))
                 )
-                for record in self.db.all_managements()
-            ],
-            headers=['tag', 'path', 'dir_id']
-        )
-        self.write_csv(
-            join(out_dir, 'file.csv'),
-            [
-                (
-                    record.file_id, record.dir_path, record.name,
-                    record.suffix, record.md5, record.size,
-                    record.directory_id, record.modified_time
+                file_count = None
+            else:
+                file_count = sum(each.file_count for each in self.db.directory_statistics().values())
+            if file_format == 'binary':
+                with FileColumnWriter(out_dir, self.db.all_dir_paths(), compression) as writer:
+                    for row in tqdm(
+                            self.db.iterate_file_rows(resolve_dir_path=False, since=since),
+                            desc='导出文件记录', total=file_count
+                    ):
+                        writer.write_row(row)
+                tables['file'] = writer.header()
+            else:
+                tables['file'] = self._dump_table(
+                    out_dir, 'file', self.FILE_COLUMNS, compression,
+                    tqdm(self.db.iterate_file_rows(since=since), desc='导出文件记录', total=file_count)
                 )
-                for record in self.db.all_files()
-            ],
-            headers=['id', 'dir_path', 'name', 'suffix', 'md5', 'size', 'dir_id', 'modified_timestamp']
-        )
-        print(f'数据已写入{out_dir}')
+        except BaseException as e:
+            remove_dump(out_dir)
+            raise e
+        write_header(out_dir, SCHEMA_VERSION, compression, tables, change_seq=change_seq, base_change_seq=since)
+        if since is None:
+            print(f'数据已写入{out_dir}')
+        else:
+            print(
+                f'增量数据已写入{out_dir}：修改了{tables["file"]["rows"]}条文件记录，'
+                f'删除了{tables["file_tombstone"]["rows"]}条文件记录'
+            )
+
+    @staticmethod
+    def _dump_table(out_dir: str, table: str, columns: List[str], compression: str, rows) -> dict:
+        """
+        导出一张表
+        :param out_dir: 输出目录
+        :param table: 表名
+        :param columns: 列名
+        :param compression: 压缩方式
+        :param rows: 可迭代的行数据
+        :return: 该表在header.json中的描述
+        """
+        with TableWriter(out_dir, table, columns, compression) as writer:
+            for row in rows:
+                writer.write_row(row)
+        return writer.header()
 
 
 class QueryRedundantFileScript(FileMD5ComputingScript):
+    # 每次从数据库中读取多少组重复的内容
+    CONTENT_PAGE_SIZE = 1000
+    # 自动选择保留的文件记录的规则，按指定的顺序比较
+    KEEP_RULES = {
+        # prefer=目录名：保留指定目录中的文件记录，可以指定多次，越靠前越优先
+        'prefer': '保留指定目录中的文件记录',
+        'shortest': '保留路径最短的文件记录',
+        'oldest': '保留修改时间最早的文件记录',
+        'newest': '保留修改时间最晚的文件记录',
+        # 不同目录中的重复都保留，只删除同一目录中的重复
+        'per_dir': '每个目录保留一条文件记录',
+    }
+
     def __call__(self, *args):
-        self.check_empty_args(*args)
-        self._process_common_size_file_ids(self.db.query_common_size_wo_md5_files())
-        self._process_common_size_md5_file_ids(self.db.query_common_md5_files())
+        """
+        查询重复的文件记录
+        :param args: 可选的若干个keep:规则，按规则在所有重复的组中自动选择保留的文件记录，不再逐组询问，
+            规则见KEEP_RULES，例如keep:prefer=相册 keep:shortest；
+            指定规则时默认只输出报告，加上apply才会在一个事务中删除选出的文件记录；
+            可选的out:文件路径，将会被删除的文件记录写入该文件
+        :return: 0表示正常
+        """
+        rules, prefer_dirs, apply, out_path = [], [], False, None
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            if arg == 'apply':
+                apply = True
+            elif sep == ':' and key == 'out':
+                out_path = value.strip()
+            elif sep == ':' and key == 'keep':
+                rule, _, rule_value = value.strip().partition('=')
+                assert rule in self.KEEP_RULES, ArgumentError(
+                    f'无法识别的规则：{rule}，可选的规则有：{list(self.KEEP_RULES.keys())}')
+                if rule == 'prefer':
+                    assert len(rule_value) > 0, ArgumentError('prefer规则需要指定目录名：keep:prefer=目录名')
+                    prefer_dirs.append(rule_value)
+                if rule not in rules:
+                    rules.append(rule)
+            else:
+                raise ArgumentError(f'无法识别的参数：{arg}')
+        assert len(rules) > 0 or (not apply and out_path is None), ArgumentError('apply和out:需要与keep:规则一起使用')
+        self.init_db_if_needed()
+        self._directory_names = {}
+        if len(rules) > 0:
+            self._resolve_by_rules(rules, prefer_dirs, apply, out_path)
+            return 0
+        self._process_common_size_file_ids()
+        self._process_common_size_md5_file_ids()
+        return 0
 
-    def _process_common_size_file_ids(
-            self,
-            size2file_ids: Dict[int, List[int]]
-    ):
+    def _resolve_by_rules(self, rules: List[str], prefer_dirs: List[str], apply: bool, out_path: str = None):
         """
-        拥有相同路径的本地文件记录与数据库文件记录相冲突的文件记录对
-        :param size2file_ids: 大小到文件id的映射
-        :return: size_md5_to_file_record 拥有相同大小和md5值的文件记录
+        在内存中按规则为所有大小和md5值相同的组选择保留的文件记录，每组至少保留一条，所以删除是安全的，
+        选出的文件记录在一个事务中批量删除
+        :param rules: 规则列表，按顺序比较
+        :param prefer_dirs: prefer规则的目录名字，越靠前越优先
+        :param apply: 是否执行删除，否则只输出报告
+        :param out_path: 将会被删除的文件记录写入该文件，为None时不写入
+        :return: None
+        """
+        dir_ids = {}
+        for name in prefer_dirs:
+            dir_id = self.db.directory_id(name)
+            assert dir_id is not None, OperationError(f'目录名字{name}不存在于数据库中')
+            dir_ids.setdefault(dir_id, len(dir_ids))
+        # 每条文件记录对应的文件在该目录的每个管理记录的物理位置下都有一份
+        management_counts = {}
+        for management in self.db.all_managements():
+            management_counts[management.dir_id] = management_counts.get(management.dir_id, 0) + 1
+
+        def keep_key(record: FileRecord) -> tuple:
+            key = []
+            for rule in rules:
+                if rule == 'prefer':
+                    key.append(dir_ids.get(record.directory_id, len(dir_ids)))
+                elif rule == 'shortest':
+                    key.append(len(record.path))
+                elif rule == 'oldest':
+                    key.append(record.modified_time)
+                elif rule == 'newest':
+                    key.append(-record.modified_time)
+            # 最后以目录和路径决定，使结果是确定的
+            key.append(self._record_hint(record))
+            return tuple(key)
+
+        to_delete, outputs = [], []
+        # [目录id] -> (删除的文件记录数, 删除的字节数)
+        dir_stats: Dict[int, Tuple[int, int]] = {}
+        groups = 0
+        for size, md5, records in tqdm(
+                self._duplicate_groups(hashed=True), desc='选择保留的文件记录',
+                total=self.db.duplicate_content_count(hashed=True)
+        ):
+            groups += 1
+            if 'per_dir' in rules:
+                partitions = {}
+                for record in records:
+                    partitions.setdefault(record.directory_id, []).append(record)
+                partitions = list(partitions.values())
+            else:
+                partitions = [records]
+            for partition in partitions:
+                if len(partition) < 2:
+                    continue
+                partition.sort(key=keep_key)
+                outputs.append(f'大小: {self.human_readable_size(size)}，md5：{md5}，保留：{self._record_hint(partition[0])}')
+                for record in partition[1:]:
+                    to_delete.append(record.file_id)
+                    outputs.append(f'\t删除：{self._record_hint(record)}')
+                    count, total = dir_stats.get(record.directory_id, (0, 0))
+                    dir_stats[record.directory_id] = (count + 1, total + size)
+
+        total_size = sum(total for _, total in dir_stats.values())
+        physical_size = sum(total * management_counts.get(dir_id, 0) for dir_id, (_, total) in dir_stats.items())
+        for dir_id, (count, total) in sorted(dir_stats.items(), key=lambda x: -x[1][1]):
+            print(
+                f'{self._directory_names[dir_id]}\t删除{count}条文件记录\t{self.human_readable_size(total)}\t'
+                f'{management_counts.get(dir_id, 0)}个管理记录'
+            )
+        print(
+            f'共{groups}组重复的文件记录，将删除{len(to_delete)}条文件记录共{self.human_readable_size(total_size)}，'
+            f'在所有的管理记录中可以释放{self.human_readable_size(physical_size)}'
+        )
+        if out_path is not None:
+            self.write_or_output_lines_to_file(outputs, out_path)
+        if not apply:
+            print('以上是按规则选择的结果，没有修改数据库，加上apply参数以执行删除')
+            return
+        if len(to_delete) > 0:
+            deleted = self.transaction(self.db.delete_file_record_by_ids, file_ids=to_delete)
+            print(f'删除了{deleted}条文件记录，请在各个管理记录的物理位置下使用lfm manage删除对应的文件')
+
+    def _duplicate_groups(self, hashed: bool):
+        """
+        按大小从大到小分页读取重复的内容及其文件记录
+        :param hashed: True表示大小和md5值都相同的文件记录，False表示没有md5值且大小相同的文件记录
+        :return: 生成器，每次生成(size, md5, 文件记录列表)
         """
-        if len(size2file_ids) == 0:
+        after = None
+        while True:
+            contents = self.db.duplicate_contents(hashed, self.CONTENT_PAGE_SIZE, after)
+            if len(contents) == 0:
+                return
+            content2ids = self.db.query_file_ids_by_contents([(size, md5) for size, md5, _ in contents])
+            file_records = self.db.query_file_by_id([i for ids in content2ids.values() for i in ids])
+            dir_ids = {record.directory_id for record in file_records.values()} - self._directory_names.keys()
+            if len(dir_ids) > 0:
+                for dir_id, directory in self.db.query_directory_by_id(list(dir_ids)).items():
+                    self._directory_names[dir_id] = directory.name
+            for size, md5, _ in contents:
+                records = [file_records[i] for i in content2ids.get((size, md5), []) if i in file_records]
+                if len(records) > 1:
+                    yield size, md5, records
+            after = contents[-1][:2]
+
+    def _record_hint(self, record: FileRecord) -> str:
+        return f'{self._directory_names[record.directory_id]}:{record.path}'
+
+    def _process_common_size_file_ids(self):
+        """
+        处理至少与其他文件记录拥有相同的大小而且数据库中没有md5值的文件记录
+        :return: None
+        """
+        count = self.db.duplicate_content_count(hashed=False)
+        if count == 0:
             return
-        all_file_ids = []
-        for each in size2file_ids.values():
-            all_file_ids.extend(each)
-        file_records = self.db.query_file_by_id(all_file_ids)
-        all_directory = None
 
         def action_a():
-            dir_id2records = {}  # 根据目录id分类文件记录
-            for record in file_records.values():
-                dir_id = record.directory_id
-                if dir_id not in dir_id2records.keys():
-                    dir_records = dir_id2records[dir_id] = []
-                else:
-                    dir_records = dir_id2records[dir_id]
-                dir_records.append(record)
-
+            valid_paths = {}
             found_records, not_found_records = [], []
-            for dir_id, records in dir_id2records.items():
-                dir_paths = self._get_valid_management_paths(dir_id)
+            for _, _, records in self._duplicate_groups(hashed=False):
                 # 尝试寻找所有的文件路径
                 for record in records:
-                    found = False
-                    for dp in dir_paths:
+                    dir_id = record.directory_id
+                    if dir_id not in valid_paths:
+                        valid_paths[dir_id] = self._get_valid_management_paths(dir_id)
+                    for dp in valid_paths[dir_id]:
                         real_path = join(dp, *(record.path.split('/')[1:]))
                         if exists(real_path):
                             record.dir_physical_path = dp
                             found_records.append(record)
-                            found = True
                             break
-                    if not found:
+                    else:
                         not_found_records.append(record)
 
             if len(not_found_records) > 0:
-                nonlocal all_directory
-                if all_directory is None:
-                    all_directory = self.db.query_directory_by_id(list(dir_id2records.keys()))
                 for record in not_found_records:
-                    print(f'{all_directory[record.directory_id].name}:{record.path}')
+                    print(self._record_hint(record))
                 input('【注意！】上述文件无法找到对应的物理路径，按下回车以继续')
             if len(found_records) > 0:
                 updated = sum(self.file_md5_computing_transactions(found_records, self.db.update_file_records))
@@ -894,130 +1899,583 @@ class QueryRedundantFileScript(FileMD5ComputingScript):
             return True
 
         def action_ls(inputs):
-            nonlocal all_directory
-            if all_directory is None:
-                all_directory_ids = set()
-                for record in file_records.values():
-                    all_directory_ids.add(record.directory_id)
-                all_directory = self.db.query_directory_by_id(list(all_directory_ids))
             outputs = []
-            for size, md5_ids in size2file_ids.items():
+            for size, _, records in self._duplicate_groups(hashed=False):
                 outputs.append(f'大小: {self.human_readable_size(size)}')
-                for file_id in md5_ids:
-                    record = file_records[file_id]
-                    outputs.append(f'{all_directory[record.directory_id].name}:{file_records[file_id].path}')
+                for record in records:
+                    outputs.append(self._record_hint(record))
             self.cmd_ls(inputs, outputs)
             return False
 
         self.query_actions(
-            f'共有{len(size2file_ids)}项文件记录至少与其他文件拥有相同的大小而且数据库中没有md5值。请问需要作何处理？',
+            f'共有{count}组文件记录拥有相同的大小而且数据库中没有md5值。请问需要作何处理？',
             {'a': ('计算md5值之后更新入数据库', action_a), },
             {'ls': ('[写入文件路径（可选）]', '列出这些文件的目录路径和大小 [写入指定的文件中]', action_ls)}
         )
 
-    def _process_common_size_md5_file_ids(
-            self,
-            size_md5_to_file_records: Dict[int, Dict[str, List[int]]]
-    ):
-        if len(size_md5_to_file_records) == 0:
+    def _process_common_size_md5_file_ids(self):
+        """
+        处理至少与其他文件记录拥有相同的大小和md5值的文件记录
+        :return: None
+        """
+        count = self.db.duplicate_content_count(hashed=True)
+        if count == 0:
             return
-        all_file_ids = []
-        for md52ids in size_md5_to_file_records.values():
-            for ids in md52ids.values():
-                all_file_ids.extend(ids)
-        file_records = self.db.query_file_by_id(all_file_ids)
-        all_directory_ids = set()
-        for record in file_records.values():
-            all_directory_ids.add(record.directory_id)
-        all_directory = self.db.query_directory_by_id(list(all_directory_ids))
 
         def action_a():
-            size_list = sorted(size_md5_to_file_records.keys(), reverse=True)
-            for size in size_list:
-                md5_dict = size_md5_to_file_records[size]
-                for md5, _ids in md5_dict.items():
-                    print(f'大小: {self.human_readable_size(size)}，md5：{md5}')
-                    options = []
-                    for file_id in _ids:
-                        _record = file_records[file_id]
-                        options.append((
-                            file_id, f'{all_directory[_record.directory_id].name}:{file_records[file_id].path}'))
-                    options.sort(key=lambda x: x[1])
-                    print('=' * 120)
-                    for i, (_, hint) in enumerate(options):
-                        print(f'【{i}】{hint}')
-                    print('=' * 120)
-                    keep_ids = set()
-                    while True:
-                        keep = input(
-                            '请选择您需要保留的文件记录：输入上述文件记录相应的数字，如果都不保留，输入-1'
-                            '多个选择可用空格分隔，输入"skip"或者"s"可以跳过这次询问，输入abort结束询问：'
-                        ).strip()
-                        try:
-                            if keep == 'abort':
-                                return True
-                            elif keep == 'skip' or keep == 's':
-                                keep_ids = set(list(range(len(_ids))))
-                                break
-                            elif keep == '-1':
-                                break
-                            for each in keep.split(' '):
-                                each = int(each)
-                                assert 0 <= each < len(_ids)
-                                keep_ids.add(each)
+            for size, md5, records in self._duplicate_groups(hashed=True):
+                print(f'大小: {self.human_readable_size(size)}，md5：{md5}')
+                options = [(record, self._record_hint(record)) for record in records]
+                options.sort(key=lambda x: x[1])
+                print('=' * 120)
+                for i, (_, hint) in enumerate(options):
+                    print(f'【{i}】{hint}')
+                print('=' * 120)
+                keep_ids = set()
+                while True:
+                    keep = input(
+                        '请选择您需要保留的文件记录：输入上述文件记录相应的数字，如果都不保留，输入-1'
+                        '多个选择可用空格分隔，输入"skip"或者"s"可以跳过这次询问，输入abort结束询问：'
+                    ).strip()
+                    try:
+                        if keep == 'abort':
+                            return True
+                        elif keep == 'skip' or keep == 's':
+                            keep_ids = set(list(range(len(options))))
                             break
-                        except ValueError:
-                            print(f'无法识别输入：{keep}，请重新输入')
-                        except AssertionError:
-                            print(f'请输入0至{len(_ids) - 1}的整数')
-                    if len(keep_ids) == len(_ids):
-                        continue
-                    to_delete = []
-
-                    print('=' * 120)
-                    for i, (file_id, _) in enumerate(options):
-                        _record = file_records[file_id]
-                        if i not in keep_ids:
-                            to_delete.append(_record)
-                        print(
-                            f'【{i}】{all_directory[_record.directory_id].name}:'
-                            f'{file_records[file_id].path}',
-                            '将被保留' if i in keep_ids else '将被删除'
-                        )
-                    print('=' * 120)
+                        elif keep == '-1':
+                            break
+                        for each in keep.split(' '):
+                            each = int(each)
+                            assert 0 <= each < len(options)
+                            keep_ids.add(each)
+                        break
+                    except ValueError:
+                        print(f'无法识别输入：{keep}，请重新输入')
+                    except AssertionError:
+                        print(f'请输入0至{len(options) - 1}的整数')
+                if len(keep_ids) == len(options):
+                    continue
+                to_delete = []
 
-                    if self.input_query('上述操作将会修改数据库，请确认'):
-                        self._query_safely_delete_file_records(to_delete)
+                print('=' * 120)
+                for i, (record, hint) in enumerate(options):
+                    if i not in keep_ids:
+                        to_delete.append(record)
+                    print(f'【{i}】{hint}', '将被保留' if i in keep_ids else '将被删除')
+                print('=' * 120)
+
+                if self.input_query('上述操作将会修改数据库，请确认'):
+                    self._query_safely_delete_file_records(to_delete)
             return True
 
         def action_ls(inputs):
             outputs = []
-            for size, md5_dict in size_md5_to_file_records.items():
-                for md5, _ids in md5_dict.items():
-                    outputs.append(f'大小: {self.human_readable_size(size)}，md5：{md5}')
-                    for file_id in _ids:
-                        _record = file_records[file_id]
-                        outputs.append(f'{all_directory[_record.directory_id].name}:{file_records[file_id].path}')
+            for size, md5, records in self._duplicate_groups(hashed=True):
+                outputs.append(f'大小: {self.human_readable_size(size)}，md5：{md5}')
+                for record in records:
+                    outputs.append(self._record_hint(record))
             self.cmd_ls(inputs, outputs)
             return False
 
         self.query_actions(
-            f'共有{len(size_md5_to_file_records)}项文件记录至少与其他文件拥有相同的大小和md5值。请问需要作何处理？',
+            f'共有{count}组文件记录拥有相同的大小和md5值。请问需要作何处理？',
             {'a': ('列出相冲突的文件并询问保留哪条冲突的记录', action_a), },
             {'ls': ('[写入文件路径（可选）]', '列出这些文件的目录路径、大小和md5值 [写入指定的文件中]', action_ls)}
         )
 
 
+class QueryRedundantSubtreeScript(DataBaseScript):
+    # 只报告至少包含这么多文件的子目录，更小的重复由qrf逐个文件处理
+    MIN_SUBTREE_FILES = 2
+
+    def __call__(self, *args):
+        """
+        按数据库中文件记录的路径、大小和md5值自底向上计算每个子目录的摘要，找出内容完全相同的子目录，
+        从大到小列出，每组只需要一次选择
+        :param args: 可选的min_files:数量，只报告至少包含这么多文件的子目录
+        :return: 0表示正常
+        """
+        min_files = self.MIN_SUBTREE_FILES
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            assert sep == ':' and key == 'min_files', ArgumentError(f'无法识别的参数：{arg}')
+            try:
+                min_files = int(value)
+            except ValueError:
+                raise ArgumentError(f'min_files需要是整数：{value}')
+        self.init_db_if_needed()
+        groups = self._duplicate_subtrees(max(min_files, 1))
+        if len(groups) == 0:
+            print('没有内容完全相同的子目录')
+            return 0
+
+        def action_a():
+            self._resolve_duplicate_subtrees(groups)
+            return True
+
+        def action_ls(inputs):
+            outputs = []
+            for size, files, members in groups:
+                outputs.append(f'大小: {self.human_readable_size(size)}，文件数：{files}')
+                for dir_id, dir_path in members:
+                    outputs.append(f'{self._directory_names[dir_id]}:{dir_path}')
+            self.cmd_ls(inputs, outputs)
+            return False
+
+        self.query_actions(
+            f'共有{len(groups)}组内容完全相同的子目录，请问需要作何处理？',
+            {'a': ('从大到小逐组询问保留哪个子目录', action_a), },
+            {'ls': ('[写入文件路径（可选）]', '列出这些子目录的大小和路径 [写入指定的文件中]', action_ls)}
+        )
+        return 0
+
+    def _duplicate_subtrees(self, min_files: int) -> List[Tuple[int, int, List[Tuple[int, str]]]]:
+        """
+        找出内容完全相同的子目录，包含在更大的相同子目录组中的组不再单独列出
+        :param min_files: 只考虑至少包含这么多文件的子目录
+        :return: 按子目录大小从大到小排列的[(子目录大小, 文件数, [(目录id, 子目录路径)])]
+        """
+        dir_paths = self.db.all_dir_paths()
+        trees: Dict[int, SubtreeDigests] = {}
+        for _, path_id, name, suffix, md5, size, dir_id, _ in tqdm(
+                self.db.iterate_file_rows(resolve_dir_path=False), desc='读取文件记录'
+        ):
+            tree = trees.get(dir_id)
+            if tree is None:
+                tree = trees[dir_id] = SubtreeDigests()
+            tree.add_file(dir_paths[int(path_id)], f'{name}{suffix}', int(size), None if md5 is None else bytes(md5))
+        self._directory_names = {
+            dir_id: directory.name for dir_id, directory in self.db.query_directory_by_id(list(trees.keys())).items()
+        }
+
+        digest_members: Dict[bytes, List[Tuple[int, str]]] = {}
+        for dir_id, tree in trees.items():
+            tree.compute()
+            for dir_path, node in tree.nodes.items():
+                if node.digest is not None and node.files >= min_files:
+                    digest_members.setdefault(node.digest, []).append((dir_id, dir_path))
+        duplicated = {digest for digest, members in digest_members.items() if len(members) > 1}
+        groups = []
+        for digest in duplicated:
+            members = digest_members[digest]
+            # 所有子目录的父目录互不相同且属于同一个重复组时，父目录组恰好包含了这一组，这一组不再单独列出；
+            # 否则（例如同一个父目录下有两个相同的子目录）这一组的重复不能由父目录组体现
+            if all(dir_path != '/' for _, dir_path in members):
+                parents = {(dir_id, parent_dir_path(dir_path)[0]) for dir_id, dir_path in members}
+                parent_digests = {trees[dir_id].digest(parent_path) for dir_id, parent_path in parents}
+                if len(parents) == len(members) and len(parent_digests) == 1 and \
+                        next(iter(parent_digests)) in duplicated:
+                    continue
+            node = trees[members[0][0]].nodes[members[0][1]]
+            groups.append((node.size, node.files, sorted(members)))
+        groups.sort(key=lambda group: (-group[0], -group[1], group[2]))
+        return groups
+
+    def _resolve_duplicate_subtrees(self, groups: List[Tuple[int, int, List[Tuple[int, str]]]]):
+        """
+        逐组询问保留哪些子目录，删除其余子目录下的所有文件记录，每组至少保留一个子目录
+        :param groups: _duplicate_subtrees的结果
+        :return: None
+        """
+        # 已经删除的子目录，之后的组中位于这些子目录下的成员不再列出
+        deleted: List[Tuple[int, str]] = []
+        for size, files, members in groups:
+            members = [
+                (dir_id, dir_path) for dir_id, dir_path in members
+                if not any(dir_id == d and dir_path.startswith(p) for d, p in deleted)
+            ]
+            if len(members) < 2:
+                continue
+            print('=' * 120)
+            print(f'大小: {self.human_readable_size(size)}，文件数：{files}')
+            for i, (dir_id, dir_path) in enumerate(members):
+                print(f'【{i}】{self._directory_names[dir_id]}:{dir_path}')
+            print('=' * 120)
+            keep_ids = set()
+            while True:
+                keep = input(
+                    '请选择您需要保留的子目录：输入上述子目录相应的数字，至少保留一个，'
+                    '多个选择可用空格分隔，输入"skip"或者"s"可以跳过这次询问，输入abort结束询问：'
+                ).strip()
+                try:
+                    if keep == 'abort':
+                        return
+                    elif keep == 'skip' or keep == 's':
+                        keep_ids = set(range(len(members)))
+                        break
+                    keep_ids = set()
+                    for each in keep.split():
+                        each = int(each)
+                        assert 0 <= each < len(members)
+                        keep_ids.add(each)
+                    assert len(keep_ids) > 0
+                    break
+                except ValueError:
+                    print(f'无法识别输入：{keep}，请重新输入')
+                except AssertionError:
+                    print(f'请输入0至{len(members) - 1}的整数，至少保留一个子目录')
+            if len(keep_ids) == len(members):
+                continue
+            to_delete = [member for i, member in enumerate(members) if i not in keep_ids]
+            for dir_id, dir_path in to_delete:
+                print(f'{self._directory_names[dir_id]}:{dir_path}', '下的所有文件记录将被删除')
+            if not self.input_query('上述操作将会修改数据库，请确认'):
+                continue
+            deleted.extend(to_delete)
+            print(f'删除了{self.transaction(self._delete_subtrees, subtrees=to_delete)}条文件记录')
+
+    def _delete_subtrees(self, subtrees: List[Tuple[int, str]]) -> int:
+        """
+        :param subtrees: (目录id, 子目录路径)列表
+        :return: 删除的文件记录数
+        """
+        return sum(self.db.delete_file_records_under(dir_id, dir_path) for dir_id, dir_path in subtrees)
+
+
+class VerifyReplicaScript(DataBaseScript):
+    def __call__(self, tag_a: str, tag_b: str, write_path: str = None, *args) -> int:
+        """
+        检查同一目录的两个管理记录的物理位置下的文件是否完全相同：按文件的相对路径、大小和修改时间为两边的每个子目录计算摘要，
+        只进入摘要不同的子目录，只有大小相同而修改时间不同的文件才比较md5值，优先使用manage保存的扫描快照中的md5值
+        :param tag_a: 管理记录的标签
+        :param tag_b: 另一个管理记录的标签
+        :param write_path: 输出差异的文件路径，为空时输出到控制台
+        :param args: 其他参数，应为空
+        :return: 0表示执行正常
+        """
+        self.check_empty_args(*args)
+        self.init_db_if_needed()
+        management_dir_ids = {management.tag: management.dir_id for management in self.db.all_managements()}
+        paths = []
+        for tag in (tag_a, tag_b):
+            assert tag in management_dir_ids, OperationError(f'管理记录{tag}不存在')
+            path = self.db.management_physical_path(tag)
+            assert path and isdir(path), OperationError(f'管理记录{tag}的物理路径{path}不存在，请确认已经挂载')
+            paths.append(path)
+        assert management_dir_ids[tag_a] == management_dir_ids[tag_b], OperationError(
+            f'管理记录{tag_a}和{tag_b}不属于同一个目录')
+
+        sides = [self._manifest(path) for path in paths]
+        (tree_a, records_a, snapshot_a), (tree_b, records_b, snapshot_b) = sides
+        if tree_a.digest() == tree_b.digest():
+            print(f'{tag_a}与{tag_b}完全相同，共{tree_a.nodes["/"].files}个文件')
+            return 0
+
+        only_a, only_b, different, suspects = [], [], [], []
+        visited = 0
+        stack = ['/']
+        while len(stack) > 0:
+            dir_path = stack.pop()
+            visited += 1
+            node_a, node_b = tree_a.nodes[dir_path], tree_b.nodes[dir_path]
+            for name in node_a.entries.keys() - node_b.entries.keys():
+                only_a.append(f'{dir_path}{name}')
+            for name in node_b.entries.keys() - node_a.entries.keys():
+                only_b.append(f'{dir_path}{name}')
+            for name in node_a.entries.keys() & node_b.entries.keys():
+                (size_a, mtime_a), (size_b, mtime_b) = node_a.entries[name], node_b.entries[name]
+                if size_a != size_b:
+                    different.append(f'{dir_path}{name}')
+                elif mtime_a != mtime_b:
+                    suspects.append(f'{dir_path}{name}')
+            children_a, children_b = set(node_a.children), set(node_b.children)
+            for name in children_a - children_b:
+                only_a.append(f'{dir_path}{name}/')
+            for name in children_b - children_a:
+                only_b.append(f'{dir_path}{name}/')
+            for name in children_a & children_b:
+                child = f'{dir_path}{name}/'
+                if tree_a.digest(child) != tree_b.digest(child):
+                    stack.append(child)
+
+        hashed = 0
+        for path in tqdm(suspects, desc='比较修改时间不同的文件', disable=len(suspects) < 5):
+            md5s = []
+            for records, snapshot in ((records_a, snapshot_a), (records_b, snapshot_b)):
+                record = records[path]
+                entry = snapshot.get(path)
+                if entry is not None and len(entry) >= 4 and entry[3] is not None and \
+                        entry[:3] == [record.inode, record.size, record.modified_time]:
+                    md5s.append(entry[3])
+                else:
+                    hashed += 1
+                    md5s.append(record.compute_md5())
+            if md5s[0] != md5s[1]:
+                different.append(path)
+
+        outputs = [f'仅存在于{tag_a}：{path}' for path in sorted(only_a)]
+        outputs.extend(f'仅存在于{tag_b}：{path}' for path in sorted(only_b))
+        outputs.extend(f'内容不同：{path}' for path in sorted(different))
+        self.write_or_output_lines_to_file(outputs, write_path)
+        print(
+            f'比较了{visited}个子目录，{len(suspects)}个文件的修改时间不同，计算了{hashed}个文件的md5值；'
+            f'{tag_a}与{tag_b}' + ('完全相同' if len(outputs) == 0 else f'共有{len(outputs)}处差异')
+        )
+        return 0
+
+    @staticmethod
+    def _manifest(path: str) -> Tuple[SubtreeDigests, Dict[str, FileRecord], Dict[str, list]]:
+        """
+        扫描物理路径下的文件，构建以大小和修改时间为内容标识的子目录摘要
+        :param path: 管理记录的物理路径
+        :return: (子目录摘要, [相对路径] -> 本地文件记录, 扫描快照)
+        """
+        tree = SubtreeDigests(keep_entries=True)
+        records = {}
+        for record in FileRecord.get_dir_file_records(path):
+            tree.add_file(record.dir_path, f'{record.name}{record.suffix}', record.size, record.modified_time)
+            records[record.path] = record
+        tree.compute()
+        return tree, records, ManageDirectoryScript._load_scan_snapshot(path)
+
+
+class ScrubScript(DataBaseScript):
+    # .lyl232fm下的巡检游标，记录上次巡检到的文件路径以及本轮巡检的进度
+    SCRUB_CURSOR = 'scrub_cursor'
+    # .lyl232fm下的巡检报告，每次巡检发现的问题追加到该文件中
+    SCRUB_REPORT = 'scrub_report'
+    # 巡检时多少秒保存一次游标
+    SAVE_FREQUENCY = 30
+    # 每次从数据库按路径顺序读取多少条文件记录
+    PAGE_SIZE = 1000
+    READ_BUFFER = 4 * 1024 * 1024
+    TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+    def __call__(self, *args) -> int:
+        """
+        按路径顺序从上次的游标处继续，校验本地文件与数据库中的md5值是否相同，多次运行后完成对整个目录的巡检。
+        文件记录从游标处按路径分页读取，时间用完时正在校验的文件也会立即停止，下次从该文件重新开始
+        :param args: 可选的目录路径，默认为当前目录；可选的rate:每秒读取的MB数；
+            可选的time:本次巡检的时间，可以带s、m、h的单位，默认为秒
+        :return: 0表示正常
+        """
+        dir_path, rate, budget = '.', None, None
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            try:
+                if sep == ':' and key == 'rate':
+                    rate = float(value) * 1024 * 1024
+                    assert rate > 0, ArgumentError(f'rate需要大于0：{value}')
+                elif sep == ':' and key == 'time':
+                    value = value.strip()
+                    unit = self.TIME_UNITS.get(value[-1:], None)
+                    budget = float(value[:-1] if unit else value) * (unit or 1)
+                else:
+                    dir_path = arg
+            except ValueError:
+                raise ArgumentError(f'无法识别的参数：{arg}')
+        fm_dir = self._find_management_dir(dir_path)
+        assert fm_dir is not None, OperationError(f'{abspath(dir_path)}不属于任何管理记录，请先使用lfm manage管理该目录')
+        dir_path = dirname(fm_dir)
+        dir_id = self.get_directory_id_by_name_or_local(self.load_manage_info(fm_dir)['name'])
+
+        cursor = self._load_cursor(fm_dir)
+        # 本次校验得到的快照项，按路径顺序产生，结束时与原来的扫描快照归并
+        verified = SpillList()
+        problems, finished = [], True
+        # 本次巡检自己的速率限制，全局的限速控制文件同样生效
+        self._bucket = TokenBucket(rate)
+        last_save = time.time()
+        deadline = None if budget is None else last_save + budget
+        try:
+            with tqdm(unit='B', unit_scale=True, desc='巡检') as bar:
+                while finished:
+                    records = self.db.hashed_file_records_after(dir_id, cursor['path'], self.PAGE_SIZE)
+                    if len(records) == 0:
+                        break
+                    for record in records:
+                        done, problem = self._scrub_file(dir_path, record, verified, bar, deadline)
+                        if not done:
+                            finished = False
+                            break
+                        if problem is not None:
+                            problems.append(f'{problem}：{record.path}')
+                        cursor['path'] = record.path
+                        cursor['verified'] += 1
+                        cursor['bytes'] += record.size
+                        if time.time() - last_save > self.SAVE_FREQUENCY:
+                            # 只保存游标，扫描快照只是md5值的缓存，在结束时一次性写入
+                            self._save_cursor(fm_dir, cursor)
+                            last_save = time.time()
+        except KeyboardInterrupt:
+            finished = False
+            print('巡检被中断，下次将从中断处继续')
+        snapshot_path = ManageDirectoryScript._snapshot_path(dir_path)
+        if len(verified) > 0:
+            write_snapshot(snapshot_path, merge_snapshots(read_snapshot(snapshot_path), verified))
+        verified.close()
+        if finished:
+            print(f'完成了第{cursor["round"]}轮巡检，共校验{cursor["verified"]}个文件共{self.human_readable_size(cursor["bytes"])}')
+            cursor = {'path': None, 'round': cursor['round'] + 1, 'verified': 0, 'bytes': 0}
+        self._save_cursor(fm_dir, cursor)
+        if len(problems) > 0:
+            with open(join(fm_dir, self.SCRUB_REPORT), 'a', encoding='utf8') as file:
+                now = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+                for each in problems:
+                    file.write(f'{now}\t{each}\n')
+            for each in problems:
+                print(each)
+            print(f'发现{len(problems)}个问题，已追加到{join(fm_dir, self.SCRUB_REPORT)}，'
+                  f'内容不同的文件在下次lfm manage时会被视为与数据库记录冲突')
+        return 0
+
+    def _scrub_file(
+            self, dir_path: str, record: FileRecord, verified: SpillList, bar: tqdm, deadline: Union[float, None]
+    ) -> Tuple[bool, Union[str, None]]:
+        """
+        校验一个文件，并将读取得到的md5值的快照项追加到verified，内容与数据库不同的文件在下次manage时会被视为冲突
+        :param dir_path: 管理记录的物理路径
+        :param record: 数据库中的文件记录
+        :param verified: 校验得到的(相对路径, 快照项)
+        :param bar: 进度条
+        :param deadline: 本次巡检的截止时间，None表示不限制
+        :return: (是否校验完成，时间用完时为False, 发现的问题，没有问题时为None)
+        """
+        if deadline is not None and time.time() >= deadline:
+            return False, None
+        path = join(dir_path, *(record.path.split('/')[1:]))
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            bar.update(record.size)
+            return True, '文件缺失'
+        if stat.st_size != record.size or FileRecord.modified_timestamp(stat.st_mtime) != record.modified_time:
+            # 文件已经被修改过，交给lfm manage处理
+            bar.update(record.size)
+            return True, '文件的大小或修改时间与数据库记录不同'
+        m = hashlib.md5()
+        THROTTLE.consume_files()
+        with open(path, 'rb') as file:
+            while True:
+                if deadline is not None and time.time() >= deadline:
+                    return False, None
+                data = file.read(THROTTLE.read_size(self.READ_BUFFER))
+                if not data:
+                    break
+                m.update(data)
+                bar.update(len(data))
+                self._bucket.consume(len(data))
+                THROTTLE.consume_bytes(len(data))
+        md5 = m.hexdigest()
+        verified.append((record.path, [stat.st_ino, record.size, record.modified_time, md5]))
+        return True, None if md5 == record.md5 else f'md5值{md5}与数据库记录{record.md5}不同'
+
+    def _load_cursor(self, fm_dir: str) -> dict:
+        """
+        :param fm_dir: .lyl232fm的路径
+        :return: 巡检游标，不存在或者无法读取时从头开始
+        """
+        try:
+            with open(join(fm_dir, self.SCRUB_CURSOR), 'r', encoding='utf8') as file:
+                return json.load(file)
+        except (JSONDecodeError, FileNotFoundError):
+            return {'path': None, 'round': 1, 'verified': 0, 'bytes': 0}
+
+    def _save_cursor(self, fm_dir: str, cursor: dict):
+        """
+        保存巡检游标，先写入临时文件再替换
+        :param fm_dir: .lyl232fm的路径
+        :param cursor: 巡检游标
+        :return: None
+        """
+        path = join(fm_dir, self.SCRUB_CURSOR)
+        with open(f'{path}.tmp', 'w', encoding='utf8') as file:
+            json.dump(cursor, file, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+
+class HashDaemonScript(FileMD5ComputingScript):
+    # 每次从数据库读取多少条没有md5值的文件记录
+    PAGE_SIZE = 1000
+
+    def __call__(self, *args) -> int:
+        """
+        以最低的CPU和IO优先级在后台为已挂载的管理记录中没有md5值的文件记录计算md5值
+        :param args: 可选的interval:秒数，每轮计算结束后等待该时间再开始下一轮，不指定时只运行一轮
+        :return: 0表示正常
+        """
+        interval = None
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            assert sep == ':' and key == 'interval', ArgumentError(f'无法识别的参数：{arg}')
+            try:
+                interval = float(value)
+            except ValueError:
+                raise ArgumentError(f'interval需要是秒数：{value}')
+        self.init_db_if_needed()
+        self._lower_priority()
+        while True:
+            hashed = self._hash_mounted_managements()
+            print(f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())} 计算了{hashed}个文件的md5值')
+            if interval is None:
+                return 0
+            time.sleep(interval)
+
+    @staticmethod
+    def _lower_priority():
+        """
+        将本进程的CPU优先级调到最低，并在有ionice时将IO调度类设为空闲，只在磁盘空闲时读取
+        :return: None
+        """
+        try:
+            os.nice(19)
+        except (AttributeError, OSError):
+            pass
+        if shutil.which('ionice') is not None:
+            subprocess.run(
+                ['ionice', '-c', '3', '-p', str(os.getpid())], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+
+    def _hash_mounted_managements(self) -> int:
+        """
+        每个目录从一个已挂载的管理记录（优先非机械硬盘）中读取文件，计算没有md5值的文件记录的md5值，分批写入数据库
+        :return: 计算了md5值的文件数量
+        """
+        speed = DeviceSpeed()
+        # [目录id] -> (设备速度等级, 物理路径)
+        sources: Dict[int, Tuple[int, str]] = {}
+        for management in self.db.all_managements():
+            if not management.path or not isdir(join(management.path, '.lyl232fm')):
+                continue
+            candidate = (speed.rank(device_of(management.path)), management.path)
+            if management.dir_id not in sources or candidate < sources[management.dir_id]:
+                sources[management.dir_id] = candidate
+        hashed = 0
+        for dir_id, (_, path) in sources.items():
+            after = 0
+            while True:
+                records = self.db.unhashed_file_records(dir_id, self.PAGE_SIZE, after)
+                if len(records) == 0:
+                    break
+                after = records[-1].file_id
+                matched = []
+                for record in records:
+                    # 只计算与数据库记录的大小和修改时间都相同的文件，其他的交给lfm manage处理
+                    try:
+                        stat = os.stat(join(path, *(record.path.split('/')[1:])))
+                    except OSError:
+                        continue
+                    if stat.st_size == record.size and \
+                            FileRecord.modified_timestamp(stat.st_mtime) == record.modified_time:
+                        record.dir_physical_path = path
+                        matched.append(record)
+                hashed += sum(self.file_md5_computing_transactions(matched, self.db.update_file_records))
+        return hashed
+
+
 class QuerySizeScript(DataBaseScript):
-    def __call__(self, name: str = None, *args) -> int:
+    def __call__(self, name: str = None, sub_path: str = '/', *args) -> int:
         """
         查询所有被管理的目录的脚本
         :param name: 目录名字，如果为空，则从当前目录下的.lyl232fm的信息获取
+        :param sub_path: 只统计该子目录下的文件记录
         :param args: 其他参数，应为空
         :return: 0表示执行正常
         """
         self.check_empty_args(*args)
-        print(self.human_readable_size(self.db.query_director_size(self.get_directory_id_by_name_or_local(name))))
+        dir_id = self.get_directory_id_by_name_or_local(name)
+        print(self.human_readable_size(self.db.query_director_size(dir_id, FileRecord.format_dir_path(sub_path))))
         return 0
 
 
@@ -1069,6 +2527,34 @@ class FindInSuffixScript(FindInColumnScript):
         return 'suffix'
 
 
+class FindFileScript(DataBaseScript):
+    """
+    组合文件名、后缀和目录路径的关键字查找
+    """
+    TERM_PREFIXES = {'name:': 'name', 'suffix:': 'suffix', 'dir:': 'dir_path'}
+
+    def __call__(self, *args) -> int:
+        """
+        查找同时满足所有条件的文件记录
+        :param args: 查找条件，格式为name:关键字、suffix:关键字或dir:关键字，其余的一个参数视为输出文件路径
+        :return: 0表示执行正常
+        """
+        terms, write_path = {}, None
+        for arg in args:
+            for prefix, column in self.TERM_PREFIXES.items():
+                if arg.startswith(prefix):
+                    terms[column] = arg[len(prefix):].strip()
+                    break
+            else:
+                assert write_path is None, ArgumentError(f'无法识别的查找条件：{arg}')
+                write_path = arg
+        assert len(terms) > 0, ArgumentError('请至少指定一个查找条件：name:关键字、suffix:关键字或dir:关键字')
+        self.init_db_if_needed()
+        outputs = self.file_record_output_lines(self.db.find_files(**terms))
+        self.write_or_output_lines_to_file(outputs, write_path)
+        return 0
+
+
 class QueryDirectoryFileRecordsExistenceScript(FileMD5ComputingScript):
     def __call__(
             self,
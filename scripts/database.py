@@ -2,30 +2,240 @@
 数据库维护脚本
 """
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from typing import List, Tuple, Iterator
+from tqdm import tqdm
 from os.path import join, exists, abspath, dirname
 from scripts import DataBaseScript
+from database import SCHEMA_VERSION, md5_to_db
 from record import DirectoryRecord, ManagementRecord, FileRecord
-from error import RunTimeError
+from error import RunTimeError, OperationError, ArgumentError
+from dump import read_table, read_file_blocks, load_header, FileColumnWriter
 
 
 class InitializeDataBaseScript(DataBaseScript):
     """
     初始化数据库脚本
     """
+    # 恢复文件记录时每批插入的数量
+    RESTORE_BATCH = 10000
 
     def __call__(self, dumped_data_path: str = None, *args) -> int:
-        self.check_empty_args(*args)
+        """
+        :param dumped_data_path: 完整导出的目录，可选
+        :param args: 依次在完整导出的数据上重放的增量导出目录；
+            或者parallel:连接数，使用多个连接分块并行导入文件记录，加上resume表示继续之前中断的并行导入
+        :return: 0表示执行正常
+        """
+        delta_paths, workers, resume = [], 0, False
+        for arg in args:
+            if arg.startswith('parallel:'):
+                try:
+                    workers = int(arg[len('parallel:'):])
+                except ValueError:
+                    raise ArgumentError(f'并行导入的连接数必须是整数：{arg}')
+                assert workers > 0, ArgumentError(f'并行导入的连接数必须大于0：{arg}')
+            elif arg == 'resume':
+                resume = True
+            else:
+                delta_paths.append(arg)
+        if workers > 0 or resume:
+            assert len(delta_paths) == 0, ArgumentError('并行导入时不能同时重放增量导出的数据')
+            return self._parallel_restore(dumped_data_path, max(workers, 1), resume)
+
+        headers = self._check_dump_chain(dumped_data_path, delta_paths)
         self.db.initialize()
         if dumped_data_path is None or not exists(dumped_data_path):
             return 0
         print(f'正在从{dumped_data_path}读取备份的数据')
+        directory_records, management_records = self._read_directories_and_managements(dumped_data_path)
+        transaction = self.db.begin_transaction()
+        try:
+            directories, managements = self._create_directories_and_managements(directory_records, management_records)
+            files = self._restore_files(dumped_data_path, headers[0])
+            print(f'导入了{directories}条目录记录、{managements}条管理记录、{files}条文件记录')
+            for delta_path, header in zip(delta_paths, headers[1:]):
+                self._replay_delta(delta_path, header)
+            self._finish_restore(headers[-1])
+            transaction.commit()
+        except Exception as e:
+            transaction.rollback()
+            raise e
+        return 0
+
+    def _create_directories_and_managements(
+            self, directory_records: List[DirectoryRecord], management_records: List[ManagementRecord]
+    ) -> Tuple[int, int]:
+        """
+        :return: 导入的目录记录数和管理记录数
+        """
+        directories = self.db.create_directories_with_id(directory_records) or 0
+        assert directories == len(directory_records), RunTimeError(
+            f'导入目录记录数据时出错，理应导入{len(directory_records)}条目录记录，但是只导入了{directories}条')
+        managements = self.db.create_managements_with_id(management_records) or 0
+        assert managements == len(management_records), RunTimeError(
+            f'导入管理记录数据时出错，理应导入{len(management_records)}条目录记录，但是只导入了{managements}条')
+        return directories, managements
+
+    def _finish_restore(self, header: dict = None):
+        """
+        导入完成后恢复修改序号并重建统计信息
+        :param header: 最后一个导入的导出目录的header
+        :return: None
+        """
+        if header is not None and header.get('change_seq') is not None:
+            self.db.set_change_seq(header['change_seq'])
+        self.db.rebuild_statistics()
+
+    def _parallel_restore(self, dumped_data_path: str, workers: int, resume: bool) -> int:
+        """
+        使用多个连接分块并行导入文件记录：导入前删除file表的二级索引和外键，导入后重新创建；
+        每一块文件记录在一个事务中导入，中断后可以跳过已经导入的块继续导入
+        :param dumped_data_path: 完整导出的目录
+        :param workers: 导入文件记录的连接数
+        :param resume: 是否继续之前中断的导入
+        :return: 0表示执行正常
+        """
+        assert dumped_data_path is not None and exists(dumped_data_path), ArgumentError('并行导入需要指定导出数据的路径')
+        header = load_header(dumped_data_path)
+        assert header is not None and header.get('base_change_seq') is None, OperationError(
+            f'{dumped_data_path}不是带有header.json的完整导出数据，无法并行导入')
+        if resume:
+            assert self.db.is_initialized(), OperationError('数据库尚未初始化，无法继续导入')
+            print(f'正在继续从{dumped_data_path}导入备份的数据')
+        else:
+            self.db.initialize()
+            print(f'正在从{dumped_data_path}读取备份的数据')
+            directories, managements = self.transaction(
+                self._create_directories_and_managements, *self._read_directories_and_managements(dumped_data_path))
+            print(f'导入了{directories}条目录记录、{managements}条管理记录')
+        self.db.prepare_bulk_load()
+        files = self._load_file_chunks(dumped_data_path, header, workers, resume)
+        print('正在创建文件记录的索引和外键')
+        self.db.finish_bulk_load()
+        self.transaction(self._finish_restore, header)
+        print(f'导入了{files}条文件记录')
+        return 0
+
+    def _load_file_chunks(self, dumped_data_path: str, header: dict, workers: int, resume: bool) -> int:
+        """
+        在主连接上读取并转换文件记录块，交给多个连接并行导入
+        :return: 导入的文件记录数，不包括之前已经导入的块
+        """
+        local, connections, lock = threading.local(), [], threading.Lock()
+
+        def load(index: int, rows: List[tuple]) -> Tuple[int, int]:
+            db = getattr(local, 'db', None)
+            if db is None:
+                db = local.db = self.connect_database()
+                db.defer_constraint_checks()
+                with lock:
+                    connections.append(db)
+            transaction = db.begin_transaction()
+            try:
+                # 继续导入时块可能已经部分存在，覆盖即可
+                db.create_file_rows_with_id(rows, replace=resume)
+                transaction.commit()
+            except Exception as e:
+                transaction.rollback()
+                raise e
+            return index, len(rows)
+
+        loaded, pending = 0, set()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor, \
+                    tqdm(desc='导入文件记录', total=header['tables']['file']['rows']) as bar:
+                def collect(return_when):
+                    nonlocal loaded, pending
+                    done, pending = wait(pending, return_when=return_when)
+                    for future in done:
+                        index, n = future.result()
+                        loaded += n
+                        bar.update(n)
+                        bar.set_postfix_str(f'第{index}块完成')
+
+                for index, rows in enumerate(self._file_chunks(dumped_data_path, header)):
+                    first_id, last_id = rows[0][0], rows[-1][0]
+                    if resume and self.db.file_count_in_id_range(first_id, last_id) == len(rows):
+                        bar.update(len(rows))
+                        continue
+                    pending.add(executor.submit(load, index, rows))
+                    # 限制读入内存中等待导入的块数
+                    if len(pending) >= 2 * workers:
+                        collect(FIRST_COMPLETED)
+                collect(ALL_COMPLETED)
+        finally:
+            for db in connections:
+                db.close()
+        return loaded
+
+    def _file_chunks(self, dumped_data_path: str, header: dict) -> Iterator[List[tuple]]:
+        """
+        按id顺序分块读取导出的文件记录，并将目录路径转换为本数据库的目录节点id
+        :return: 生成器，每次生成一块(id, 目录节点id, name, suffix, md5, size, dir_id, modified_timestamp)列表
+        """
+        if header['tables']['file'].get('format') == FileColumnWriter.FORMAT:
+            path_ids = {}
+            for kind, data in read_file_blocks(dumped_data_path):
+                if kind == 'dict':
+                    interned = self.transaction(self.db.intern_dir_paths, list(data.values()))
+                    path_ids.update({dumped_id: interned[dir_path] for dumped_id, dir_path in data.items()})
+                    continue
+                yield [(row[0], path_ids[row[1]], *row[2:]) for row in data]
+            return
+        batch = []
+        for row in read_table(dumped_data_path, 'file'):
+            batch.append(row)
+            if len(batch) >= self.RESTORE_BATCH:
+                yield self._csv_file_rows(batch)
+                batch = []
+        if len(batch) > 0:
+            yield self._csv_file_rows(batch)
+
+    def _csv_file_rows(self, rows: List[List[str]]) -> List[tuple]:
+        path_ids = self.transaction(self.db.intern_dir_paths, list({row[1] for row in rows}))
+        return [
+            (
+                int(file_id), path_ids[dir_path], name, suffix, md5_to_db(md5),
+                int(size), int(dir_id), int(modified_timestamp)
+            )
+            for file_id, dir_path, name, suffix, md5, size, dir_id, modified_timestamp in rows
+        ]
+
+    @staticmethod
+    def _check_dump_chain(dumped_data_path: str, delta_paths) -> list:
+        """
+        检查完整导出和增量导出的数据能否首尾相接
+        :param dumped_data_path: 完整导出的目录
+        :param delta_paths: 增量导出的目录
+        :return: 每个导出目录的header，没有header的旧版导出数据为None
+        """
+        if dumped_data_path is None or not exists(dumped_data_path):
+            return [None]
+        headers = [load_header(dumped_data_path)]
+        assert headers[0] is None or headers[0].get('base_change_seq') is None, OperationError(
+            f'{dumped_data_path}是增量导出的数据，请先指定完整导出的数据')
+        for delta_path in delta_paths:
+            header = load_header(delta_path)
+            assert header is not None and header.get('base_change_seq') is not None, OperationError(
+                f'{delta_path}不是增量导出的数据')
+            assert headers[-1] is not None and header['base_change_seq'] == headers[-1].get('change_seq'), \
+                OperationError(f'{delta_path}不是在上一个导出的数据之后增量导出的数据，请按导出的顺序指定')
+            headers.append(header)
+        return headers
+
+    @staticmethod
+    def _read_directories_and_managements(
+            dumped_data_path: str
+    ) -> Tuple[List[DirectoryRecord], List[ManagementRecord]]:
         directory_records = [
             DirectoryRecord(
                 dir_id=int(dir_id),
                 name=name,
                 desc=des,
             )
-            for dir_id, name, des in self.read_csv(join(dumped_data_path, 'directory.csv'), True)
+            for dir_id, name, des in read_table(dumped_data_path, 'directory')
         ]
         management_records = [
             ManagementRecord(
@@ -34,10 +244,51 @@ class InitializeDataBaseScript(DataBaseScript):
                 # 在文件中的反斜杠路径为正斜杠，得替换回来
                 path=path.replace('/', os.path.sep)
             )
-            for tag, path, dir_id in self.read_csv(join(dumped_data_path, 'management.csv'), True)
+            for tag, path, dir_id in read_table(dumped_data_path, 'management')
         ]
-        file_records = [
-            FileRecord(
+        return directory_records, management_records
+
+    def _replay_delta(self, delta_path: str, header: dict):
+        """
+        在数据库上重放一次增量导出的数据：目录记录和管理记录是完整的，文件记录只包含修改过的记录和删除标记
+        :param delta_path: 增量导出的目录
+        :param header: 增量导出的header
+        :return: None
+        """
+        print(f'正在重放增量导出的数据{delta_path}')
+        directory_records, management_records = self._read_directories_and_managements(delta_path)
+        existing = {each.dir_id for each in self.db.directories()}
+        self.db.create_directories_with_id([each for each in directory_records if each.dir_id not in existing])
+        deleted = self.db.purge_file_records([int(file_id) for file_id, in read_table(delta_path, 'file_tombstone')]) or 0
+        files = self._restore_files(delta_path, header, replace=True)
+        self.db.replace_directories_and_managements(directory_records, management_records)
+        print(f'修改了{files}条文件记录、删除了{deleted}条文件记录')
+
+    def _restore_files(self, dumped_data_path: str, header: dict = None, replace: bool = False) -> int:
+        """
+        导入文件记录
+        :param dumped_data_path: 导出目录
+        :param header: 导出目录的header，None表示旧版导出数据
+        :param replace: 是否覆盖已存在的同id文件记录
+        :return: 导入的文件记录数
+        """
+        file_header = None if header is None else header['tables']['file']
+        if file_header is not None and file_header.get('format') == FileColumnWriter.FORMAT:
+            return self._restore_binary_files(dumped_data_path, file_header['rows'], replace)
+        return self._restore_csv_files(dumped_data_path, None if file_header is None else file_header['rows'], replace)
+
+    def _restore_csv_files(self, dumped_data_path: str, file_count: int = None, replace: bool = False) -> int:
+        """
+        分批导入文本格式的文件记录
+        :param dumped_data_path: 导出目录
+        :param file_count: 文件记录的数量，用于显示进度
+        :param replace: 是否覆盖已存在的同id文件记录
+        :return: 导入的文件记录数
+        """
+        files, batch = 0, []
+        for file_id, dir_path, name, suffix, md5, size, dir_id, modified_timestamp in tqdm(
+                read_table(dumped_data_path, 'file'), desc='导入文件记录', total=file_count):
+            batch.append(FileRecord(
                 file_id=int(file_id),
                 dir_path=dir_path,
                 name=name,
@@ -46,28 +297,85 @@ class InitializeDataBaseScript(DataBaseScript):
                 size=int(size),
                 directory_id=int(dir_id),
                 modified_time=int(modified_timestamp)
-            )
-            for file_id, dir_path, name, suffix, md5, size, dir_id, modified_timestamp
-            in self.read_csv(join(dumped_data_path, 'file.csv'), True)
-        ]
-        if len(file_records) == 0 and len(directory_records) == 0 and len(management_records) == 0:
+            ))
+            if len(batch) >= self.RESTORE_BATCH:
+                files += self._create_files(batch, replace)
+                batch = []
+        return files + self._create_files(batch, replace)
+
+    def _restore_binary_files(self, dumped_data_path: str, file_count: int, replace: bool = False) -> int:
+        """
+        逐块导入二进制列式格式的文件记录，不构造FileRecord对象
+        :param dumped_data_path: 导出目录
+        :param file_count: 文件记录的数量，用于显示进度
+        :param replace: 是否覆盖已存在的同id文件记录
+        :return: 导入的文件记录数
+        """
+        files, path_ids = 0, {}
+        with tqdm(desc='导入文件记录', total=file_count) as bar:
+            for kind, data in read_file_blocks(dumped_data_path):
+                if kind == 'dict':
+                    # 导出数据中的目录节点id -> 本数据库中的目录节点id
+                    interned = self.db.intern_dir_paths(list(data.values()))
+                    path_ids.update({dumped_id: interned[dir_path] for dumped_id, dir_path in data.items()})
+                    continue
+                rows = [(row[0], path_ids[row[1]], *row[2:]) for row in data]
+                created = self._check_created(self.db.create_file_rows_with_id(rows, replace), len(rows), replace)
+                files += created
+                bar.update(created)
+        return files
+
+    def _create_files(self, file_records: List[FileRecord], replace: bool = False) -> int:
+        if len(file_records) == 0:
             return 0
-        transaction = self.db.begin_transaction()
-        try:
-            directories = self.db.create_directories_with_id(directory_records)
-            assert directories == len(directory_records), RunTimeError(
-                f'导入目录记录数据时出错，理应导入{len(directory_records)}条目录记录，但是只导入了{directories}条')
-            managements = self.db.create_managements_with_id(management_records)
-            assert managements == len(management_records), RunTimeError(
-                f'导入管理记录数据时出错，理应导入{len(management_records)}条目录记录，但是只导入了{managements}条')
-            files = self.db.create_files_with_id(file_records)
-            assert files == len(file_records), RunTimeError(
-                f'导入文件记录数据时出错，理应导入{len(file_records)}条目录记录，但是只导入了{files}条')
-            transaction.commit()
-            print(f'导入了{directories}条目录记录、{managements}条管理记录、{files}条文件记录')
-        except Exception as e:
-            transaction.rollback()
-            raise e
+        return self._check_created(self.db.create_files_with_id(file_records, replace), len(file_records), replace)
+
+    @staticmethod
+    def _check_created(created: int, expected: int, replace: bool) -> int:
+        """
+        :param created: 数据库返回的影响行数
+        :param expected: 导入的文件记录数
+        :param replace: 是否覆盖已存在的同id文件记录，此时影响行数不等于导入的记录数，不做检查
+        :return: 导入的文件记录数
+        """
+        assert replace or created == expected, RunTimeError(
+            f'导入文件记录数据时出错，理应导入{expected}条目录记录，但是只导入了{created}条')
+        return expected
+
+
+class MigrateDataBaseScript(DataBaseScript):
+    """
+    就地升级数据库结构的脚本
+    """
+
+    def __call__(self, *args) -> int:
+        self.check_empty_args(*args)
+        assert self.db.is_initialized(), OperationError('数据库尚未初始化，请使用init_db脚本初始化')
+        version = self.db.schema_version()
+        if version == SCHEMA_VERSION:
+            print(f'数据库结构已经是最新版本：{SCHEMA_VERSION}')
+            return 0
+        if not self.input_query(
+                f'将把数据库结构从版本{version}升级到版本{SCHEMA_VERSION}，升级过程中会修改表结构，'
+                f'建议先使用dump_db导出数据，是否继续？'
+        ):
+            print('已取消')
+            return 0
+        self.db.migrate()
+        print(f'数据库结构已从版本{version}升级到版本{SCHEMA_VERSION}')
+        return 0
+
+
+class RepairDataBaseScript(DataBaseScript):
+    """
+    根据文件记录重建统计信息的脚本
+    """
+
+    def __call__(self, *args) -> int:
+        self.check_empty_args(*args)
+        self.init_db_if_needed()
+        self.transaction(self.db.rebuild_statistics)
+        print('已重建统计信息')
         return 0
 
 
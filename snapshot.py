@@ -0,0 +1,101 @@
+"""
+本地扫描快照：记录上次管理时每个文件的inode、大小、修改时间和已知的md5值，用于确认文件的移动，以及在文件没有改变时复用md5值。
+快照文件按相对路径排序，每行是一个JSON数组[相对路径, inode, 大小, 修改时间, md5值或者null]，
+所以可以与按路径排序的扫描流式地归并，读写都不需要将整个快照放入内存。旧版的快照是一个JSON对象，读取时在内存中排序
+"""
+import os
+import json
+import heapq
+from itertools import chain, groupby
+from json.decoder import JSONDecodeError
+from typing import Iterator, Iterable, Tuple, Dict, Union
+
+
+def read_snapshot(path: str) -> Iterator[Tuple[str, list]]:
+    """
+    按路径顺序读取快照
+    :param path: 快照文件路径
+    :return: 生成器，每次生成(相对路径, [inode, 大小, 修改时间, md5值或者None])，快照不存在或者无法读取时为空
+    """
+    try:
+        file = open(path, 'r', encoding='utf8')
+    except FileNotFoundError:
+        return
+    with file:
+        first = file.readline()
+        if first.startswith('{'):
+            try:
+                legacy = json.loads(first + file.read())
+            except JSONDecodeError:
+                return
+            yield from sorted(legacy.items())
+            return
+        for line in chain([first], file):
+            try:
+                relative_path, *entry = json.loads(line)
+            except (JSONDecodeError, ValueError):
+                return
+            yield relative_path, entry
+
+
+def load_snapshot(path: str) -> Dict[str, list]:
+    """
+    :param path: 快照文件路径
+    :return: [相对路径] -> [inode, 大小, 修改时间, md5值或者None]，快照不存在或者无法读取时为空
+    """
+    return dict(read_snapshot(path))
+
+
+def write_snapshot(path: str, entries: Iterable[Tuple[str, list]]):
+    """
+    写入快照，先写入临时文件再替换，中断时不会留下不完整的快照
+    :param path: 快照文件路径
+    :param entries: 按路径排序的(相对路径, 快照项)
+    :return: None
+    """
+    with open(f'{path}.tmp', 'w', encoding='utf8') as file:
+        for relative_path, entry in entries:
+            file.write(json.dumps([relative_path, *entry], ensure_ascii=False))
+            file.write('\n')
+    os.replace(f'{path}.tmp', path)
+
+
+def merge_snapshots(*streams: Iterable[Tuple[str, list]]) -> Iterator[Tuple[str, list]]:
+    """
+    归并多个按路径排序的快照项序列，同一路径有多个快照项时，靠后的序列中的、同一序列中靠后的优先
+    :param streams: 按路径排序的(相对路径, 快照项)序列
+    :return: 按路径排序的(相对路径, 快照项)
+    """
+    tagged = [_tag(stream, i) for i, stream in enumerate(streams)]
+    for relative_path, group in groupby(heapq.merge(*tagged, key=lambda x: (x[0], x[1])), key=lambda x: x[0]):
+        *_, (_, _, entry) = group
+        yield relative_path, entry
+
+
+def _tag(stream: Iterable[Tuple[str, list]], i: int) -> Iterator[Tuple[str, int, list]]:
+    for relative_path, entry in stream:
+        yield relative_path, i, entry
+
+
+class SnapshotLookup:
+    """
+    按路径递增的顺序查找快照项，只需要顺序读取一遍快照
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, list]]):
+        """
+        :param entries: 按路径排序的(相对路径, 快照项)
+        """
+        self._entries = iter(entries)
+        self._current = next(self._entries, None)
+
+    def get(self, relative_path: str) -> Union[list, None]:
+        """
+        :param relative_path: 相对路径，不能小于上一次查找的路径
+        :return: 快照项，不存在时为None
+        """
+        while self._current is not None and self._current[0] < relative_path:
+            self._current = next(self._entries, None)
+        if self._current is not None and self._current[0] == relative_path:
+            return self._current[1]
+        return None
@@ -0,0 +1,147 @@
+"""
+读取文件数据时的全局限速：以令牌桶限制每秒读取的字节数和文件数，计算md5值、复制文件和增量复制都经过这里。
+限速配置从控制文件读取，运行中修改控制文件，或者向进程发送SIGHUP信号，都会在下一次读取时生效
+"""
+import os
+import json
+import time
+import signal
+import threading
+from json.decoder import JSONDecodeError
+from typing import Union
+
+
+class TokenBucket:
+    def __init__(self, rate: float = None):
+        """
+        :param rate: 每秒补充的令牌数，None表示不限制
+        """
+        self._lock = threading.Lock()
+        self.rate = None
+        self._tokens, self._last = 0., time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Union[float, None]):
+        """
+        修改速率，桶的容量为一秒的令牌数
+        :param rate: 每秒补充的令牌数，None或者不大于0表示不限制
+        :return: None
+        """
+        with self._lock:
+            self.rate = rate if rate is not None and rate > 0 else None
+            self._tokens, self._last = (self.rate or 0.), time.monotonic()
+
+    def consume(self, amount: float):
+        """
+        取出令牌，令牌不足时先取出（允许欠账），再等待到欠账还清，所以一次可以取出超过桶容量的令牌，
+        多个线程同时取出时各自等待自己的欠账，总体速率仍然不超过限制
+        :param amount: 令牌数
+        :return: None
+        """
+        if self.rate is None:
+            return
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate) - amount
+            self._last = now
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle:
+    # 多少秒检查一次控制文件是否被修改
+    CHECK_INTERVAL = 1
+    # 限速时每次读取的数据量不超过多少秒的配额，使等待更加平滑
+    READ_SLICE = 0.25
+    MIN_READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.bytes = TokenBucket()
+        self.files = TokenBucket()
+        self._path = None
+        self._mtime = None
+        self._checked = 0.
+        self._reload = False
+
+    def configure(self, path: str):
+        """
+        指定控制文件并读取其中的配置，控制文件是一个json对象：
+        {"bytes_per_second": 每秒读取的字节数, "files_per_second": 每秒打开的文件数}，
+        缺少的项或者值为null表示不限制，控制文件不存在时也不限制，之后创建控制文件同样会生效
+        :param path: 控制文件的路径
+        :return: None
+        """
+        self._path = os.path.abspath(path)
+        self._mtime = None
+        self._check(force=True)
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._reload = True
+
+    def _check(self, force: bool = False):
+        """
+        控制文件被修改或者收到SIGHUP信号时重新读取配置
+        :param force: 是否立即检查
+        :return: None
+        """
+        if self._path is None:
+            return
+        now = time.monotonic()
+        if not force and not self._reload and now - self._checked < self.CHECK_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            mtime = None
+        if not self._reload and mtime == self._mtime:
+            return
+        self._reload, self._mtime = False, mtime
+        config = {}
+        if mtime is not None:
+            try:
+                with open(self._path, 'r', encoding='utf8') as file:
+                    config = json.load(file)
+            except (JSONDecodeError, OSError) as e:
+                # 控制文件可能正在被写入，保持原来的配置，下次修改后再读取
+                print(f'无法读取限速控制文件{self._path}：{e}')
+                return
+        self.bytes.set_rate(config.get('bytes_per_second'))
+        self.files.set_rate(config.get('files_per_second'))
+
+    def consume_bytes(self, n: int):
+        """
+        读取了n个字节后调用，超过限速时等待
+        :param n: 字节数
+        :return: None
+        """
+        self._check()
+        self.bytes.consume(n)
+
+    def consume_files(self, n: int = 1):
+        """
+        打开n个文件读取前调用，超过限速时等待
+        :param n: 文件数
+        :return: None
+        """
+        self._check()
+        self.files.consume(n)
+
+    def read_size(self, default: int) -> int:
+        """
+        :param default: 不限速时每次读取的字节数
+        :return: 每次读取的字节数，限速时不超过READ_SLICE秒的配额
+        """
+        rate = self.bytes.rate
+        if rate is None:
+            return default
+        return max(self.MIN_READ_SIZE, min(default, int(rate * self.READ_SLICE)))
+
+
+# 进程内共享的限速，run.py在运行脚本前指定控制文件
+THROTTLE = Throttle()
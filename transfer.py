@@ -0,0 +1,715 @@
+"""
+文件在物理位置之间的传输：文件所在设备的识别以及设备读取速度的估计（用于在多个副本中选择复制的来源），
+以及按设备并行、使用零拷贝系统调用的批量文件复制
+"""
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import zlib
+from math import isqrt
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，无法使用reflink
+    fcntl = None
+from os.path import join, exists
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union, Callable, List, Tuple, Set
+from tqdm import tqdm
+
+from error import DataError, RunTimeError
+from record import FileRecord
+from throttle import THROTTLE
+
+
+def device_of(path: str) -> Union[int, None]:
+    """
+    文件或者目录所在的设备号
+    :param path: 路径
+    :return: 设备号，路径不存在时返回None
+    """
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class DeviceSpeed:
+    """
+    根据设备是否为机械硬盘估计设备的读取速度等级，结果按设备号缓存，等级越小读取越快
+    """
+    # 固态硬盘等非旋转设备
+    FAST = 0
+    # 无法判断的设备，例如非Linux系统或者网络文件系统
+    UNKNOWN = 1
+    # 机械硬盘
+    SLOW = 2
+
+    def __init__(self):
+        self._ranks: Dict[int, int] = {}
+
+    def rank(self, device: int) -> int:
+        """
+        设备的读取速度等级
+        :param device: 设备号
+        :return: FAST，UNKNOWN或者SLOW
+        """
+        rank = self._ranks.get(device)
+        if rank is None:
+            rank = self._ranks[device] = self._rotational_rank(device)
+        return rank
+
+    @classmethod
+    def _rotational_rank(cls, device: int) -> int:
+        """
+        通过/sys/dev/block读取块设备的rotational属性，分区的属性在其所属磁盘的目录下
+        :param device: 设备号
+        :return: 读取速度等级
+        """
+        sys_path = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+        if not exists(sys_path):
+            return cls.UNKNOWN
+        sys_path = os.path.realpath(sys_path)
+        for each in (sys_path, os.path.dirname(sys_path)):
+            rotational = join(each, 'queue', 'rotational')
+            if exists(rotational):
+                try:
+                    with open(rotational, 'r') as file:
+                        return cls.SLOW if file.read().strip() == '1' else cls.FAST
+                except OSError:
+                    return cls.UNKNOWN
+        return cls.UNKNOWN
+
+
+# 每次系统调用复制的字节数，也是更新复制进度的粒度
+COPY_CHUNK = 64 * 1024 * 1024
+# 无法使用零拷贝系统调用时的读写缓存
+COPY_BUFFER = 1024 * 1024
+# 小于该大小的文件被合并为一个复制任务，减少线程池的调度开销
+SMALL_FILE_SIZE = 1024 * 1024
+# 一个合并的小文件复制任务最多包含的文件数和字节数
+SMALL_FILE_BATCH_COUNT = 256
+SMALL_FILE_BATCH_SIZE = 64 * 1024 * 1024
+
+
+def copy_file_data(src_fd: int, dst_fd: int, size: int, progress: Callable[[int], None] = None):
+    """
+    在两个文件描述符之间复制数据，依次尝试copy_file_range、sendfile和普通的读写，
+    前两者的数据不经过用户空间，而且在支持的文件系统上copy_file_range可以由服务端或者存储设备完成复制
+    :param src_fd: 源文件描述符，从当前位置开始读取
+    :param dst_fd: 目标文件描述符，从当前位置开始写入
+    :param size: 需要复制的字节数
+    :param progress: 每复制一部分数据后以复制的字节数调用
+    :return: None
+    """
+    copied = 0
+    for method in (_copy_file_range, _sendfile):
+        if method is None:
+            continue
+        try:
+            while copied < size:
+                n = method(src_fd, dst_fd, min(THROTTLE.read_size(COPY_CHUNK), size - copied))
+                if n == 0:
+                    break
+                copied += n
+                THROTTLE.consume_bytes(n)
+                if progress is not None:
+                    progress(n)
+            if copied >= size:
+                return
+        except OSError as e:
+            # 只有在还没有复制任何数据时才换用其他方式，避免文件偏移不一致
+            if copied > 0 or e.errno not in _FALLBACK_ERRNOS:
+                raise
+    while True:
+        data = os.read(src_fd, COPY_BUFFER)
+        if not data:
+            break
+        THROTTLE.consume_bytes(len(data))
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(dst_fd, view):]
+        if progress is not None:
+            progress(len(data))
+
+
+def copy_file_data_with_md5(src_fd: int, dst_fd: int, progress: Callable[[int], None] = None) -> str:
+    """
+    在两个文件描述符之间复制数据，同时以读出的数据计算md5值，只读取一遍源文件就能校验复制的结果
+    :param src_fd: 源文件描述符，从当前位置开始读取
+    :param dst_fd: 目标文件描述符，从当前位置开始写入，为None时只计算md5值
+    :param progress: 每复制一部分数据后以复制的字节数调用
+    :return: 复制的数据的md5值
+    """
+    m = hashlib.md5()
+    buffer = bytearray(COPY_BUFFER)
+    view = memoryview(buffer)
+    while True:
+        n = os.readv(src_fd, [buffer])
+        if n == 0:
+            break
+        THROTTLE.consume_bytes(n)
+        m.update(view[:n])
+        if dst_fd is not None:
+            written = 0
+            while written < n:
+                written += os.write(dst_fd, view[written:n])
+        if progress is not None:
+            progress(n)
+    return m.hexdigest()
+
+
+if hasattr(os, 'copy_file_range'):
+    def _copy_file_range(src_fd: int, dst_fd: int, count: int) -> int:
+        return os.copy_file_range(src_fd, dst_fd, count)
+else:
+    _copy_file_range = None
+
+# 只有Linux的sendfile支持普通文件作为目标
+if hasattr(os, 'sendfile') and sys.platform == 'linux':
+    def _sendfile(src_fd: int, dst_fd: int, count: int) -> int:
+        return os.sendfile(dst_fd, src_fd, None, count)
+else:
+    _sendfile = None
+
+# 这些错误表示当前的文件系统或者内核不支持该系统调用
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+# linux/fs.h中的FICLONE：让目标文件共享源文件的数据块（写时复制），btrfs、XFS等文件系统支持
+FICLONE = 0x40049409
+# 这些错误表示两个文件不在同一个文件系统或者文件系统不支持reflink/硬链接
+_LINK_FALLBACK_ERRNOS = _FALLBACK_ERRNOS | {errno.ENOTTY, errno.EPERM, errno.EMLINK}
+
+# 文件的实现方式：复制数据，reflink共享数据块，硬链接共享同一个inode
+COPIED, REFLINKED, HARDLINKED = 'copy', 'reflink', 'hardlink'
+
+
+def reflink_file_data(src_fd: int, dst_fd: int) -> bool:
+    """
+    尝试以reflink的方式让目标文件共享源文件的全部数据块，不需要读写数据，也不占用额外的空间
+    :param src_fd: 源文件描述符
+    :param dst_fd: 目标文件描述符，应该是一个空文件
+    :return: 是否成功，文件系统不支持或者不在同一个文件系统时返回False
+    """
+    if fcntl is None or sys.platform != 'linux':
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in _LINK_FALLBACK_ERRNOS:
+            return False
+        raise
+
+
+def copy_file(
+        src: str, dst: str, progress: Callable[[int], None] = None, hardlink: bool = False, md5: str = None,
+        overwrite: bool = False
+) -> str:
+    """
+    复制文件的数据和元数据（包括修改时间），同shutil.copy2，目标文件不能已经存在，除非允许覆盖。
+    依次尝试硬链接（如果允许）、reflink，都不支持时才真正复制数据
+    :param src: 源文件路径
+    :param dst: 目标文件路径
+    :param progress: 每复制一部分数据后以复制的字节数调用
+    :param hardlink: 是否优先使用硬链接，硬链接的两个路径是同一个文件，修改其中一个另一个也会改变
+    :param md5: 期望的md5值，不为None时在复制的同时计算md5值并校验，此时真正复制数据时不使用零拷贝系统调用，
+        硬链接和reflink没有读取数据，需要读取一遍目标文件；不一致时抛出DataError，复制的结果保留在临时文件中
+    :param overwrite: 是否允许覆盖已经存在的目标文件，复制成功后才原子地替换，失败时原来的目标文件不受影响
+    :return: 文件的实现方式：COPIED，REFLINKED或者HARDLINKED
+    """
+    if not overwrite and exists(dst):
+        raise FileExistsError(errno.EEXIST, '复制的目标文件已经存在', dst)
+    # 先写入临时文件，完成后再原子地重命名，中断时目标路径上不会出现不完整的文件
+    tmp_path = temp_path_of(dst)
+    if exists(tmp_path):
+        # 上次中断时留下的临时文件
+        os.remove(tmp_path)
+    method, copied_md5 = None, None
+    THROTTLE.consume_files()
+    if hardlink:
+        try:
+            os.link(src, tmp_path)
+            method = HARDLINKED
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+    if method is None:
+        with open(src, 'rb') as src_file:
+            size = os.fstat(src_file.fileno()).st_size
+            dst_file = open(tmp_path, 'xb')
+            try:
+                with dst_file:
+                    if reflink_file_data(src_file.fileno(), dst_file.fileno()):
+                        method = REFLINKED
+                    elif md5 is not None:
+                        method = COPIED
+                        copied_md5 = copy_file_data_with_md5(src_file.fileno(), dst_file.fileno(), progress)
+                    else:
+                        method = COPIED
+                        copy_file_data(src_file.fileno(), dst_file.fileno(), size, progress)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        shutil.copystat(src, tmp_path)
+    if method != COPIED:
+        if md5 is None:
+            if progress is not None:
+                progress(os.stat(tmp_path).st_size)
+        else:
+            with open(tmp_path, 'rb') as dst_file:
+                copied_md5 = copy_file_data_with_md5(dst_file.fileno(), None, progress)
+    assert md5 is None or copied_md5 == md5, DataError(f'复制的文件{dst}的md5值为{copied_md5}，与期望的{md5}不一致')
+    os.replace(tmp_path, dst)
+    return method
+
+
+def temp_path_of(path: str) -> str:
+    """
+    写入指定文件时使用的临时文件路径，与目标文件在同一目录下，所以可以原子地重命名
+    :param path: 目标文件路径
+    :return: 临时文件路径
+    """
+    return f'{path}{FileRecord.TEMP_SUFFIX}'
+
+
+# 大于该大小的冲突文件使用增量复制
+DELTA_COPY_SIZE = 64 * 1024 * 1024
+# 增量复制的块大小的范围，在范围内取文件大小的平方根，与rsync相同
+DELTA_MIN_BLOCK = 64 * 1024
+DELTA_MAX_BLOCK = 1024 * 1024
+# 增量复制时每次从源文件读取的字节数
+DELTA_READ_SIZE = 16 * 1024 * 1024
+# 逐字节滚动是纯Python实现的，远比直接复制慢：处理了至少DELTA_GIVE_UP_MIN字节的源文件后，
+# 不同数据的比例超过DELTA_GIVE_UP_RATIO时放弃增量复制，由调用方改为直接复制。每滚动DELTA_GIVE_UP_CHECK字节检查一次
+DELTA_GIVE_UP_MIN = 1024 * 1024
+DELTA_GIVE_UP_RATIO = 0.5
+DELTA_GIVE_UP_CHECK = 64 * 1024
+# adler32的模数
+_ADLER_MOD = 65521
+
+
+def delta_copy(
+        src: str, basis: str, dst: str, progress: Callable[[int], None] = None
+) -> Union[Tuple[int, str], None]:
+    """
+    rsync式的增量复制：将基准文件按块计算adler32弱校验和与md5强校验和，然后在源文件上滚动计算弱校验和寻找相同的块，
+    以基准文件中已有的块和源文件中不同的数据重建出与源文件相同的目标文件。在源文件与基准文件只有少量不同时，
+    绝大部分数据直接从基准文件（通常在本地）复制，即使不同的部分使数据发生了偏移。
+    源文件对齐的位置先用zlib直接计算校验和，只有在不匹配时才逐字节滚动，所以相同的部分几乎没有额外的计算
+    :param src: 源文件路径
+    :param basis: 基准文件路径，即本地已有的旧版本文件
+    :param dst: 目标文件路径，不能已经存在，完成后复制源文件的元数据
+    :param progress: 每处理一部分源文件后以处理的字节数调用
+    :return: (从源文件写入的不同数据的字节数, 源文件的md5值)，源文件与基准文件差别太大而放弃时返回None，
+        此时目标文件已被删除，应改用copy_file直接复制
+    """
+    THROTTLE.consume_files()
+    block = min(DELTA_MAX_BLOCK, max(DELTA_MIN_BLOCK, isqrt(os.stat(basis).st_size)))
+    # [弱校验和] -> {强校验和: 基准文件中的偏移}
+    signatures: Dict[int, Dict[bytes, int]] = {}
+    with open(basis, 'rb') as basis_file:
+        offset = 0
+        while True:
+            data = basis_file.read(block)
+            THROTTLE.consume_bytes(len(data))
+            if len(data) < block:
+                break
+            signatures.setdefault(zlib.adler32(data), {}).setdefault(hashlib.md5(data).digest(), offset)
+            offset += block
+
+    m = hashlib.md5()
+    literal_size = 0
+    # 已经处理的源文件字节数，以及距离上次检查是否放弃滚动了多少字节
+    processed, unchecked = 0, 0
+    given_up = False
+    with open(src, 'rb') as src_file, open(basis, 'rb') as basis_file:
+        dst_file = open(dst, 'xb')
+        try:
+            with dst_file:
+                dst_fd, basis_fd = dst_file.fileno(), basis_file.fileno()
+                window, pos, eof = bytearray(), 0, False
+                literal = bytearray()
+                # 连续的匹配块合并为一次复制：(基准文件中的偏移, 长度)
+                match_offset, match_length = 0, 0
+
+                def flush_literal():
+                    nonlocal literal_size
+                    if len(literal) > 0:
+                        _write_all(dst_fd, literal)
+                        literal_size += len(literal)
+                        literal.clear()
+
+                def flush_match():
+                    nonlocal match_length
+                    if match_length > 0:
+                        _copy_range(basis_fd, dst_fd, match_offset, match_length)
+                        match_length = 0
+
+                def fill() -> bool:
+                    nonlocal window, pos, eof
+                    if eof:
+                        return False
+                    data = src_file.read(THROTTLE.read_size(DELTA_READ_SIZE))
+                    if not data:
+                        eof = True
+                        return False
+                    THROTTLE.consume_bytes(len(data))
+                    m.update(data)
+                    if progress is not None:
+                        progress(len(data))
+                    window = window[pos:] + data
+                    pos = 0
+                    return True
+
+                weak = None
+                while True:
+                    while len(window) - pos < block and fill():
+                        pass
+                    if len(window) - pos < block:
+                        break
+                    if weak is None:
+                        weak = zlib.adler32(window[pos:pos + block])
+                    candidates = signatures.get(weak)
+                    if candidates is not None:
+                        offset = candidates.get(hashlib.md5(window[pos:pos + block]).digest())
+                        if offset is not None:
+                            flush_literal()
+                            if match_length > 0 and match_offset + match_length == offset:
+                                match_length += block
+                            else:
+                                flush_match()
+                                match_offset, match_length = offset, block
+                            pos += block
+                            processed += block
+                            weak = None
+                            continue
+                    # 没有匹配的块，输出一个字节并滚动弱校验和
+                    flush_match()
+                    processed += 1
+                    unchecked += 1
+                    if unchecked >= DELTA_GIVE_UP_CHECK:
+                        unchecked = 0
+                        if processed >= DELTA_GIVE_UP_MIN and \
+                                literal_size + len(literal) > DELTA_GIVE_UP_RATIO * processed:
+                            given_up = True
+                            break
+                    if len(window) - pos == block and not fill():
+                        literal.extend(window[pos:pos + 1])
+                        pos += 1
+                        weak = None
+                        continue
+                    out, new = window[pos], window[pos + block]
+                    literal.append(out)
+                    pos += 1
+                    a = (weak & 0xffff) - out + new
+                    a %= _ADLER_MOD
+                    b = ((weak >> 16) - block * out + a - 1) % _ADLER_MOD
+                    weak = (b << 16) | a
+                    if len(literal) >= DELTA_READ_SIZE:
+                        flush_literal()
+                if not given_up:
+                    flush_match()
+                    literal.extend(window[pos:])
+                    flush_literal()
+        except BaseException:
+            os.remove(dst)
+            raise
+    if given_up:
+        os.remove(dst)
+        return None
+    shutil.copystat(src, dst)
+    return literal_size, m.hexdigest()
+
+
+def _write_all(fd: int, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, count: int):
+    """
+    将源文件中指定范围的数据复制到目标文件的当前位置
+    :param src_fd: 源文件描述符
+    :param dst_fd: 目标文件描述符
+    :param offset: 源文件中的偏移
+    :param count: 字节数
+    :return: None
+    """
+    if _copy_file_range is not None:
+        try:
+            while count > 0:
+                n = os.copy_file_range(src_fd, dst_fd, min(THROTTLE.read_size(count), count), offset)
+                if n == 0:
+                    break
+                THROTTLE.consume_bytes(n)
+                offset += n
+                count -= n
+            if count == 0:
+                return
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    while count > 0:
+        data = os.pread(src_fd, min(COPY_BUFFER, count), offset)
+        if not data:
+            raise RunTimeError(f'增量复制时基准文件在偏移{offset}处提前结束')
+        THROTTLE.consume_bytes(len(data))
+        _write_all(dst_fd, data)
+        offset += len(data)
+        count -= len(data)
+
+
+class CopyEngine:
+    """
+    并行的批量文件复制：按(源设备, 目标设备)将复制任务分组，每组使用一个按设备速度确定大小的线程池，
+    不同设备组之间并行，以便多个设备同时满负荷工作；复制进度以字节数显示
+    """
+    # [设备读取速度等级] -> 每组的线程数，机械硬盘并发读写会导致大量寻道，只使用一个线程
+    WORKERS = {
+        DeviceSpeed.FAST: 8,
+        DeviceSpeed.UNKNOWN: 2,
+        DeviceSpeed.SLOW: 1,
+    }
+
+    def __init__(
+            self, speed: DeviceSpeed = None, hardlink: bool = False, quarantine: Callable[[str], str] = None,
+            journal: 'CopyJournal' = None
+    ):
+        """
+        :param speed: 设备速度的估计
+        :param hardlink: 源和目标在同一文件系统时是否优先使用硬链接，见copy_file
+        :param quarantine: 校验失败的目标文件路径 -> 隔离的路径，为None时删除校验失败的目标文件
+        :param journal: 记录每个复制结果的复制日志，为None时不记录
+        """
+        self.speed = speed or DeviceSpeed()
+        self.hardlink = hardlink
+        self.quarantine = quarantine
+        self.journal = journal
+        # [文件的实现方式] -> 文件数
+        self.methods: Dict[str, int] = {}
+        # [目标文件路径] -> 校验通过的md5值
+        self.verified: Dict[str, str] = {}
+        # [目标文件路径] -> 隔离的路径
+        self.quarantined: Dict[str, str] = {}
+
+    def copy(
+            self, pairs: List[Tuple[str, str]], desc: str = '复制文件', md5s: Dict[str, str] = None,
+            overwrite: Set[str] = None
+    ) -> Dict[str, Exception]:
+        """
+        批量复制文件，目标文件的父目录会被自动创建，各实现方式的文件数累计在methods中
+        :param pairs: (源文件路径, 目标文件路径)列表
+        :param desc: 进度条的说明
+        :param md5s: [目标文件路径] -> 期望的md5值，这些文件在复制的同时校验，
+            校验通过的记录在verified中，不通过的被隔离并记录在quarantined中
+        :param overwrite: 允许覆盖的目标文件路径，见copy_file
+        :return: [目标文件路径] -> 复制失败的原因
+        """
+        md5s = md5s or {}
+        overwrite = overwrite or set()
+        groups: Dict[Tuple[int, int], List[Tuple[str, str, int]]] = {}
+        failed = {}
+        for src, dst in pairs:
+            try:
+                size = os.stat(src).st_size
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+            except OSError as e:
+                failed[dst] = e
+                if self.journal is not None:
+                    self.journal.record(dst, e)
+                continue
+            key = (device_of(src), device_of(os.path.dirname(dst)))
+            groups.setdefault(key, []).append((src, dst, size))
+        total = sum(size for group in groups.values() for _, _, size in group)
+
+        lock = Lock()
+        with tqdm(
+                total=total, desc=desc, unit='B', unit_scale=True, unit_divisor=1024,
+                disable=len(pairs) < 3
+        ) as bar:
+            def progress(n: int):
+                with lock:
+                    bar.update(n)
+
+            def run(batch: List[Tuple[str, str, int]]):
+                for src, dst, _ in batch:
+                    md5 = md5s.get(dst)
+                    try:
+                        method = copy_file(src, dst, progress, self.hardlink, md5, dst in overwrite)
+                        with lock:
+                            self.methods[method] = self.methods.get(method, 0) + 1
+                            if md5 is not None:
+                                self.verified[dst] = md5
+                            if self.journal is not None:
+                                self.journal.record(dst)
+                    except DataError as e:
+                        self._quarantine(dst)
+                        with lock:
+                            failed[dst] = e
+                            if self.journal is not None:
+                                self.journal.record(dst, e)
+                    except Exception as e:
+                        with lock:
+                            failed[dst] = e
+                            if self.journal is not None:
+                                self.journal.record(dst, e)
+
+            executors = []
+            try:
+                futures = []
+                for (src_device, dst_device), group in groups.items():
+                    workers = self.WORKERS[max(self.speed.rank(src_device), self.speed.rank(dst_device))]
+                    executor = ThreadPoolExecutor(max_workers=workers)
+                    executors.append(executor)
+                    futures.extend(executor.submit(run, batch) for batch in self._batches(group))
+                for future in futures:
+                    future.result()
+            finally:
+                for executor in executors:
+                    executor.shutdown(wait=True, cancel_futures=True)
+        return failed
+
+    def _quarantine(self, path: str):
+        """
+        隔离校验失败的文件，使其不会被当作正常的文件管理
+        :param path: 目标文件路径，校验失败的复制结果在其临时文件中
+        :return: None
+        """
+        if self.quarantine is None:
+            os.remove(temp_path_of(path))
+            return
+        quarantine_path = self.quarantine(path)
+        os.makedirs(os.path.dirname(quarantine_path), exist_ok=True)
+        os.replace(temp_path_of(path), quarantine_path)
+        self.quarantined[path] = quarantine_path
+
+    @staticmethod
+    def _batches(group: List[Tuple[str, str, int]]) -> List[List[Tuple[str, str, int]]]:
+        """
+        将一组复制任务按源路径排序（同一目录下的文件在机械硬盘上通常相邻），并将连续的小文件合并为一个任务
+        :param group: (源文件路径, 目标文件路径, 大小)列表
+        :return: 任务列表
+        """
+        batches, batch, batch_size = [], [], 0
+        for each in sorted(group):
+            if each[2] >= SMALL_FILE_SIZE:
+                batches.append([each])
+                continue
+            batch.append(each)
+            batch_size += each[2]
+            if len(batch) >= SMALL_FILE_BATCH_COUNT or batch_size >= SMALL_FILE_BATCH_SIZE:
+                batches.append(batch)
+                batch, batch_size = [], 0
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+
+class CopyJournal:
+    """
+    复制日志：以JSON行的形式追加记录计划的复制以及每个复制的结果，复制中断（例如拔出设备、Ctrl-C）后，
+    下次运行时可以直接继续未完成的复制，而不需要重新比较和在其他物理位置中寻找来源。
+    因为目标文件是在复制完成后原子地重命名得到的，目标文件存在即表示复制已经完成，即使日志中没有来得及记录；
+    覆盖已有文件的复制除外，它们只有记录了完成才算完成
+    """
+    PLANNED, DONE, FAILED = 'planned', 'done', 'failed'
+
+    def __init__(self, path: str):
+        """
+        :param path: 日志文件路径
+        """
+        self.path = path
+        self._file = None
+
+    def plan(self, pairs: List[Tuple[str, str]], md5s: Dict[str, str] = None, overwrite: Set[str] = None):
+        """
+        记录计划的复制
+        :param pairs: (源文件路径, 目标文件路径)列表
+        :param md5s: [目标文件路径] -> 期望的md5值
+        :param overwrite: 覆盖已有文件的目标文件路径
+        :return: None
+        """
+        if len(pairs) == 0:
+            return
+        md5s = md5s or {}
+        overwrite = overwrite or set()
+        for src, dst in pairs:
+            entry = {'op': self.PLANNED, 'src': src, 'dst': dst, 'md5': md5s.get(dst)}
+            if dst in overwrite:
+                entry['overwrite'] = True
+            self._write(entry)
+        os.fsync(self._file.fileno())
+
+    def record(self, dst: str, error: Exception = None):
+        """
+        记录一个复制的结果
+        :param dst: 目标文件路径
+        :param error: 失败的原因，为None表示复制完成
+        :return: None
+        """
+        if error is None:
+            self._write({'op': self.DONE, 'dst': dst})
+        else:
+            self._write({'op': self.FAILED, 'dst': dst, 'error': str(error)})
+
+    def pending(self) -> Tuple[List[Tuple[str, str]], Dict[str, str], Dict[str, str], Set[str]]:
+        """
+        读取日志中还没有完成的复制，失败的复制也需要重试。日志的最后一行可能因为中断而不完整，会被忽略
+        :return: ((源文件路径, 目标文件路径)列表, [目标文件路径] -> 期望的md5值, [目标文件路径] -> 上次失败的原因,
+            覆盖已有文件的目标文件路径)
+        """
+        planned: Dict[str, Tuple[str, str]] = {}
+        errors = {}
+        overwrite = set()
+        if not exists(self.path):
+            return [], {}, {}, set()
+        with open(self.path, 'r', encoding='utf8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry['op'] == self.PLANNED:
+                    planned[entry['dst']] = (entry['src'], entry['md5'])
+                    if entry.get('overwrite', False):
+                        overwrite.add(entry['dst'])
+                    else:
+                        overwrite.discard(entry['dst'])
+                elif entry['op'] == self.DONE:
+                    planned.pop(entry['dst'], None)
+                    errors.pop(entry['dst'], None)
+                elif entry['op'] == self.FAILED:
+                    errors[entry['dst']] = entry['error']
+        planned = {dst: each for dst, each in planned.items() if dst in overwrite or not exists(dst)}
+        return (
+            [(src, dst) for dst, (src, _) in planned.items()],
+            {dst: md5 for dst, (_, md5) in planned.items() if md5 is not None},
+            {dst: error for dst, error in errors.items() if dst in planned},
+            {dst for dst in overwrite if dst in planned}
+        )
+
+    def remove(self):
+        """
+        所有的复制都已经完成，删除日志
+        :return: None
+        """
+        self.close()
+        if exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry: dict):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf8')
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()